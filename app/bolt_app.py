@@ -1,51 +1,99 @@
-import os, re
-from datetime import datetime, timezone, timedelta
+import os, re, atexit, logging
+from datetime import datetime
 from dotenv import load_dotenv
 from slack_bolt import App
 from slack_bolt.adapter.socket_mode import SocketModeHandler
 from slack_bolt.response import BoltResponse
+from slack_sdk.errors import SlackApiError
 from rag.retriever import retrieve
-from rag.generator import generate_answer
+from rag.timewindow import extract_time_window
+from rag.generator import generate_answer, stream_answer
 from utils.blocks import build_answer_blocks, build_date_time_picker, build_channel_picker
-from store import init_db, get_last_channel, set_last_channel
+from store import init_db, ensure_os_index, get_last_channel, set_last_channel
+from ingest import workspace_url
+from realtime import WriteBehindWriter
+from outbox import OutboxReplayer
+import metrics
+import dm
 
 load_dotenv()
+metrics.configure_logging()
+log = logging.getLogger(__name__)
 app = App(token=os.environ["SLACK_BOT_TOKEN"])
 ALLOWED = os.environ["ALLOWED_CHANNEL_ID"]
 
-JST = timezone(timedelta(hours=9))
-
 # 起動時にDB準備
 init_db()
+# OpenSearch のインデックス確認も起動時に 1 回だけ行う（以降の検索では確認しない）
+try:
+    ensure_os_index()
+except Exception:
+    log.warning("OpenSearch index bootstrap failed (will retry on first search)", exc_info=True)
+
+# 新規・編集・削除メッセージを取り込むバックグラウンドライター
+writer = WriteBehindWriter(
+    workspace_url(app.client),
+    maxsize=int(os.getenv("REALTIME_QUEUE_SIZE", "10000")),
+    batch_size=int(os.getenv("REALTIME_FLUSH_BATCH", "100")),
+    flush_sec=float(os.getenv("REALTIME_FLUSH_SEC", "1.0")),
+)
+writer.start()
+atexit.register(writer.stop)
+
+# OpenSearch へ反映できなかった書き込みの再送
+replayer = OutboxReplayer()
+replayer.start()
+atexit.register(replayer.stop)
+
+# Prometheus テキスト形式の /metrics（METRICS_PORT=0 で無効）
+metrics.add_gauge("slackrag_realtime_writer", "Write-behind queue depth and counters", writer.stats)
+metrics.add_gauge("slackrag_outbox", "OpenSearch outbox depth / lag and replay counters", replayer.stats)
+metrics.start_http_server()
+
+# どのリスナーが処理するかに関係なく、メッセージイベントはすべて取り込みキューへ
+@app.middleware
+def ingest_message_events(body, next):
+    event = body.get("event")
+    if event:
+        writer.handle_event(event)
+    next()
+
+# 編集・削除イベントは上のミドルウェアで取り込むだけ（未処理警告を出さないための受け口）
+@app.event({"type": "message", "subtype": "message_changed"})
+@app.event({"type": "message", "subtype": "message_deleted"})
+def on_message_edited_or_deleted():
+    pass
 
 @app.command("/ask")
 def on_ask(ack, body, client):
     ack()
+    with metrics.request("ask"):
+        _on_ask(body, client)
+
+def _on_ask(body, client):
     q = (body.get("text") or "").strip()
     user = body["user_id"]
     channel = body["channel_id"]
 
     if channel != ALLOWED:
         client.chat_postEphemeral(channel=channel, user=user,
-            text="このコマンドは指定チャンネルでのみ使用可能である。")
+            text=dm.ASK_NOT_ALLOWED)
         return
 
-    # RAG: 素朴検索（後で生成を追加）
-    hits = retrieve(q, ALLOWED, k=5)
-    if not hits:
-        answer = f"該当を見つけられなかった。検索語を変えて再試行してほしい。\n> `{q}`"
-    else:
-        # ここでは回答は簡潔に（将来 GPT-5 を組み合わせ）
-        answer = f"問い合わせ: *{q}*\n上位の関連メッセージを返す。"
+    # RAG: 素朴検索（後で生成を追加）。「先週」などの期間指定は検索の時間窓にする
+    query, window = extract_time_window(q)
+    hits = retrieve(query, ALLOWED, k=5, window=window)
+    answer = dm.ask_answer(q, hits)
 
     # DMへ回答
-    im = client.conversations_open(users=user)
-    client.chat_postMessage(channel=im["channel"]["id"],
-                            text="Answer",
-                            blocks=build_answer_blocks(answer, hits))
+    with metrics.stage("slack_post"):
+        im = client.conversations_open(users=user)
+        client.chat_postMessage(channel=im["channel"]["id"],
+                                text="Answer",
+                                blocks=build_answer_blocks(answer, hits))
 
     # ついでに日付・時刻の希望を聞く UI を送る例
-    today = datetime.now(JST).strftime("%Y-%m-%d")
+    today = datetime.now(dm.JST).strftime("%Y-%m-%d")
     client.chat_postMessage(channel=im["channel"]["id"],
                             text="Pick date/time",
                             blocks=build_date_time_picker(today, "10:00"))
@@ -57,11 +105,16 @@ def on_dm_message(message, say, client, logger, context):
     if message.get("channel_type") != "im":
         return
 
+    with metrics.request("dm") as trace:
+        _on_dm_message(message, say, client, logger, trace)
+
+def _on_dm_message(message, say, client, logger, trace):
     user = message["user"]
     text = (message.get("text") or "").strip()
 
     # 既定チャンネルを取得
-    last_ch = get_last_channel(user)
+    with metrics.stage("get_last_channel"):
+        last_ch = get_last_channel(user)
 
     # まだ設定されてなければ、ピッカーを提示して終了
     if not last_ch:
@@ -69,19 +122,64 @@ def on_dm_message(message, say, client, logger, context):
         return
 
     # 普通の問い合わせとして扱う
+    started = trace.started
+    placeholder = None
     try:
-        hits = retrieve(text, last_ch, k=6)
+        # 「先週」「last 30 days」などの期間指定は時間窓にして検索語から外す（生成には元の質問文を渡す）
+        query, window = extract_time_window(text)
+        hits = retrieve(query, last_ch, k=6, window=window)
+        if hits and dm.STREAM:
+            with metrics.stage("slack_say"):
+                placeholder = say(text=dm.PLACEHOLDER)
+            stream_answer_to_slack(client, logger, placeholder, text, hits, started)
+            return
         if not hits:
-            answer = f"検索対象: <#{last_ch}>\n該当が見つからなかった。もう少し具体的に尋ねてください。"
+            answer = dm.no_hits(last_ch)
         else:
-            answer = generate_answer(text, hits)
+            with metrics.stage("generate"):
+                answer = generate_answer(text, hits)
 
         # 回答 + 出典
-        say(blocks=build_answer_blocks(answer, hits), text="Answer")
+        with metrics.stage("slack_say"):
+            say(blocks=build_answer_blocks(answer, hits), text="Answer")
 
     except Exception as e:
-        logger.exception(e)
-        say(text=f"内部エラーが発生しました。管理者に連絡してください。\n```{e}```")
+        logger.exception(f"request_id={trace.id} {e!r}")
+        # ストリーミング中の失敗はプレースホルダ側に表示済み
+        if placeholder is None:
+            say(text=dm.error_text(trace.id, e))
+
+def update_progress(client, logger, channel, ts, text) -> bool:
+    try:
+        with metrics.stage("slack_update"):
+            client.chat_update(channel=channel, ts=ts, text=text)
+    except SlackApiError as e:
+        dm.progress_failed(logger, e)
+        return False
+    return True
+
+def stream_answer_to_slack(client, logger, placeholder, query, hits, started):
+    """
+    投稿済みのプレースホルダを生成中のテキストで更新し、最後に出典ブロック付きの回答で置き換える。
+    失敗したらプレースホルダをエラー表示に置き換えて元の例外を送出する。
+    """
+    channel, ts = placeholder["channel"], placeholder["ts"]
+    progress = dm.StreamProgress(started)
+    try:
+        for delta in stream_answer(query, hits):
+            text = progress.feed(delta)
+            if text is not None and update_progress(client, logger, channel, ts, text):
+                progress.shown()
+        dm.CHAT_UPDATE.acquire()
+        with metrics.stage("slack_update"):
+            client.chat_update(channel=channel, ts=ts, text="Answer", blocks=build_answer_blocks(progress.answer, hits))
+    except Exception as e:
+        try:
+            client.chat_update(channel=channel, ts=ts, text=dm.error_text(metrics.request_id(), e))
+        except Exception:
+            dm.placeholder_failed(logger)
+        raise
+    progress.finish(logger)
 
 # ---------- ③ チャンネル選択のハンドラ ----------
 import re
@@ -96,11 +194,8 @@ def on_pick_channel(ack, body, client, say):
     client.chat_update(
         channel=body["channel"]["id"],
         ts=body["message"]["ts"],
-        text="検索対象チャンネルを設定しました。",
-        blocks=[
-            {"type":"section","text":{"type":"mrkdwn","text":f"✅ 検索対象を <#{selected}> に設定しました。以降はこのDMにメッセージを送るだけで検索できます。"}},
-            {"type":"context","elements":[{"type":"mrkdwn","text":"変更したいときは『チャンネル変更』と送ってください。"}]}
-        ]
+        text=dm.CHANNEL_SET,
+        blocks=dm.channel_set_blocks(selected),
     )
 
 # ---------- ④ チャンネル変更のキーワード ----------
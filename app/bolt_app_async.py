@@ -0,0 +1,269 @@
+"""
+bolt_app.py の asyncio 版（AsyncApp + 非同期 Socket Mode、uvloop 上で動作）。
+
+SQLite / 検索 / LLM はブロッキングなので上限付きのスレッドプールへ逃がし、
+LLM 生成の同時実行数は RAG_MAX_CONCURRENT_GENERATIONS で制限する。
+遅い LLM 応答があっても他ユーザーのイベント処理は止まらない。
+
+    python app/bolt_app_async.py
+"""
+import os, re, asyncio, logging, functools, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from dotenv import load_dotenv
+from slack_bolt.async_app import AsyncApp
+from slack_bolt.adapter.socket_mode.async_handler import AsyncSocketModeHandler
+from slack_sdk.errors import SlackApiError
+from rag.retriever import retrieve
+from rag.timewindow import extract_time_window
+from rag.generator import generate_answer, stream_answer
+from utils.blocks import build_answer_blocks, build_date_time_picker, build_channel_picker
+from store import init_db, ensure_os_index, get_last_channel, set_last_channel
+from realtime import WriteBehindWriter
+from outbox import OutboxReplayer
+import metrics
+import dm
+
+load_dotenv()
+metrics.configure_logging()
+log = logging.getLogger(__name__)
+app = AsyncApp(token=os.environ["SLACK_BOT_TOKEN"])
+ALLOWED = os.environ["ALLOWED_CHANNEL_ID"]
+
+# SQLite / 検索用と LLM 用でプールを分け、LLM が I/O 用スレッドを食い潰さないようにする
+MAX_GENERATIONS = int(os.getenv("RAG_MAX_CONCURRENT_GENERATIONS", "4"))
+_io_pool = ThreadPoolExecutor(max_workers=int(os.getenv("RAG_IO_WORKERS", "16")), thread_name_prefix="io")
+_llm_pool = ThreadPoolExecutor(max_workers=MAX_GENERATIONS, thread_name_prefix="llm")
+_gen_slots = asyncio.Semaphore(MAX_GENERATIONS)
+
+_DONE = object()
+
+writer: WriteBehindWriter | None = None
+
+
+def _in_context(fn, *args, **kwargs):
+    # run_in_executor は contextvars を引き継がないので、計時が同じリクエストに載るよう明示的に渡す
+    return functools.partial(contextvars.copy_context().run, functools.partial(fn, *args, **kwargs))
+
+
+async def run_io(fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_io_pool, _in_context(fn, *args, **kwargs))
+
+
+async def run_llm(fn, *args, **kwargs):
+    async with _gen_slots:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_llm_pool, _in_context(fn, *args, **kwargs))
+
+
+async def astream_answer(query, hits):
+    """stream_answer を LLM プール上で回し、差分をイベントループ側へ渡す。"""
+    async with _gen_slots:
+        loop = asyncio.get_running_loop()
+        queue: asyncio.Queue = asyncio.Queue()
+
+        def pump():
+            try:
+                for delta in stream_answer(query, hits):
+                    loop.call_soon_threadsafe(queue.put_nowait, delta)
+            except BaseException as e:
+                loop.call_soon_threadsafe(queue.put_nowait, e)
+                return
+            loop.call_soon_threadsafe(queue.put_nowait, _DONE)
+
+        fut = loop.run_in_executor(_llm_pool, _in_context(pump))
+        while True:
+            item = await queue.get()
+            if item is _DONE:
+                break
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+        await fut
+
+
+@app.middleware
+async def ingest_message_events(body, next):
+    event = body.get("event")
+    if event and writer is not None:
+        # イベントループを止めないよう、キューが満杯なら待たずに捨てる
+        writer.handle_event(event, block=False)
+    await next()
+
+
+@app.event({"type": "message", "subtype": "message_changed"})
+@app.event({"type": "message", "subtype": "message_deleted"})
+async def on_message_edited_or_deleted():
+    pass
+
+
+@app.command("/ask")
+async def on_ask(ack, body, client):
+    await ack()
+    with metrics.request("ask"):
+        await _on_ask(body, client)
+
+
+async def _on_ask(body, client):
+    q = (body.get("text") or "").strip()
+    user = body["user_id"]
+    channel = body["channel_id"]
+
+    if channel != ALLOWED:
+        await client.chat_postEphemeral(channel=channel, user=user,
+            text=dm.ASK_NOT_ALLOWED)
+        return
+
+    query, window = extract_time_window(q)
+    hits = await run_io(retrieve, query, ALLOWED, k=5, window=window)
+    answer = dm.ask_answer(q, hits)
+
+    with metrics.stage("slack_post"):
+        im = await client.conversations_open(users=user)
+        await client.chat_postMessage(channel=im["channel"]["id"],
+                                      text="Answer",
+                                      blocks=build_answer_blocks(answer, hits))
+
+    today = datetime.now(dm.JST).strftime("%Y-%m-%d")
+    await client.chat_postMessage(channel=im["channel"]["id"],
+                                  text="Pick date/time",
+                                  blocks=build_date_time_picker(today, "10:00"))
+
+
+@app.message(re.compile(r"^.*"))
+async def on_dm_message(message, say, client, logger, context):
+    if message.get("channel_type") != "im":
+        return
+
+    with metrics.request("dm") as trace:
+        await _on_dm_message(message, say, client, logger, trace)
+
+
+async def _on_dm_message(message, say, client, logger, trace):
+    user = message["user"]
+    text = (message.get("text") or "").strip()
+
+    with metrics.stage("get_last_channel"):
+        last_ch = await run_io(get_last_channel, user)
+    if not last_ch:
+        await say(blocks=build_channel_picker(), text="Choose a channel to search")
+        return
+
+    started = trace.started
+    placeholder = None
+    try:
+        # 「先週」「last 30 days」などの期間指定は時間窓にして検索語から外す（生成には元の質問文を渡す）
+        query, window = extract_time_window(text)
+        hits = await run_io(retrieve, query, last_ch, k=6, window=window)
+        if hits and dm.STREAM:
+            with metrics.stage("slack_say"):
+                placeholder = await say(text=dm.PLACEHOLDER)
+            await stream_answer_to_slack(client, logger, placeholder, text, hits, started)
+            return
+        if not hits:
+            answer = dm.no_hits(last_ch)
+        else:
+            # 生成枠の待ち時間も含めて計る
+            with metrics.stage("generate"):
+                answer = await run_llm(generate_answer, text, hits)
+
+        with metrics.stage("slack_say"):
+            await say(blocks=build_answer_blocks(answer, hits), text="Answer")
+
+    except Exception as e:
+        logger.exception(f"request_id={trace.id} {e!r}")
+        # ストリーミング中の失敗はプレースホルダ側に表示済み
+        if placeholder is None:
+            await say(text=dm.error_text(trace.id, e))
+
+
+async def update_progress(client, logger, channel, ts, text) -> bool:
+    try:
+        with metrics.stage("slack_update"):
+            await client.chat_update(channel=channel, ts=ts, text=text)
+    except SlackApiError as e:
+        dm.progress_failed(logger, e)
+        return False
+    return True
+
+
+async def stream_answer_to_slack(client, logger, placeholder, query, hits, started):
+    channel, ts = placeholder["channel"], placeholder["ts"]
+    progress = dm.StreamProgress(started)
+    try:
+        async for delta in astream_answer(query, hits):
+            text = progress.feed(delta)
+            if text is not None and await update_progress(client, logger, channel, ts, text):
+                progress.shown()
+        # 最後の更新だけは枠が空くまで待つ（イベントループは止めない）
+        while not dm.CHAT_UPDATE.acquire(timeout=0):
+            await asyncio.sleep(dm.CHAT_UPDATE.ready_in())
+        with metrics.stage("slack_update"):
+            await client.chat_update(channel=channel, ts=ts, text="Answer", blocks=build_answer_blocks(progress.answer, hits))
+    except Exception as e:
+        # エラー表示に失敗しても元の例外を優先する
+        try:
+            await client.chat_update(channel=channel, ts=ts, text=dm.error_text(metrics.request_id(), e))
+        except Exception:
+            dm.placeholder_failed(logger)
+        raise
+    progress.finish(logger)
+
+
+@app.action("pick_channel")
+async def on_pick_channel(ack, body, client):
+    await ack()
+    user = body["user"]["id"]
+    selected = body["actions"][0]["selected_conversation"]
+    await run_io(set_last_channel, user, selected)
+
+    await client.chat_update(
+        channel=body["channel"]["id"],
+        ts=body["message"]["ts"],
+        text=dm.CHANNEL_SET,
+        blocks=dm.channel_set_blocks(selected),
+    )
+
+
+@app.message(re.compile(r"^(チャンネル変更|change channel)$", re.I))
+async def on_change_channel(message, say):
+    await say(blocks=build_channel_picker(), text="Choose a channel")
+
+
+async def main():
+    global writer
+    await run_io(init_db)
+    try:
+        await run_io(ensure_os_index)
+    except Exception:
+        log.warning("OpenSearch index bootstrap failed (will retry on first search)", exc_info=True)
+    base_url = os.getenv("SLACK_WORKSPACE_URL") or (await app.client.auth_test())["url"]
+    writer = WriteBehindWriter(
+        base_url.rstrip("/") + "/",
+        maxsize=int(os.getenv("REALTIME_QUEUE_SIZE", "10000")),
+        batch_size=int(os.getenv("REALTIME_FLUSH_BATCH", "100")),
+        flush_sec=float(os.getenv("REALTIME_FLUSH_SEC", "1.0")),
+    )
+    writer.start()
+    replayer = OutboxReplayer()
+    replayer.start()
+    metrics.add_gauge("slackrag_realtime_writer", "Write-behind queue depth and counters", writer.stats)
+    metrics.add_gauge("slackrag_outbox", "OpenSearch outbox depth / lag and replay counters", replayer.stats)
+    metrics.start_http_server()
+    try:
+        await AsyncSocketModeHandler(app, os.environ["SLACK_APP_TOKEN"]).start_async()
+    finally:
+        await run_io(writer.stop)
+        await run_io(replayer.stop)
+
+
+if __name__ == "__main__":
+    try:
+        import uvloop
+    except ImportError:
+        uvloop = None
+    if uvloop is not None:
+        uvloop.run(main())
+    else:
+        asyncio.run(main())
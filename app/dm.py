@@ -0,0 +1,107 @@
+"""
+DM / /ask 応答の共通部分（bolt_app.py と bolt_app_async.py の両方から使う）。
+
+文言・途中経過の更新方針（chat.update の枠と間隔）・計時をここに置き、
+各アプリには同期 / 非同期の Slack 呼び出しだけを残す。
+"""
+import os, time
+from datetime import timezone, timedelta
+from typing import List, Dict, Optional
+from slack_sdk.errors import SlackApiError
+from utils.ratelimit import TokenBucket
+import metrics
+
+JST = timezone(timedelta(hours=9))
+
+# 回答をストリーミングで chat_update する（chat.update のレート制限内に収まる間隔で更新）
+STREAM = os.getenv("RAG_STREAM", "1") == "1"
+STREAM_UPDATE_SEC = float(os.getenv("SLACK_STREAM_UPDATE_SEC", "1.0"))
+# chat.update（Tier 3）は同時に走る全回答で共有する。途中経過は枠が無ければ送らない
+CHAT_UPDATE = TokenBucket(float(os.getenv("SLACK_CHAT_UPDATE_PER_MIN", "50")) / 60, burst=5)
+
+TIME_TO_FIRST_TEXT = metrics.histogram("slackrag_dm_time_to_first_text_seconds",
+                                       "DM: time until the first streamed text is shown")
+
+# ---------- 文言 ----------
+ASK_NOT_ALLOWED = "このコマンドは指定チャンネルでのみ使用可能である。"
+PLACEHOLDER = "回答を作成中です…"
+CHANNEL_SET = "検索対象チャンネルを設定しました。"
+
+
+def ask_answer(q: str, hits: List[dict]) -> str:
+    if not hits:
+        return f"該当を見つけられなかった。検索語を変えて再試行してほしい。\n> `{q}`"
+    # ここでは回答は簡潔に（将来 GPT-5 を組み合わせ）
+    return f"問い合わせ: *{q}*\n上位の関連メッセージを返す。"
+
+
+def no_hits(channel_id: str) -> str:
+    return f"検索対象: <#{channel_id}>\n該当が見つからなかった。もう少し具体的に尋ねてください。"
+
+
+def error_text(request_id, e) -> str:
+    return f"内部エラーが発生しました。管理者に連絡してください。（request_id: {request_id}）\n```{e}```"
+
+
+def channel_set_blocks(selected: str) -> List[Dict]:
+    return [
+        {"type":"section","text":{"type":"mrkdwn","text":f"✅ 検索対象を <#{selected}> に設定しました。以降はこのDMにメッセージを送るだけで検索できます。"}},
+        {"type":"context","elements":[{"type":"mrkdwn","text":"変更したいときは『チャンネル変更』と送ってください。"}]}
+    ]
+
+# ---------- 途中経過の更新方針と計時 ----------
+def _retry_after(e: SlackApiError) -> float:
+    headers = e.response.headers or {}
+    return float(headers.get("Retry-After", headers.get("retry-after", 1)))
+
+
+def progress_failed(logger, e: SlackApiError):
+    """途中経過の chat_update が失敗した。429 なら全回答で枠を止め、それ以外はログだけ（回答全体は失敗にしない）。"""
+    if e.response.status_code == 429:
+        CHAT_UPDATE.pause(_retry_after(e))
+    else:
+        logger.warning(f"request_id={metrics.request_id()} skipped progress update: {e.response.get('error')}")
+
+
+def placeholder_failed(logger):
+    logger.warning(f"request_id={metrics.request_id()} failed to show the error on the placeholder", exc_info=True)
+
+
+class StreamProgress:
+    """
+    ストリーミング回答 1 件分の状態。feed() が送るべき途中経過を返し（STREAM_UPDATE_SEC 間隔・CHAT_UPDATE の枠があるときだけ）、
+    呼び出し側が chat_update に成功したら shown() を呼ぶ。finish() で最初の表示までの時間を記録する。
+    """
+
+    def __init__(self, started: float):
+        self.started = started
+        self.parts: List[str] = []
+        self.first_text_ms: Optional[float] = None
+        self._last_update = 0.0
+        self._pending_at = 0.0
+
+    def feed(self, delta: str) -> Optional[str]:
+        self.parts.append(delta)
+        now = time.perf_counter()
+        if now - self._last_update < STREAM_UPDATE_SEC:
+            return None
+        self._last_update = now
+        if not CHAT_UPDATE.acquire(timeout=0):
+            return None
+        self._pending_at = now
+        return "".join(self.parts) + " ▍"
+
+    def shown(self):
+        if self.first_text_ms is None:
+            self.first_text_ms = (self._pending_at - self.started) * 1000
+
+    @property
+    def answer(self) -> str:
+        return "".join(self.parts).strip()
+
+    def finish(self, logger):
+        total_ms = (time.perf_counter() - self.started) * 1000
+        first_text_ms = self.first_text_ms if self.first_text_ms is not None else total_ms
+        TIME_TO_FIRST_TEXT.observe(first_text_ms / 1000)
+        metrics.annotate(time_to_first_text_ms=round(first_text_ms))
+        logger.info(f"dm_answer request_id={metrics.request_id()} time_to_first_text_ms={first_text_ms:.0f} total_ms={total_ms:.0f}")
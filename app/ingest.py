@@ -1,43 +1,236 @@
-import os, re
+import os, re, time, argparse, contextlib, contextvars
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Any
 from dotenv import load_dotenv
 from slack_sdk import WebClient
-from app.store import init_db, upsert_message
+from slack_sdk.http_retry.builtin_handlers import RateLimitErrorRetryHandler
+from store import init_db, upsert_messages, get_sync_state, set_sync_state
+from utils.ratelimit import TokenBucket
+from outbox import drain_outbox
+import metrics
 
 load_dotenv()
 client = WebClient(token=os.environ["SLACK_BOT_TOKEN"])
+# 429 が返ったら Retry-After に従って再試行する
+client.retry_handlers.append(RateLimitErrorRetryHandler(max_retry_count=3))
 ALLOWED = os.environ["ALLOWED_CHANNEL_ID"]
+# 同期対象チャンネル（カンマ区切り）。未指定なら ALLOWED_CHANNEL_ID のみ
+CHANNELS = [c.strip() for c in os.getenv("INGEST_CHANNEL_IDS", ALLOWED).split(",") if c.strip()]
+
+# パーマリンクの取得方法: "local"=ワークスペースURLから組み立て / "api"=chat_getPermalink
+PERMALINK_MODE = os.getenv("INGEST_PERMALINK_MODE", "local").lower()
+PERMALINK_CONCURRENCY = int(os.getenv("INGEST_PERMALINK_CONCURRENCY", "8"))
+CHANNEL_CONCURRENCY = int(os.getenv("INGEST_CHANNEL_CONCURRENCY", "4"))
+THREAD_CONCURRENCY = int(os.getenv("INGEST_THREAD_CONCURRENCY", "4"))
+# 増分同期時、この日数以内に親があるスレッドの新着返信を拾う
+THREAD_LOOKBACK_SEC = float(os.getenv("INGEST_THREAD_LOOKBACK_DAYS", "7")) * 86400
+
+# Slack の Tier 別レート制限（全チャンネル・全スレッドで共有）
+# conversations.history / conversations.replies = Tier 3, chat.getPermalink = Tier 4
+TIER3 = TokenBucket(float(os.getenv("SLACK_TIER3_PER_MIN", "50")) / 60, burst=5)
+TIER4 = TokenBucket(float(os.getenv("SLACK_TIER4_PER_MIN", "100")) / 60, burst=10)
+
+# rag/retriever.py と同じ RAG_DENSE。有効なら upsert に合わせてベクトル索引へ追記する（import でリスナー登録）
+DENSE = os.getenv("RAG_DENSE", "1") == "1"
+if DENSE:
+    from rag import dense
 
 MENTION = re.compile(r"<@([A-Z0-9]+)>")
 
+INGESTED = metrics.counter("slackrag_ingest_messages_total", "Messages seen by ingest, by outcome (new / changed / unchanged)")
+
 def normalize(text: str) -> str:
     return (text or "").strip()
 
-def run_full_sync():
-    init_db()
+def workspace_url(web: WebClient) -> str:
+    """
+    パーマリンクの組み立てに使うワークスペースURL（例: https://example.slack.com/）。
+    SLACK_WORKSPACE_URL が無ければ auth.test の結果を使う。
+    """
+    url = os.getenv("SLACK_WORKSPACE_URL") or web.auth_test()["url"]
+    return url.rstrip("/") + "/"
+
+def build_permalink(base_url: str, channel_id: str, ts: str, thread_ts: str | None = None) -> str:
+    # Slack のパーマリンク形式: /archives/<channel>/p<ts の数字部分>
+    pl = f"{base_url}archives/{channel_id}/p{ts.replace('.', '')}"
+    if thread_ts and thread_ts != ts:
+        pl += f"?thread_ts={thread_ts}&cid={channel_id}"
+    return pl
+
+def fetch_permalinks(web: WebClient, channel_id: str, messages: List[Dict[str, Any]],
+                     pool: ThreadPoolExecutor) -> List[str]:
+    """chat_getPermalink を同時実行数を絞って並列に呼ぶ。"""
+    def one(msg):
+        TIER4.acquire()
+        return web.chat_getPermalink(channel=channel_id, message_ts=msg["ts"])["permalink"]
+    return list(pool.map(one, messages))
+
+def to_record(channel_id: str, msg: Dict[str, Any], permalink: str) -> Dict[str, Any]:
+    ts = msg["ts"]
+    return {
+        "id": f"{channel_id}-{ts}",
+        "channel_id": channel_id,
+        "ts": ts,
+        # スレッド親 or 子の区別
+        "thread_ts": msg.get("thread_ts"),
+        "user_id": msg.get("user"),
+        "text_norm": normalize(msg.get("text", "")),
+        "permalink": permalink
+    }
+
+def fetch_replies(web: WebClient, channel_id: str, thread_ts: str, oldest: str | None) -> List[Dict[str, Any]]:
+    """スレッドの返信（親を除く）を oldest より新しいものだけ取得する。"""
+    replies = []
     cursor = None
     while True:
-        resp = client.conversations_history(channel=ALLOWED, cursor=cursor, limit=200)
-        for msg in resp.get("messages", []):
-            ts = msg["ts"]
-            text = normalize(msg.get("text", ""))
-            # スレッド親 or 子の区別
-            thread_ts = msg.get("thread_ts")
-            # パーマリンク
-            pl = client.chat_getPermalink(channel=ALLOWED, message_ts=ts)["permalink"]
-            rec = {
-                "id": f"{ALLOWED}-{ts}",
-                "channel_id": ALLOWED,
-                "ts": ts,
-                "thread_ts": thread_ts,
-                "user_id": msg.get("user"),
-                "text_norm": text,
-                "permalink": pl
-            }
-            upsert_message(rec)
+        TIER3.acquire()
+        kwargs = {"channel": channel_id, "ts": thread_ts, "cursor": cursor, "limit": 200}
+        if oldest:
+            kwargs["oldest"] = oldest
+        resp = web.conversations_replies(**kwargs)
+        replies.extend(m for m in resp.get("messages", []) if m["ts"] != thread_ts)
+        cursor = resp.get("response_metadata", {}).get("next_cursor")
+        if not cursor:
+            return replies
+
+def sync_channel(channel_id: str, web: WebClient = client, full: bool = False,
+                 link_pool: ThreadPoolExecutor | None = None,
+                 thread_pool: ThreadPoolExecutor | None = None) -> Dict[str, Any]:
+    """
+    1 チャンネルを同期する。full=False なら sync_state の last_ts より新しいものだけを取る。
+
+    - conversations_history の 1 ページ (200件) ごとに、SQLite へは 1 トランザクション、
+      OpenSearch へは 1 回の _bulk でまとめて書き込む。
+    - 返信のあるスレッドは conversations_replies を並列に取得する。親が古くても
+      THREAD_LOOKBACK_SEC 以内なら latest_reply を見て新着返信を拾う。
+    - link_pool / thread_pool を渡さなければこの呼び出しの間だけのプールを作る
+      （run_sync は全チャンネルで共有するプールを渡す）。
+    """
+    with contextlib.ExitStack() as stack:
+        if thread_pool is None:
+            thread_pool = stack.enter_context(ThreadPoolExecutor(max_workers=THREAD_CONCURRENCY))
+        if link_pool is None and PERMALINK_MODE != "local":
+            link_pool = stack.enter_context(ThreadPoolExecutor(max_workers=PERMALINK_CONCURRENCY))
+        return _sync_channel(channel_id, web, full, link_pool, thread_pool)
+
+def _sync_channel(channel_id: str, web: WebClient, full: bool,
+                  link_pool: ThreadPoolExecutor | None, thread_pool: ThreadPoolExecutor) -> Dict[str, Any]:
+    last_ts = None if full else get_sync_state(channel_id)
+    oldest = None
+    if last_ts:
+        oldest = f"{max(0.0, float(last_ts) - THREAD_LOOKBACK_SEC):.6f}"
+    base_url = workspace_url(web) if PERMALINK_MODE == "local" else None
+    high_water = last_ts
+    counts = {"messages": 0, "replies": 0, "threads": 0, "new": 0, "changed": 0, "unchanged": 0}
+
+    def is_new(ts: str) -> bool:
+        return last_ts is None or float(ts) > float(last_ts)
+
+    def write(messages: List[Dict[str, Any]]):
+        if not messages:
+            return
+        if base_url is not None:
+            links = [build_permalink(base_url, channel_id, m["ts"], m.get("thread_ts")) for m in messages]
+        else:
+            with metrics.stage("slack_permalinks"):
+                links = fetch_permalinks(web, channel_id, messages, link_pool)
+        # 内容が変わっていないメッセージは upsert_messages 側で書き込みを省く
+        with metrics.stage("store_upsert"):
+            result = upsert_messages([to_record(channel_id, m, pl) for m, pl in zip(messages, links)])
+        for kind, n in result.items():
+            counts[kind] += n
+            INGESTED.inc(n, kind=kind)
+
+    cursor = None
+    while True:
+        TIER3.acquire()
+        kwargs = {"channel": channel_id, "cursor": cursor, "limit": 200}
+        if oldest:
+            kwargs["oldest"] = oldest
+        with metrics.stage("slack_history"):
+            resp = web.conversations_history(**kwargs)
+        page = resp.get("messages", [])
+        new = [m for m in page if is_new(m["ts"])]
+        # 返信があり、前回以降に新着のあるスレッドだけ取りに行く
+        threads = [m["ts"] for m in page
+                   if m.get("reply_count") and is_new(m.get("latest_reply") or m["ts"])]
+        reply_oldest = last_ts if last_ts else None
+        with metrics.stage("slack_replies"):
+            replies = [r for rs in thread_pool.map(lambda t: fetch_replies(web, channel_id, t, reply_oldest), threads)
+                       for r in rs if is_new(r["ts"])]
+        write(new + replies)
+        counts["messages"] += len(new)
+        counts["replies"] += len(replies)
+        counts["threads"] += len(threads)
+        # high-water mark は履歴のスナップショットだけから進める。返信は履歴より後に取得するので、
+        # その ts を使うと取得の合間に投稿されたトップレベルのメッセージを次回取りこぼす
+        for m in new:
+            if high_water is None or float(m["ts"]) > float(high_water):
+                high_water = m["ts"]
         cursor = resp.get("response_metadata", {}).get("next_cursor")
         if not cursor:
             break
-    print("Full sync done.")
+    # 履歴は新しい順に返るので、全ページ取り終えてから high-water mark を進める
+    if high_water and high_water != last_ts:
+        set_sync_state(channel_id, high_water)
+    return {"channel_id": channel_id, **counts}
+
+def run_sync(channels: List[str] = CHANNELS, web: WebClient = client, full: bool = False) -> Dict[str, Any]:
+    """
+    複数チャンネルを並列に同期する。Slack のレート制限は TIER3/TIER4 で全体共有。
+    段階別の所要時間（全チャンネルの合計）は終了時に 1 行の JSON でログに出る。
+    """
+    init_db()
+    with metrics.request("full_sync" if full else "incremental_sync"):
+        return _run_sync(channels, web, full)
+
+def _run_sync(channels: List[str], web: WebClient, full: bool) -> Dict[str, Any]:
+    started = time.perf_counter()
+    link_pool = ThreadPoolExecutor(max_workers=PERMALINK_CONCURRENCY) if PERMALINK_MODE != "local" else None
+    with ThreadPoolExecutor(max_workers=THREAD_CONCURRENCY) as thread_pool, \
+         ThreadPoolExecutor(max_workers=CHANNEL_CONCURRENCY) as channel_pool:
+        try:
+            # 各チャンネルの計時を同じリクエストに記録するため context ごと渡す
+            futures = [channel_pool.submit(contextvars.copy_context().run,
+                                           sync_channel, ch, web, full, link_pool, thread_pool)
+                       for ch in channels]
+            results = [f.result() for f in futures]
+        finally:
+            if link_pool is not None:
+                link_pool.shutdown()
+    elapsed = time.perf_counter() - started
+    total = sum(r["messages"] + r["replies"] for r in results)
+    rate = total / elapsed if elapsed > 0 else 0.0
+    mode = "Full" if full else "Incremental"
+    print(f"{mode} sync done. {total} messages in {elapsed:.2f}s ({rate:.1f} msg/s)")
+    for r in results:
+        print(f"  {r['channel_id']}: messages={r['messages']} replies={r['replies']} threads={r['threads']}"
+              f" new={r['new']} changed={r['changed']} unchanged={r['unchanged']}")
+    # 同期中に OpenSearch へ反映できなかった分を再送しておく
+    with metrics.stage("outbox_drain"):
+        ob = drain_outbox()
+    if ob["replayed"] or ob["depth"]:
+        print(f"  outbox: replayed={ob['replayed']} pending={ob['depth']} lag={ob['lag_sec']:.1f}s")
+    written = sum(r["new"] + r["changed"] for r in results)
+    metrics.annotate(messages=total, written=written)
+    return {"messages": total, "written": written, "seconds": elapsed, "msgs_per_sec": rate, "channels": results}
+
+def run_full_sync(channel_id: str = ALLOWED, web: WebClient = client) -> Dict[str, Any]:
+    """1 チャンネルを全件再取得する（high-water mark を無視）。"""
+    return run_sync([channel_id], web, full=True)
 
 if __name__ == "__main__":
-    run_full_sync()
\ No newline at end of file
+    ap = argparse.ArgumentParser(description="Slack → SQLite / OpenSearch sync")
+    ap.add_argument("--full", action="store_true", help="high-water mark を無視して全件再取得する")
+    ap.add_argument("--channels", help="カンマ区切りのチャンネルID（既定: INGEST_CHANNEL_IDS）")
+    ap.add_argument("--rebuild-vectors", action="store_true", help="messages からベクトル索引を作り直す")
+    args = ap.parse_args()
+    metrics.configure_logging()
+    if args.rebuild_vectors:
+        if not DENSE:
+            raise SystemExit("RAG_DENSE=0 ではベクトル索引を使わない（作り直すなら RAG_DENSE=1 で実行する）")
+        init_db()
+        print(f"Rebuilt vector index: {dense.rebuild()} messages")
+        raise SystemExit(0)
+    chans = [c.strip() for c in args.channels.split(",")] if args.channels else CHANNELS
+    run_sync(chans, full=args.full)
@@ -1,50 +1,222 @@
-import os, textwrap
-from typing import List, Dict, Optional
-from tenacity import retry, stop_after_attempt, wait_exponential
+import os, time, random, logging, textwrap, threading
+from typing import List, Dict, Optional, Iterator, Callable, Any, Mapping
+import metrics
+from utils.ratelimit import TokenBucket, ConcurrencyGate
+from llm.providers import PROVIDER_CLASSES, DEFAULT_MODELS, classify, error_headers, retry_after, parse_duration
+
+log = logging.getLogger(__name__)
 
 _PROVIDER = os.getenv("RAG_LLM_PROVIDER", "openai").lower()
 _MODEL = os.getenv("RAG_LLM_MODEL")  # 任意
+# 主プロバイダが混雑（レート制限・同時実行数の上限）しているときに回す先（任意）
+_FALLBACK = (os.getenv("RAG_LLM_FALLBACK_PROVIDER") or "").lower() or None
+_FALLBACK_MODEL = os.getenv("RAG_LLM_FALLBACK_MODEL")
+
+# 知らないプロバイダ名は従来どおり openai として扱い、フォールバックは使わない（起動時に 1 回だけ警告）
+if _PROVIDER not in PROVIDER_CLASSES:
+    log.warning("unknown RAG_LLM_PROVIDER=%r (expected one of %s); using openai",
+                _PROVIDER, ", ".join(PROVIDER_CLASSES))
+    _PROVIDER = "openai"
+if _FALLBACK is not None and _FALLBACK not in PROVIDER_CLASSES:
+    log.warning("unknown RAG_LLM_FALLBACK_PROVIDER=%r (expected one of %s); fallback disabled",
+                _FALLBACK, ", ".join(PROVIDER_CLASSES))
+    _FALLBACK = None
+
+# プロバイダごとのリクエスト数/分・バースト・同時実行数（全スレッドで共有）
+RPM = float(os.getenv("RAG_LLM_RPM", "500"))
+BURST = float(os.getenv("RAG_LLM_BURST", "20"))
+MAX_CONCURRENCY = int(os.getenv("RAG_LLM_MAX_CONCURRENCY", "8"))
+# 1 回の生成（待ち・再試行込み）の締め切りと、フォールバックへ切り替えるまでの待ち
+DEADLINE_SEC = float(os.getenv("RAG_LLM_DEADLINE_SEC", "60"))
+QUEUE_TIMEOUT_SEC = float(os.getenv("RAG_LLM_QUEUE_TIMEOUT_SEC", "5"))
+MAX_ATTEMPTS = int(os.getenv("RAG_LLM_MAX_ATTEMPTS", "3"))
 
 def _default_model() -> str:
-    if _PROVIDER == "groq":
-        return _MODEL or "llama-3.1-70b-versatile"
-    return _MODEL or "gpt-5"
+    return _MODEL or DEFAULT_MODELS.get(_PROVIDER, DEFAULT_MODELS["openai"])
+
+def model_id() -> str:
+    """キャッシュキー等に使う "provider:model"。"""
+    return f"{_PROVIDER}:{_default_model()}"
+
+LLM_RETRIES = metrics.counter("slackrag_llm_retries_total", "LLM request retries by operation and provider")
+LLM_ERRORS = metrics.counter("slackrag_llm_errors_total", "LLM requests that failed after all retries")
+LLM_RATE_LIMITED = metrics.counter("slackrag_llm_rate_limited_total", "429 responses from LLM providers")
+LLM_FALLBACKS = metrics.counter("slackrag_llm_fallbacks_total", "Requests moved to the fallback provider")
+PROMPT_CHARS = metrics.histogram("slackrag_llm_prompt_chars", "System + user prompt size in characters",
+                                 (500, 1000, 2000, 4000, 8000, 16000, 32000, 64000))
+
+
+class LLMSaturated(RuntimeError):
+    """レート制限・同時実行数の上限で、締め切りまでに呼び出せなかった。"""
+
+
+class LLMDeadlineExceeded(TimeoutError):
+    """再試行を含めて DEADLINE_SEC を使い切った。"""
+
+
+class _Lane:
+    """1 プロバイダ分のクライアント・リミッタ・同時実行ゲート。プロセス内で使い回す。"""
+
+    def __init__(self, provider):
+        self.provider = provider
+        self.name = provider.name
+        self.limiter = TokenBucket(RPM / 60, burst=BURST)
+        self.gate = ConcurrencyGate(MAX_CONCURRENCY)
+
+    def on_headers(self, headers: Mapping[str, str]):
+        """x-ratelimit-* を見て、相手の残り枠に合わせる（0 ならリセットまで止める）。"""
+        remaining = headers.get("x-ratelimit-remaining-requests")
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+        except ValueError:
+            return
+        if remaining <= 0:
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests"))
+            if reset:
+                self.limiter.pause(reset)
+        else:
+            self.limiter.clamp(remaining)
+
+
+_LANES: Dict[str, _Lane] = {}
+_LANES_LOCK = threading.Lock()
+
+def _lane(name: str, model: str | None) -> _Lane:
+    with _LANES_LOCK:
+        lane = _LANES.get(name)
+        if lane is None:
+            cls = PROVIDER_CLASSES[name]
+            lane = _LANES[name] = _Lane(cls(model or DEFAULT_MODELS[name], timeout=DEADLINE_SEC))
+        return lane
+
+def _lanes() -> List[_Lane]:
+    lanes = [_lane(_PROVIDER, _MODEL)]
+    if _FALLBACK and _FALLBACK != _PROVIDER:
+        lanes.append(_lane(_FALLBACK, _FALLBACK_MODEL))
+    return lanes
+
+def set_provider(provider, fallback=None):
+    """
+    プロバイダを差し替える（FakeProvider を使った試験・ベンチ用）。
+    モデルも差し替えたプロバイダのものにする（model_id() が回答キャッシュのキーに入るため）。
+    """
+    global _PROVIDER, _MODEL, _FALLBACK, _FALLBACK_MODEL
+    with _LANES_LOCK:
+        _LANES.clear()
+        _PROVIDER = provider.name
+        _MODEL = getattr(provider, "model", None) or DEFAULT_MODELS.get(provider.name)
+        _LANES[provider.name] = _Lane(provider)
+        _FALLBACK = fallback.name if fallback is not None else None
+        _FALLBACK_MODEL = getattr(fallback, "model", None) if fallback is not None else None
+        if fallback is not None:
+            _LANES[fallback.name] = _Lane(fallback)
+
+def lane_stats() -> Dict[tuple, float]:
+    out = {}
+    for lane in list(_LANES.values()):
+        out[(("provider", lane.name), ("state", "in_flight"))] = lane.gate.in_use
+        out[(("provider", lane.name), ("state", "waiting"))] = lane.gate.waiting
+    return out
+
+metrics.add_gauge("slackrag_llm_requests", "LLM requests in flight / waiting for a slot", lane_stats)
+
+
+def _acquire(lane: _Lane, deadline: float, wait: float) -> None:
+    """リミッタとゲートを wait 秒（締め切りまで）以内に取る。取れなければ LLMSaturated。"""
+    with metrics.stage("llm_queue"):
+        budget = min(wait, deadline - time.monotonic())
+        if budget <= 0 or not lane.limiter.acquire(timeout=budget):
+            raise LLMSaturated(f"{lane.name}: rate limit (ready in {lane.limiter.ready_in():.1f}s)")
+        if not lane.gate.acquire(timeout=max(0.0, min(wait, deadline - time.monotonic()))):
+            raise LLMSaturated(f"{lane.name}: {lane.gate.limit} requests already in flight")
+
+def _call_lane(lane: _Lane, op: str, call: Callable[[_Lane, float], Any], deadline: float, wait: float,
+               has_fallback: bool) -> Any:
+    """
+    1 プロバイダでの呼び出し（再試行込み）。成功時はゲートを保持したまま返すので、
+    呼び出し側で lane.gate.release() すること。
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        _acquire(lane, deadline, wait)
+        try:
+            return call(lane, max(0.1, deadline - time.monotonic()))
+        except Exception as e:
+            lane.gate.release()
+            retryable, status = classify(e)
+            delay = retry_after(error_headers(e))
+            if status == 429:
+                LLM_RATE_LIMITED.inc(provider=lane.name)
+                # 同じプロバイダを使う他のリクエストもまとめて待たせる
+                lane.limiter.pause(delay if delay is not None else 1.0)
+                if has_fallback:
+                    raise LLMSaturated(f"{lane.name}: 429 (retry after {delay}s)") from e
+            if not retryable or attempt == MAX_ATTEMPTS:
+                raise
+            if delay is None:
+                delay = min(8.0, 0.7 * 2 ** (attempt - 1)) * (0.5 + random.random() / 2)
+            if time.monotonic() + delay >= deadline:
+                raise LLMDeadlineExceeded(f"{lane.name}: no time left to retry after {e!r}") from e
+            LLM_RETRIES.inc(op=op, provider=lane.name)
+            metrics.annotate(llm_retries=attempt)
+            log.warning("LLM %s via %s failed (attempt %d/%d, status=%s); retrying in %.1fs",
+                        op, lane.name, attempt, MAX_ATTEMPTS, status, delay)
+            # 429 ならリミッタ側の pause で待つので、ここでは寝ない
+            if status != 429:
+                time.sleep(delay)
+
+def _call(op: str, call: Callable[[_Lane, float], Any]):
+    """主プロバイダ → （混雑時）フォールバックの順に呼ぶ。戻り値は (lane, 結果)。ゲートは保持したまま。"""
+    deadline = time.monotonic() + DEADLINE_SEC
+    lanes = _lanes()
+    for i, lane in enumerate(lanes):
+        has_fallback = i + 1 < len(lanes)
+        wait = QUEUE_TIMEOUT_SEC if has_fallback else DEADLINE_SEC
+        try:
+            result = _call_lane(lane, op, call, deadline, wait, has_fallback)
+        except LLMSaturated as e:
+            if not has_fallback:
+                raise
+            LLM_FALLBACKS.inc(**{"from": lane.name, "to": lanes[i + 1].name})
+            log.warning("LLM %s: %s; falling back to %s", op, e, lanes[i + 1].name)
+            continue
+        metrics.annotate(llm_provider=lane.name)
+        return lane, result
 
-@retry(stop=stop_after_attempt(3), wait=wait_exponential(multiplier=0.7, max=8))
 def generate_llm_answer(system_prompt: str, user_prompt: str) -> str:
     """
     Provider-agnostic text generation.
+    共有のリミッタ・同時実行ゲートを通し、429 は Retry-After に従って再試行する。
+    所要時間は待ち・再試行込みで stage "llm_generate" に記録する。
+    """
+    PROMPT_CHARS.observe(len(system_prompt) + len(user_prompt), provider=_PROVIDER)
+    try:
+        with metrics.stage("llm_generate"):
+            lane, answer = _call("generate", lambda lane, timeout: lane.provider.complete(
+                system_prompt, user_prompt, timeout, lane.on_headers))
+            lane.gate.release()
+            return answer
+    except Exception:
+        LLM_ERRORS.inc(op="generate", provider=_PROVIDER)
+        raise
+
+def stream_llm_answer(system_prompt: str, user_prompt: str) -> Iterator[str]:
+    """
+    Provider-agnostic streaming generation. テキストの差分を順に yield する。
+    接続（待ち・再試行込み）は stage "llm_open_stream"、受信し終えるまでは "llm_stream" に記録する。
+    トークンを返し始めた後はやり直さない。ゲートは受信し終えるまで保持する。
     """
-    if _PROVIDER == "groq":
-        from groq import Groq
-        client = Groq(api_key=os.environ["GROQ_API_KEY"])
-        resp = client.chat.completions.create(
-            model=_default_model(),
-            messages=[
-                {"role":"system","content":system_prompt},
-                {"role":"user","content":user_prompt},
-            ],
-            temperature=0.2,
-        )
-        return resp.choices[0].message.content.strip()
-
-    else:
-        # OpenAI Responses API
-        from openai import OpenAI
-        client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        resp = client.responses.create(
-            model=_default_model(),
-            input=[
-                {"role":"system","content":system_prompt},
-                {"role":"user","content":user_prompt},
-            ],
-            temperature=0.2,
-        )
-        return resp.output_text.strip()
-
-def trim_context(snippets: str, max_chars: int = 8000) -> str:
-    if len(snippets) <= max_chars:
-        return snippets
-    head = int(max_chars * 0.7)
-    tail = max_chars - head
-    return f"{snippets[:head]}\n...\n{snippets[-tail:]}"
\ No newline at end of file
+    PROMPT_CHARS.observe(len(system_prompt) + len(user_prompt), provider=_PROVIDER)
+    try:
+        with metrics.stage("llm_open_stream"):
+            lane, stream = _call("stream", lambda lane, timeout: lane.provider.open_stream(
+                system_prompt, user_prompt, timeout, lane.on_headers))
+    except Exception:
+        LLM_ERRORS.inc(op="stream", provider=_PROVIDER)
+        raise
+    try:
+        with metrics.stage("llm_stream"):
+            yield from stream
+    finally:
+        lane.gate.release()
@@ -0,0 +1,219 @@
+"""
+LLM プロバイダのクライアント（プロセス内で 1 つずつ作って使い回す）。
+
+各プロバイダは complete() / open_stream() を持ち、SDK 側のリトライは切ってある
+（再試行・レート制御・フォールバックは llm.client で行う）。
+成功時のレスポンスヘッダ（x-ratelimit-*）は on_headers に渡して共有のリミッタへ反映する。
+"""
+import os, re, time, random, threading
+from typing import Callable, Dict, Iterator, Mapping
+from utils.ratelimit import TokenBucket
+
+DEFAULT_MODELS = {
+    "openai": "gpt-5",
+    "groq": "llama-3.1-70b-versatile",
+    "fake": "fake-echo",
+}
+
+HeadersHook = Callable[[Mapping[str, str]], None]
+
+
+class ProviderError(Exception):
+    """プロバイダ呼び出しの失敗。status_code / headers は SDK の例外と同じ名前で持つ。"""
+
+    def __init__(self, message: str, status_code: int | None = None, headers: Mapping[str, str] | None = None):
+        super().__init__(message)
+        self.status_code = status_code
+        self.headers = headers or {}
+
+
+_DURATION = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_UNIT = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0}
+
+
+def parse_duration(value: str | None) -> float | None:
+    """"1.5" / "20ms" / "6m0s" のような値を秒に。解釈できなければ None。"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    parts = _DURATION.findall(value)
+    if not parts:
+        return None
+    return sum(float(n) * _UNIT[u] for n, u in parts)
+
+
+def error_headers(exc: BaseException) -> Mapping[str, str]:
+    headers = getattr(exc, "headers", None)
+    if headers is None:
+        headers = getattr(getattr(exc, "response", None), "headers", None)
+    return headers or {}
+
+
+def retry_after(headers: Mapping[str, str]) -> float | None:
+    """Retry-After（秒 / ms）を優先し、無ければリクエスト枠のリセットまでの秒数。"""
+    ms = headers.get("retry-after-ms")
+    if ms is not None:
+        try:
+            return float(ms) / 1000
+        except ValueError:
+            pass
+    for name in ("retry-after", "x-ratelimit-reset-requests"):
+        sec = parse_duration(headers.get(name))
+        if sec is not None:
+            return sec
+    return None
+
+
+def classify(exc: BaseException) -> tuple[bool, int | None]:
+    """(再試行してよいか, HTTP ステータス)。429 / 408 / 409 / 5xx と接続・タイムアウト系を再試行する。"""
+    status = getattr(exc, "status_code", None)
+    if status is not None:
+        return status in (408, 409, 429) or status >= 500, status
+    name = type(exc).__name__
+    if isinstance(exc, (TimeoutError, ConnectionError)) or name in ("APIConnectionError", "APITimeoutError"):
+        return True, None
+    return False, None
+
+
+def _messages(system_prompt: str, user_prompt: str):
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+
+
+class OpenAIProvider:
+    """OpenAI Responses API。"""
+    name = "openai"
+
+    def __init__(self, model: str, timeout: float):
+        from openai import OpenAI
+        self.model = model
+        self.client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), max_retries=0, timeout=timeout)
+
+    def complete(self, system_prompt: str, user_prompt: str, timeout: float, on_headers: HeadersHook) -> str:
+        raw = self.client.responses.with_raw_response.create(
+            model=self.model, input=_messages(system_prompt, user_prompt), temperature=0.2, timeout=timeout,
+        )
+        on_headers(raw.headers)
+        return raw.parse().output_text.strip()
+
+    def open_stream(self, system_prompt: str, user_prompt: str, timeout: float,
+                    on_headers: HeadersHook) -> Iterator[str]:
+        raw = self.client.responses.with_raw_response.create(
+            model=self.model, input=_messages(system_prompt, user_prompt), temperature=0.2, stream=True,
+            timeout=timeout,
+        )
+        on_headers(raw.headers)
+        return self._deltas(raw.parse())
+
+    @staticmethod
+    def _deltas(stream) -> Iterator[str]:
+        for event in stream:
+            if getattr(event, "type", "") == "response.output_text.delta" and event.delta:
+                yield event.delta
+
+
+class GroqProvider:
+    """Groq Chat Completions API。"""
+    name = "groq"
+
+    def __init__(self, model: str, timeout: float):
+        from groq import Groq
+        self.model = model
+        self.client = Groq(api_key=os.environ["GROQ_API_KEY"], max_retries=0, timeout=timeout)
+
+    def complete(self, system_prompt: str, user_prompt: str, timeout: float, on_headers: HeadersHook) -> str:
+        raw = self.client.chat.completions.with_raw_response.create(
+            model=self.model, messages=_messages(system_prompt, user_prompt), temperature=0.2, timeout=timeout,
+        )
+        on_headers(raw.headers)
+        return raw.parse().choices[0].message.content.strip()
+
+    def open_stream(self, system_prompt: str, user_prompt: str, timeout: float,
+                    on_headers: HeadersHook) -> Iterator[str]:
+        raw = self.client.chat.completions.with_raw_response.create(
+            model=self.model, messages=_messages(system_prompt, user_prompt), temperature=0.2, stream=True,
+            timeout=timeout,
+        )
+        on_headers(raw.headers)
+        return self._deltas(raw.parse())
+
+    @staticmethod
+    def _deltas(stream) -> Iterator[str]:
+        for chunk in stream:
+            if not chunk.choices:
+                continue
+            delta = chunk.choices[0].delta.content
+            if delta:
+                yield delta
+
+
+class FakeProvider:
+    """
+    ネットワークを使わないローカルのプロバイダ（ベンチ・負荷試験用）。
+
+    - 最初のトークンまで ttft_ms、以降 tokens_per_sec で answer_tokens 個の差分を返す
+    - rpm（10 秒分までのバースト可）を超える呼び出しには本物と同じく 429 + Retry-After を返す（0 で無制限）
+    - fail_rate の確率で 503 を返す
+    """
+    name = "fake"
+
+    def __init__(self, model: str = DEFAULT_MODELS["fake"], timeout: float = 60.0,
+                 ttft_ms: float | None = None, tokens_per_sec: float | None = None, answer_tokens: int | None = None,
+                 rpm: float | None = None, fail_rate: float | None = None, name: str | None = None):
+        env = lambda key, default: float(os.getenv(f"RAG_FAKE_LLM_{key}", default))
+        self.model = model
+        if name:
+            self.name = name
+        self.ttft = (ttft_ms if ttft_ms is not None else env("TTFT_MS", "300")) / 1000
+        tps = tokens_per_sec if tokens_per_sec is not None else env("TOKENS_PER_SEC", "80")
+        self.interval = 1.0 / tps if tps > 0 else 0.0
+        self.answer_tokens = int(answer_tokens if answer_tokens is not None else env("ANSWER_TOKENS", "60"))
+        self.rpm = rpm if rpm is not None else env("RPM", "0")
+        self.fail_rate = fail_rate if fail_rate is not None else env("FAIL_RATE", "0")
+        self._bucket = TokenBucket(self.rpm / 60, burst=max(1.0, self.rpm / 6)) if self.rpm else None
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.rejected = 0
+
+    def _admit(self) -> Dict[str, str]:
+        with self._lock:
+            self.calls += 1
+        if self.fail_rate and random.random() < self.fail_rate:
+            raise ProviderError("fake provider unavailable", status_code=503)
+        if self._bucket is None:
+            return {}
+        if not self._bucket.acquire(timeout=0):
+            with self._lock:
+                self.rejected += 1
+            raise ProviderError("rate limit exceeded", status_code=429,
+                                headers={"retry-after": f"{self._bucket.ready_in():.3f}"})
+        return {"x-ratelimit-remaining-requests": str(int(self._bucket.available())),
+                "x-ratelimit-reset-requests": f"{60 / self.rpm:.3f}s"}
+
+    def _tokens(self, user_prompt: str) -> Iterator[str]:
+        links = re.findall(r"<(https?://[^>]+)>", user_prompt)[:2]
+        for i in range(self.answer_tokens):
+            if i and self.interval:
+                time.sleep(self.interval)
+            yield f"tok{i} "
+        yield "\nSources: " + " ".join(links)
+
+    def complete(self, system_prompt: str, user_prompt: str, timeout: float, on_headers: HeadersHook) -> str:
+        on_headers(self._admit())
+        time.sleep(self.ttft)
+        return "".join(self._tokens(user_prompt)).strip()
+
+    def open_stream(self, system_prompt: str, user_prompt: str, timeout: float,
+                    on_headers: HeadersHook) -> Iterator[str]:
+        on_headers(self._admit())
+        time.sleep(self.ttft)
+        return self._tokens(user_prompt)
+
+
+PROVIDER_CLASSES = {"openai": OpenAIProvider, "groq": GroqProvider, "fake": FakeProvider}
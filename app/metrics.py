@@ -0,0 +1,272 @@
+"""
+軽量なメトリクスとリクエスト単位の計時（外部依存なし）。
+
+- カウンタ / ヒストグラムをプロセス内に持ち、Prometheus のテキスト形式で出す
+- stage("opensearch_search") で囲んだ区間は stage_seconds{stage=...} に記録し、
+  実行中のリクエスト（request("dm")）があればその内訳にも足す
+- request() ごとに相関 ID を振り、終了時に段階別の所要時間を 1 行の JSON でログに出す
+  （INFO。エントリポイントで configure_logging() を呼ぶ。レベルは LOG_LEVEL）
+- METRICS_PORT（既定 9464, 0 で無効）の /metrics で公開する（既定は 127.0.0.1 のみ）
+
+相関 ID は contextvars で持つので、スレッドプールへ渡す処理は
+contextvars.copy_context().run で包むと同じリクエストに記録される。
+"""
+import os, json, time, uuid, bisect, logging, threading, contextvars
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterator, List, Tuple
+
+log = logging.getLogger(__name__)
+
+METRICS_ADDR = os.getenv("METRICS_ADDR", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9464"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+SIZE_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 20000, 50000)
+
+_LabelKey = Tuple[Tuple[str, str], ...]
+
+
+def _key(labels: Dict[str, object]) -> _LabelKey:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _fmt_labels(key: _LabelKey) -> str:
+    if not key:
+        return ""
+    return "{" + ",".join(f'{k}="{v}"' for k, v in key) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self._values: Dict[_LabelKey, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, value: float = 1, **labels):
+        key = _key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def value(self, **labels) -> float:
+        return self._values.get(_key(labels), 0)
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        with self._lock:
+            items = list(self._values.items())
+        for key, v in items:
+            yield f"{self.name}{_fmt_labels(key)} {v:g}"
+
+
+class Histogram:
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        # label → (バケットごとの件数, 合計, 件数)
+        self._values: Dict[_LabelKey, List] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = _key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            v = self._values.get(key)
+            if v is None:
+                v = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if i < len(self.buckets):
+                v[0][i] += 1
+            v[1] += value
+            v[2] += 1
+
+    def expose(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            items = [(key, list(v[0]), v[1], v[2]) for key, v in self._values.items()]
+        for key, counts, total, n in items:
+            acc = 0
+            for le, c in zip(self.buckets, counts):
+                acc += c
+                yield f"{self.name}_bucket{_fmt_labels(key + (('le', f'{le:g}'),))} {acc}"
+            yield f"{self.name}_bucket{_fmt_labels(key + (('le', '+Inf'),))} {n}"
+            yield f"{self.name}_sum{_fmt_labels(key)} {total:g}"
+            yield f"{self.name}_count{_fmt_labels(key)} {n}"
+
+
+_REGISTRY: Dict[str, object] = {}
+_GAUGES: List[Tuple[str, str, Callable[[], object]]] = []
+_REG_LOCK = threading.Lock()
+
+
+def counter(name: str, help: str) -> Counter:
+    with _REG_LOCK:
+        if name not in _REGISTRY:
+            _REGISTRY[name] = Counter(name, help)
+        return _REGISTRY[name]
+
+
+def histogram(name: str, help: str, buckets=LATENCY_BUCKETS) -> Histogram:
+    with _REG_LOCK:
+        if name not in _REGISTRY:
+            _REGISTRY[name] = Histogram(name, help, buckets)
+        return _REGISTRY[name]
+
+
+def add_gauge(name: str, help: str, fn: Callable[[], object]):
+    """
+    スクレイプ時に fn() を呼んで値を出すゲージ。
+    fn は数値か、{ラベル値: 数値} / {(("label", "value"), ...): 数値} の dict を返す。
+    """
+    with _REG_LOCK:
+        _GAUGES[:] = [g for g in _GAUGES if g[0] != name]
+        _GAUGES.append((name, help, fn))
+
+
+STAGE_SECONDS = histogram("slackrag_stage_seconds", "Time spent in each stage of request handling / ingest")
+REQUEST_SECONDS = histogram("slackrag_request_seconds", "End-to-end handler latency by request kind")
+REQUESTS = counter("slackrag_requests_total", "Handled requests by kind and outcome")
+
+# ---------- リクエスト単位の計時 ----------
+_CURRENT: contextvars.ContextVar["Trace | None"] = contextvars.ContextVar("slackrag_trace", default=None)
+
+
+class Trace:
+    def __init__(self, kind: str, request_id: str | None = None):
+        self.kind = kind
+        self.id = request_id or uuid.uuid4().hex[:12]
+        self.started = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.fields: Dict[str, object] = {}
+        self._lock = threading.Lock()
+
+    def add(self, stage: str, seconds: float):
+        with self._lock:
+            self.stages[stage] = self.stages.get(stage, 0.0) + seconds
+
+
+def current() -> Trace | None:
+    return _CURRENT.get()
+
+
+def request_id() -> str | None:
+    t = _CURRENT.get()
+    return t.id if t else None
+
+
+def annotate(**fields):
+    """実行中のリクエストの終了ログに載せる値（ヒット数など）を足す。"""
+    t = _CURRENT.get()
+    if t is not None:
+        t.fields.update(fields)
+
+
+@contextmanager
+def request(kind: str, request_id: str | None = None) -> Iterator[Trace]:
+    """
+    ハンドラ 1 回分を囲む。終了時に request_seconds を記録し、
+    {"event": "request", "request_id": ..., "stages_ms": {...}} を INFO で出す。
+    """
+    trace = Trace(kind, request_id)
+    token = _CURRENT.set(trace)
+    outcome = "ok"
+    try:
+        yield trace
+    except BaseException:
+        outcome = "error"
+        raise
+    finally:
+        _CURRENT.reset(token)
+        elapsed = time.perf_counter() - trace.started
+        REQUEST_SECONDS.observe(elapsed, kind=kind)
+        REQUESTS.inc(kind=kind, outcome=outcome)
+        log.info(json.dumps({
+            "event": "request", "kind": kind, "request_id": trace.id, "outcome": outcome,
+            "total_ms": round(elapsed * 1000, 1),
+            "stages_ms": {k: round(v * 1000, 1) for k, v in trace.stages.items()},
+            **trace.fields,
+        }, ensure_ascii=False, default=str))
+
+
+@contextmanager
+def stage(name: str) -> Iterator[None]:
+    """区間の所要時間を stage_seconds{stage=name} と実行中リクエストの内訳に記録する。"""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - t0
+        STAGE_SECONDS.observe(elapsed, stage=name)
+        t = _CURRENT.get()
+        if t is not None:
+            t.add(name, elapsed)
+
+
+def configure_logging(level: str | None = None):
+    """エントリポイントで 1 回呼ぶ。root ロガーを LOG_LEVEL（既定 INFO）で標準エラーへ出す。"""
+    logging.basicConfig(level=(level or os.getenv("LOG_LEVEL", "INFO")).upper(),
+                        format="%(asctime)s %(levelname)s %(name)s %(message)s")
+
+
+# ---------- 公開 ----------
+def render() -> str:
+    """Prometheus のテキスト形式（version 0.0.4）。"""
+    lines: List[str] = []
+    with _REG_LOCK:
+        metrics = list(_REGISTRY.values())
+        gauges = list(_GAUGES)
+    for m in metrics:
+        lines.extend(m.expose())
+    for name, help, fn in gauges:
+        try:
+            value = fn()
+        except Exception as e:
+            log.warning("gauge %s failed: %s", name, e)
+            continue
+        lines.append(f"# HELP {name} {help}")
+        lines.append(f"# TYPE {name} gauge")
+        if isinstance(value, dict):
+            for labels, v in value.items():
+                key = labels if isinstance(labels, tuple) else (("name", str(labels)),)
+                lines.append(f"{name}{_fmt_labels(key)} {float(v):g}")
+        else:
+            lines.append(f"{name} {float(value):g}")
+    return "\n".join(lines) + "\n"
+
+
+class _Handler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/metrics", "/"):
+            self.send_error(404)
+            return
+        body = render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+_SERVER: ThreadingHTTPServer | None = None
+
+
+def start_http_server(port: int = METRICS_PORT, addr: str = METRICS_ADDR) -> ThreadingHTTPServer | None:
+    """/metrics をバックグラウンドスレッドで公開する。port=0 なら何もしない。"""
+    global _SERVER
+    if port <= 0 or _SERVER is not None:
+        return _SERVER
+    try:
+        _SERVER = ThreadingHTTPServer((addr, port), _Handler)
+    except OSError as e:
+        log.warning("metrics endpoint disabled (%s:%d): %s", addr, port, e)
+        return None
+    _SERVER.daemon_threads = True
+    threading.Thread(target=_SERVER.serve_forever, name="metrics-http", daemon=True).start()
+    log.info("metrics endpoint on http://%s:%d/metrics", addr, port)
+    return _SERVER
@@ -0,0 +1,58 @@
+import os, logging, threading
+from store import OPENSEARCH_ENABLED, replay_outbox, outbox_stats
+
+log = logging.getLogger(__name__)
+
+
+class OutboxReplayer:
+    """
+    os_outbox をバックグラウンドで再送し続けるスレッド。
+    溜まっている間は間を空けずに回し、空になったら OUTBOX_INTERVAL_SEC 待つ。
+    """
+
+    def __init__(self, interval_sec: float = float(os.getenv("OUTBOX_INTERVAL_SEC", "5")),
+                 batch_size: int = int(os.getenv("OUTBOX_BATCH", "500"))):
+        self.interval = interval_sec
+        self.batch_size = batch_size
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="outbox-replayer", daemon=True)
+        self.replayed = 0
+        self.failed = 0
+
+    def start(self):
+        # RAG_SEARCH_BACKEND=fts5 では outbox に積まれないので回さない
+        if not OPENSEARCH_ENABLED:
+            log.info("OpenSearch disabled (RAG_SEARCH_BACKEND=fts5); outbox replayer not started")
+            return
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout)
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                res = replay_outbox(limit=self.batch_size)
+            except Exception:
+                log.exception("outbox replay crashed")
+                res = {"replayed": 0, "failed": 0}
+            self.replayed += res["replayed"]
+            self.failed += res["failed"]
+            if res["replayed"] < self.batch_size:
+                self._stop.wait(self.interval)
+
+    def stats(self):
+        return {**outbox_stats(), "replayed": self.replayed, "failed": self.failed}
+
+
+def drain_outbox(batch_size: int = 500) -> dict:
+    """再送可能なものが無くなるまで同期的に流す（バッチ処理の最後に使う）。"""
+    total = {"replayed": 0, "failed": 0}
+    while True:
+        res = replay_outbox(limit=batch_size)
+        total["replayed"] += res["replayed"]
+        total["failed"] += res["failed"]
+        if res["replayed"] + res["failed"] == 0:
+            return {**total, **outbox_stats()}
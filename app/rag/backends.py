@@ -0,0 +1,100 @@
+import os, time, threading, logging, contextvars
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import List, Dict, Protocol, Optional, Tuple
+from store import search_top_k, search_fts, SearchQueryError, is_request_error
+
+log = logging.getLogger(__name__)
+
+
+Window = Optional[Tuple[Optional[float], Optional[float]]]
+
+
+class SearchBackend(Protocol):
+    """検索バックエンドの共通インターフェース。hits は search_top_k と同じ形の dict。window は (since, until)。"""
+    name: str
+
+    def search(self, query: str, channel_id: str, k: int, window: Window = None) -> List[Dict]: ...
+
+
+class OpenSearchBackend:
+    name = "opensearch"
+
+    def search(self, query: str, channel_id: str, k: int, window: Window = None) -> List[Dict]:
+        return search_top_k(query, channel_id, k=k, window=window)
+
+
+class FTS5Backend:
+    name = "fts5"
+
+    def search(self, query: str, channel_id: str, k: int, window: Window = None) -> List[Dict]:
+        return search_fts(query, channel_id, k=k, window=window)
+
+
+class FailoverBackend:
+    """
+    primary をレイテンシ予算つきで呼び、遅い・落ちている場合は fallback で応答する。
+    タイムアウト・接続エラー・5xx / 429 の後は cooldown 秒間 primary を呼ばない（クラスタ不調時にボットが詰まらないように）。
+    クエリ自体の誤り（4xx。構文エラーなど）はその 1 回だけ fallback で答え、primary は止めない。
+    """
+    name = "failover"
+
+    def __init__(self, primary: SearchBackend, fallback: SearchBackend,
+                 budget_ms: float = 800, cooldown_sec: float = 30, max_workers: int = 8):
+        self.primary = primary
+        self.fallback = fallback
+        self.budget = budget_ms / 1000.0
+        self.cooldown = cooldown_sec
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="search")
+        self._down_until = 0.0
+        self._lock = threading.Lock()
+
+    def _trip(self, reason: str):
+        with self._lock:
+            self._down_until = time.monotonic() + self.cooldown
+        log.warning("search backend %s unavailable (%s); serving from %s for %ss",
+                    self.primary.name, reason, self.fallback.name, self.cooldown)
+
+    def search(self, query: str, channel_id: str, k: int, window: Window = None) -> List[Dict]:
+        if time.monotonic() < self._down_until:
+            return self.fallback.search(query, channel_id, k, window)
+        # 計時（metrics.stage）を呼び出し元のリクエストに記録できるよう context ごと渡す
+        ctx = contextvars.copy_context()
+        fut = self._pool.submit(ctx.run, self.primary.search, query, channel_id, k, window)
+        try:
+            return fut.result(timeout=self.budget)
+        except FutureTimeout:
+            self._trip(f"over {self.budget * 1000:.0f}ms budget")
+        except Exception as e:
+            # opensearchpy の TransportError は status_code に HTTP ステータス（接続エラーは "N/A"）を持つ
+            if isinstance(e, SearchQueryError) or is_request_error(getattr(e, "status_code", None)):
+                log.info("search backend %s rejected the query (%r); serving from %s",
+                         self.primary.name, e, self.fallback.name)
+            else:
+                self._trip(repr(e))
+        return self.fallback.search(query, channel_id, k, window)
+
+
+_BACKEND: SearchBackend | None = None
+
+
+def get_backend() -> SearchBackend:
+    """
+    RAG_SEARCH_BACKEND で選択する。
+    - failover (既定): OpenSearch を優先し、予算超過・障害時は FTS5
+    - opensearch: OpenSearch のみ
+    - fts5: SQLite FTS5 のみ（小規模運用・テスト向け。ネットワーク不要）
+    """
+    global _BACKEND
+    if _BACKEND is None:
+        kind = os.getenv("RAG_SEARCH_BACKEND", "failover").lower()
+        if kind == "opensearch":
+            _BACKEND = OpenSearchBackend()
+        elif kind == "fts5":
+            _BACKEND = FTS5Backend()
+        else:
+            _BACKEND = FailoverBackend(
+                OpenSearchBackend(), FTS5Backend(),
+                budget_ms=float(os.getenv("RAG_SEARCH_BUDGET_MS", "800")),
+                cooldown_sec=float(os.getenv("RAG_SEARCH_COOLDOWN_SEC", "30")),
+            )
+    return _BACKEND
@@ -0,0 +1,144 @@
+import re, time, threading, unicodedata
+from collections import OrderedDict
+from concurrent.futures import Future
+from typing import Any, Dict, Hashable, Tuple
+
+
+def normalize_query(q: str) -> str:
+    """キャッシュキー用の正規化（NFKC・小文字化・空白の圧縮）。"""
+    q = unicodedata.normalize("NFKC", q or "").lower()
+    return re.sub(r"\s+", " ", q).strip()
+
+
+class ChannelLRUCache:
+    """
+    チャンネル単位で無効化できる LRU + TTL キャッシュ。
+
+    - キーは (channel_id, ...) のタプル。channel_id ごとにキーを索引しておき、
+      invalidate_channel で該当チャンネルの項目だけを捨てる。
+    - 検索中に書き込みが入った結果を保存しないよう、generation(channel) を
+      検索前に取得して put に渡す。無効化で世代が進んでいれば put は捨てる。
+    - 検索側（OpenSearch の refresh 間隔）が書き込みを反映するまでの
+      refresh_grace 秒間はそのチャンネルの結果を保存しない。
+    """
+
+    def __init__(self, maxsize: int = 512, ttl_sec: float = 300, refresh_grace_sec: float = 1.0):
+        self.maxsize = maxsize
+        self.ttl = ttl_sec
+        self.refresh_grace = refresh_grace_sec
+        self._data: "OrderedDict[Tuple, Tuple[float, Any]]" = OrderedDict()
+        self._by_channel: Dict[str, set] = {}
+        self._gen: Dict[str, int] = {}
+        self._dirty_until: Dict[str, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def generation(self, channel_id: str) -> int:
+        with self._lock:
+            return self._gen.get(channel_id, 0)
+
+    def get(self, key: Tuple[Hashable, ...]) -> Any | None:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires, value = item
+            if expires < time.monotonic():
+                self._drop(key)
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Tuple[Hashable, ...], value: Any, generation: int):
+        if self.maxsize <= 0:
+            return
+        channel_id = key[0]
+        now = time.monotonic()
+        with self._lock:
+            if self._gen.get(channel_id, 0) != generation:
+                return
+            if now < self._dirty_until.get(channel_id, 0.0):
+                return
+            self._data[key] = (now + self.ttl, value)
+            self._data.move_to_end(key)
+            self._by_channel.setdefault(channel_id, set()).add(key)
+            while len(self._data) > self.maxsize:
+                oldest = next(iter(self._data))
+                self._drop(oldest)
+                self.evictions += 1
+
+    def invalidate_channel(self, channel_id: str, *_):
+        with self._lock:
+            self._gen[channel_id] = self._gen.get(channel_id, 0) + 1
+            self._dirty_until[channel_id] = time.monotonic() + self.refresh_grace
+            for key in self._by_channel.pop(channel_id, set()):
+                self._data.pop(key, None)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self._by_channel.clear()
+
+    def _drop(self, key):
+        self._data.pop(key, None)
+        keys = self._by_channel.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._by_channel[key[0]]
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "maxsize": self.maxsize,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": (self.hits / total) if total else 0.0,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+            }
+
+
+class SingleFlight:
+    """
+    同じキーの処理が実行中なら、新たに実行せずその結果を待つ（in-flight coalescing）。
+    例外も待機中の全員に伝播し、結果は保持しない。
+    """
+
+    def __init__(self):
+        self._inflight: Dict[Hashable, Future] = {}
+        self._lock = threading.Lock()
+        self.coalesced = 0
+
+    def lead(self, key: Hashable) -> Tuple[Future, bool]:
+        """
+        key の Future と、呼び出し側が実行役 (leader) かどうかを返す。
+        leader は必ず finish() で結果を確定させること。
+        """
+        with self._lock:
+            fut = self._inflight.get(key)
+            if fut is not None:
+                self.coalesced += 1
+                return fut, False
+            fut = Future()
+            self._inflight[key] = fut
+            return fut, True
+
+    def finish(self, key: Hashable, result: Any = None, error: BaseException | None = None):
+        with self._lock:
+            fut = self._inflight.pop(key, None)
+        if fut is None:
+            return
+        if error is not None:
+            fut.set_exception(error)
+        else:
+            fut.set_result(result)
@@ -0,0 +1,255 @@
+"""
+ローカル計算の埋め込みとメモリマップしたベクトル索引（GPU・ネットワーク不要）。
+
+- 埋め込み: 英数字の単語・単語内の文字 3-gram・CJK 連続部分の文字 2-gram を
+  特徴ハッシュで DIM 次元に落とし、L2 正規化する。言い換えや JA/EN 混在でも
+  共通の部分文字列があれば近くなる。
+- 索引: float32 の連続行列を DB の隣（既定 data/db.vectors.f32、rebuild ごとに .1, .2, … の世代）に
+  追記していき、np.memmap で読む。message_id → 行番号・ts は SQLite の message_vectors に持つ。
+  編集時は新しい行を追記して対応を差し替え、削除済みは検索時に messages で落とす。
+"""
+import os, re, zlib, threading, unicodedata
+from typing import List, Dict, Any, Tuple
+import numpy as np
+import store
+from store import get_conn, add_upsert_listener
+
+DIM = int(os.getenv("RAG_DENSE_DIM", "256"))
+VECTOR_PATH = os.getenv("RAG_VECTOR_PATH") or os.path.splitext(store.DB_PATH)[0] + ".vectors.f32"
+
+_WORD = re.compile(r"[a-z0-9]+")
+_CJK = re.compile(r"[\u3040-\u30FF\u31F0-\u31FF\u4E00-\u9FFF]+")
+
+
+def _features(text: str) -> List[str]:
+    t = unicodedata.normalize("NFKC", text or "").lower()
+    feats = []
+    for w in _WORD.findall(t):
+        feats.append(w)
+        if len(w) > 3:
+            feats.extend(f"#{w[i:i + 3]}" for i in range(len(w) - 2))
+    for run in _CJK.findall(t):
+        if len(run) == 1:
+            feats.append(run)
+        feats.extend(run[i:i + 2] for i in range(len(run) - 1))
+    return feats
+
+
+def embed_texts(texts: List[str]) -> np.ndarray:
+    """(len(texts), DIM) の float32 行列を返す。各行は L2 正規化済み（空文は 0 ベクトル）。"""
+    out = np.zeros((len(texts), DIM), dtype=np.float32)
+    for i, text in enumerate(texts):
+        feats = _features(text)
+        if not feats:
+            continue
+        h = np.fromiter((zlib.crc32(f.encode("utf-8")) for f in feats), dtype=np.uint32, count=len(feats))
+        idx = (h % DIM).astype(np.intp)
+        sign = np.where((h >> 31) & 1, -1.0, 1.0).astype(np.float32)
+        np.add.at(out[i], idx, sign)
+    # tf を抑える（同じ語の繰り返しで支配されないように）
+    out = np.sign(out) * np.log1p(np.abs(out))
+    norms = np.linalg.norm(out, axis=1, keepdims=True)
+    np.divide(out, norms, out=out, where=norms > 0)
+    return out.astype(np.float32, copy=False)
+
+
+def _generation(conn) -> int:
+    row = conn.execute("SELECT generation FROM vector_index WHERE id = 0").fetchone()
+    return row[0] if row else 0
+
+
+def generation_path(path: str, generation: int) -> str:
+    """世代ごとの行列ファイル。0（rebuild 前）は path そのもの。"""
+    return path if generation == 0 else f"{path}.{generation}"
+
+
+class VectorIndex:
+    def __init__(self, path: str = VECTOR_PATH, dim: int = DIM):
+        self.path = path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self._mm: np.memmap | None = None
+        self._mm_key: Tuple[str, int, int] | None = None
+        # channel_id → (世代, 読み込み済みの最大行, 行番号, message_id, ts)
+        self._channel_rows: Dict[str, Tuple[int, int, np.ndarray, np.ndarray, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    # ---------- 書き込み ----------
+    def add(self, recs: List[Dict[str, Any]]):
+        """レコードを埋め込んで行列の末尾に追記し、message_vectors を更新する。"""
+        if not recs:
+            return
+        vecs = embed_texts([r.get("text_norm") or "" for r in recs])
+        conn = get_conn()
+        with conn:
+            # SQLite の書き込みロックで行番号の払い出しをプロセス間でも直列化する（rebuild の差し替えとも）
+            conn.execute("BEGIN IMMEDIATE")
+            path = generation_path(self.path, _generation(conn))
+            start = os.path.getsize(path) // self.row_bytes if os.path.exists(path) else 0
+            with open(path, "r+b" if os.path.exists(path) else "wb") as f:
+                f.seek(start * self.row_bytes)
+                f.write(vecs.tobytes())
+            conn.executemany("""
+              INSERT INTO message_vectors (message_id, channel_id, row, ts) VALUES (?, ?, ?, ?)
+              ON CONFLICT(message_id) DO UPDATE SET row=excluded.row
+            """, [(r["id"], r["channel_id"], start + i, float(r["ts"])) for i, r in enumerate(recs)])
+
+    # ---------- 読み込み ----------
+    def _matrix(self, generation: int, need_rows: int) -> np.ndarray:
+        """世代の行列。ファイル（rebuild で差し替わる）か大きさが変わっていたら張り直す。"""
+        path = generation_path(self.path, generation)
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            st = None
+        key = (path, st.st_ino, st.st_size) if st else None
+        if key != self._mm_key or self._mm is None or self._mm.shape[0] < need_rows:
+            n = st.st_size // self.row_bytes if st else 0
+            self._mm = np.memmap(path, dtype=np.float32, mode="r", shape=(n, self.dim)) if n else None
+            self._mm_key = key
+        return self._mm if self._mm is not None else np.zeros((0, self.dim), dtype=np.float32)
+
+    def _rows_for(self, channel_id: str) -> Tuple[int, np.ndarray, np.ndarray, np.ndarray]:
+        """
+        (世代, 行番号, message_id, ts)。チャンネルごとに読み込み済みの最大行を覚えておき、
+        それより後に追記された行だけ読み足す（他チャンネルの書き込みでは読み直さない）。
+        """
+        conn = get_conn()
+        while True:
+            generation = _generation(conn)
+            top = conn.execute("SELECT COALESCE(MAX(row), -1) FROM message_vectors WHERE channel_id=?",
+                               (channel_id,)).fetchone()[0]
+            with self._lock:
+                cached = self._channel_rows.get(channel_id)
+            if cached and cached[0] == generation and cached[1] >= top:
+                return cached[0], *cached[2:]
+            since = cached[1] if cached and cached[0] == generation else -1
+            rows = conn.execute("SELECT row, message_id, ts FROM message_vectors "
+                                "WHERE channel_id=? AND row > ? ORDER BY row", (channel_id, since)).fetchall()
+            # 読んでいる間に rebuild で差し替わったら読み直す
+            if _generation(conn) == generation:
+                break
+        idx = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        ids = np.array([r[1] for r in rows], dtype=object)
+        tss = np.fromiter((r[2] for r in rows), dtype=np.float64, count=len(rows))
+        if since >= 0:
+            # 編集は同じ ts で新しい行に付け替わるので、古い行を落として後ろに足す
+            keep = ~np.isin(cached[4], tss)
+            idx = np.concatenate([cached[2][keep], idx])
+            ids = np.concatenate([cached[3][keep], ids])
+            tss = np.concatenate([cached[4][keep], tss])
+        top = int(idx[-1]) if idx.size else since
+        with self._lock:
+            self._channel_rows[channel_id] = (generation, top, idx, ids, tss)
+        return generation, idx, ids, tss
+
+    def search(self, query: str, channel_id: str, k: int,
+               window: Tuple[float | None, float | None] | None = None) -> List[Tuple[str, float]]:
+        """チャンネル内のコサイン類似度上位 k 件の (message_id, score)。window=(since, until) で ts を絞る。"""
+        generation, idx, ids, tss = self._rows_for(channel_id)
+        if window is not None:
+            since, until = window
+            keep = np.ones(idx.size, dtype=bool)
+            if since is not None:
+                keep &= tss >= since
+            if until is not None:
+                keep &= tss < until
+            idx, ids = idx[keep], ids[keep]
+        if idx.size == 0:
+            return []
+        q = embed_texts([query])[0]
+        if not q.any():
+            return []
+        mat = self._matrix(generation, int(idx[-1]) + 1)
+        if idx[-1] >= mat.shape[0]:
+            keep = idx < mat.shape[0]
+            idx, ids = idx[keep], ids[keep]
+            if idx.size == 0:
+                return []
+        if idx[-1] - idx[0] + 1 == idx.size:
+            # チャンネルの行が連続していればコピーせずにスライスのまま計算する
+            scores = mat[idx[0]:idx[-1] + 1] @ q
+        else:
+            scores = mat[idx] @ q
+        k = min(k, scores.size)
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(ids[i], float(scores[i])) for i in top if scores[i] > 0]
+
+
+def rebuild(batch_size: int = 2000) -> int:
+    """
+    messages 全件から索引を作り直す（初回のバックフィルや不要行の掃除用）。
+    新しい世代のファイルと message_vectors_build に作ってから、1 トランザクションで
+    テーブルの rename と世代の切り替えを行う。作っている間に add() された行は切り替え時に引き継ぐ。
+    """
+    conn = get_conn()
+    generation = _generation(conn)
+    old_path = generation_path(VECTOR_PATH, generation)
+    new_path = generation_path(VECTOR_PATH, generation + 1)
+    with conn:
+        conn.execute("DROP TABLE IF EXISTS message_vectors_build")
+        conn.execute("""
+          CREATE TABLE message_vectors_build (
+            message_id TEXT PRIMARY KEY,
+            channel_id TEXT NOT NULL,
+            row INTEGER NOT NULL,
+            ts REAL
+          )
+        """)
+        start_row = conn.execute("SELECT COALESCE(MAX(row), -1) FROM message_vectors").fetchone()[0]
+    total = 0
+    last_rowid = 0
+    with open(new_path, "wb") as f:
+        while True:
+            # 読み取りトランザクションを開いたまま書くと他の書き込みと衝突するので、rowid でページを切る
+            rows = conn.execute("SELECT rowid, id, channel_id, ts, text_norm FROM messages "
+                                "WHERE rowid > ? AND deleted = 0 ORDER BY rowid LIMIT ?",
+                                (last_rowid, batch_size)).fetchall()
+            if not rows:
+                break
+            last_rowid = rows[-1]["rowid"]
+            f.write(embed_texts([r["text_norm"] or "" for r in rows]).tobytes())
+            with conn:
+                conn.executemany("INSERT INTO message_vectors_build (message_id, channel_id, row, ts) VALUES (?, ?, ?, ?)",
+                                 [(r["id"], r["channel_id"], total + i, float(r["ts"])) for i, r in enumerate(rows)])
+            total += len(rows)
+    with conn:
+        conn.execute("BEGIN IMMEDIATE")
+        if _generation(conn) != generation:
+            raise RuntimeError("vector index was rebuilt concurrently")
+        late = conn.execute("SELECT message_id, channel_id, row, ts FROM message_vectors WHERE row > ? ORDER BY row",
+                            (start_row,)).fetchall()
+        if late:
+            old = np.memmap(old_path, dtype=np.float32, mode="r").reshape(-1, DIM)
+            with open(new_path, "ab") as f:
+                f.write(np.ascontiguousarray(old[[r["row"] for r in late]]).tobytes())
+            conn.executemany("""
+              INSERT INTO message_vectors_build (message_id, channel_id, row, ts) VALUES (?, ?, ?, ?)
+              ON CONFLICT(message_id) DO UPDATE SET row=excluded.row
+            """, [(r["message_id"], r["channel_id"], total + i, r["ts"]) for i, r in enumerate(late)])
+        conn.execute("DROP TABLE message_vectors")
+        conn.execute("ALTER TABLE message_vectors_build RENAME TO message_vectors")
+        conn.execute("CREATE INDEX message_vectors_channel ON message_vectors(channel_id, row)")
+        conn.execute("""
+          INSERT INTO vector_index (id, generation) VALUES (0, ?)
+          ON CONFLICT(id) DO UPDATE SET generation=excluded.generation
+        """, (generation + 1,))
+    # 旧世代を張っているプロセスは次の検索で新しい世代へ移る（開いている memmap はそのまま読める）
+    if os.path.exists(old_path):
+        os.remove(old_path)
+    return total
+
+
+_INDEX: VectorIndex | None = None
+
+
+def get_index() -> VectorIndex:
+    global _INDEX
+    if _INDEX is None:
+        _INDEX = VectorIndex()
+    return _INDEX
+
+
+# ingest / リアルタイム取り込みの upsert に合わせて追記する
+add_upsert_listener(lambda recs: get_index().add(recs))
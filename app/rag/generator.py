@@ -1,22 +1,110 @@
-from typing import List, Dict
-from llm.client import generate_llm_answer, trim_context
+import os, json, hashlib, logging
+from typing import List, Dict, Iterator
+from llm.client import generate_llm_answer, stream_llm_answer, model_id
+from rag.cache import SingleFlight, normalize_query
+from rag.packer import pack_context
+from store import get_cached_answer, put_cached_answer
+import metrics
+
+# SYSTEM やプロンプトの書式を変えたら上げる（古いキャッシュを使わないように）
+PROMPT_VERSION = "2"
+# コンテキストに使うトークン予算（見積もり）
+CONTEXT_TOKENS = int(os.getenv("RAG_CONTEXT_TOKENS", "2000"))
+
+log = logging.getLogger(__name__)
+# 0 で回答キャッシュを無効化
+ANSWER_CACHE_TTL_SEC = int(os.getenv("RAG_ANSWER_CACHE_TTL_SEC", "86400"))
+
+_INFLIGHT = SingleFlight()
+
+ANSWER_CACHE = metrics.counter("slackrag_answer_cache_total", "Answer cache lookups by result (hit / miss / coalesced)")
+CONTEXT_TOKENS_HIST = metrics.histogram("slackrag_context_tokens", "Estimated context tokens before / after packing",
+                                        (100, 250, 500, 1000, 2000, 4000, 8000, 16000))
+metrics.add_gauge("slackrag_generation_coalesced", "Generations served by waiting on an identical in-flight one",
+                  lambda: _INFLIGHT.coalesced)
 
 SYSTEM = """You are a Slack RAG assistant. Answer concisely in the language(s) of the user message (JA/EN mixed OK).
 Use only the provided Slack context to answer. Include citations (Slack permalinks) for key claims.
 If the context is insufficient, say so briefly and suggest a focused follow-up query."""
 
-def build_context_snippets(hits: List[Dict]) -> str:
-    lines = []
-    for i, h in enumerate(hits, 1):
-        txt = (h.get("text_norm") or "").replace("\n", " ").strip()
-        link = h.get("permalink")
-        lines.append(f"[{i}] {txt}\n<{link}>")
-    return "\n\n".join(lines)
+def answer_cache_key(query: str, hits: List[Dict]) -> str:
+    """provider/model・プロンプト版・正規化クエリ・ヒットの (id, updated_at) 列から作るキー。"""
+    material = [
+        model_id(),
+        PROMPT_VERSION,
+        normalize_query(query),
+        [[h.get("id"), h.get("updated_at")] for h in hits],
+    ]
+    return hashlib.sha256(json.dumps(material, ensure_ascii=False).encode("utf-8")).hexdigest()
 
 def generate_answer(query: str, hits: List[Dict]) -> str:
-    ctx = build_context_snippets(hits) if hits else "NO CONTEXT"
-    ctx = trim_context(ctx, max_chars=8000)
-    prompt = f"""User query:
+    """
+    回答キャッシュを引き、無ければ LLM で生成する。
+    同じキーの生成が実行中なら新たに呼ばずにその結果を待つ。
+    """
+    if ANSWER_CACHE_TTL_SEC <= 0:
+        return _generate_answer(query, hits)
+    key = answer_cache_key(query, hits)
+    cached = get_cached_answer(key, ANSWER_CACHE_TTL_SEC)
+    if cached is not None:
+        ANSWER_CACHE.inc(result="hit")
+        return cached
+    fut, leader = _INFLIGHT.lead(key)
+    if not leader:
+        ANSWER_CACHE.inc(result="coalesced")
+        return fut.result()
+    ANSWER_CACHE.inc(result="miss")
+    try:
+        answer = _generate_answer(query, hits)
+        put_cached_answer(key, answer, [h["id"] for h in hits if h.get("id")], ANSWER_CACHE_TTL_SEC)
+    except BaseException as e:
+        _INFLIGHT.finish(key, error=e)
+        raise
+    _INFLIGHT.finish(key, answer)
+    return answer
+
+def stream_answer(query: str, hits: List[Dict]) -> Iterator[str]:
+    """
+    generate_answer のストリーミング版。トークン差分を順に yield する。
+    キャッシュ済み・同じ生成が実行中の場合は完成した回答を 1 回で yield する。
+    """
+    if ANSWER_CACHE_TTL_SEC <= 0:
+        yield from stream_llm_answer(SYSTEM, build_prompt(query, hits))
+        return
+    key = answer_cache_key(query, hits)
+    cached = get_cached_answer(key, ANSWER_CACHE_TTL_SEC)
+    if cached is not None:
+        ANSWER_CACHE.inc(result="hit")
+        yield cached
+        return
+    fut, leader = _INFLIGHT.lead(key)
+    if not leader:
+        ANSWER_CACHE.inc(result="coalesced")
+        yield fut.result()
+        return
+    ANSWER_CACHE.inc(result="miss")
+    parts: List[str] = []
+    try:
+        for delta in stream_llm_answer(SYSTEM, build_prompt(query, hits)):
+            parts.append(delta)
+            yield delta
+        answer = "".join(parts).strip()
+        put_cached_answer(key, answer, [h["id"] for h in hits if h.get("id")], ANSWER_CACHE_TTL_SEC)
+    except BaseException as e:
+        _INFLIGHT.finish(key, error=e)
+        raise
+    _INFLIGHT.finish(key, answer)
+
+def build_prompt(query: str, hits: List[Dict]) -> str:
+    ctx, stats = pack_context(hits, CONTEXT_TOKENS)
+    CONTEXT_TOKENS_HIST.observe(stats["tokens_in"], stage="in")
+    CONTEXT_TOKENS_HIST.observe(stats["tokens_out"], stage="out")
+    metrics.annotate(context_tokens=stats["tokens_out"], snippets=stats["snippets"])
+    if hits:
+        log.info("context packed: tokens_in=%(tokens_in)d tokens_out=%(tokens_out)d tokens_saved=%(tokens_saved)d "
+                 "snippets=%(snippets)d dup=%(dropped_duplicates)d over_budget=%(dropped_over_budget)d", stats)
+    ctx = ctx or "NO CONTEXT"
+    return f"""User query:
 {query}
 
 Slack context:
@@ -27,4 +115,6 @@ Instructions:
 - Quote short key phrases when helpful.
 - Add "Sources:" and list only the permalinks you relied on.
 """
-    return generate_llm_answer(SYSTEM, prompt)
\ No newline at end of file
+
+def _generate_answer(query: str, hits: List[Dict]) -> str:
+    return generate_llm_answer(SYSTEM, build_prompt(query, hits))
@@ -0,0 +1,110 @@
+"""
+プロンプト用コンテキストの詰め込み。
+
+- スニペットごとにトークン数を見積もる（CJK は 1 文字 1 トークン、それ以外は 4 文字 1 トークン）
+- MinHash（文字 3-gram の Jaccard 推定）で「+1」や再貼り付けのような近似重複を落とす
+- 関連度順（ヒット順）に、メッセージ単位で予算に収まるものを貪欲に詰める
+"""
+import re, zlib, unicodedata
+from typing import List, Dict, Tuple
+import numpy as np
+
+_CJK = re.compile(r"[\u3040-\u30FF\u31F0-\u31FF\u3400-\u4DBF\u4E00-\u9FFF\uFF00-\uFFEF]")
+
+
+def estimate_tokens(text: str) -> int:
+    if not text:
+        return 0
+    cjk = len(_CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def _shingles(text: str, n: int = 3) -> List[str]:
+    t = re.sub(r"\s+", " ", unicodedata.normalize("NFKC", text).lower()).strip()
+    if len(t) <= n:
+        return [t] if t else []
+    return [t[i:i + n] for i in range(len(t) - n + 1)]
+
+
+_PERMS = 64
+_rng = np.random.default_rng(20240901)
+_A = _rng.integers(1, 2**61 - 1, size=_PERMS, dtype=np.uint64) | np.uint64(1)
+_B = _rng.integers(0, 2**61 - 1, size=_PERMS, dtype=np.uint64)
+
+
+def minhash(text: str) -> np.ndarray:
+    """文字 3-gram 集合の MinHash 署名（_PERMS 個の uint64）。"""
+    shingles = set(_shingles(text))
+    h = np.fromiter((zlib.crc32(sh.encode("utf-8")) for sh in shingles), dtype=np.uint64, count=len(shingles))
+    if h.size == 0:
+        return np.zeros(_PERMS, dtype=np.uint64)
+    # (a * h + b) mod 2^64 を全置換まとめて計算し、置換ごとの最小値を取る
+    return (h[:, None] * _A[None, :] + _B[None, :]).min(axis=0)
+
+
+def _near_duplicate(sig: np.ndarray, seen: np.ndarray, threshold: float) -> bool:
+    """seen（採用済み署名の行列）のどれかと推定 Jaccard が threshold 以上か。"""
+    if seen.shape[0] == 0:
+        return False
+    return bool((seen == sig).mean(axis=1).max() >= threshold)
+
+
+def format_snippet(i: int, text: str, link: str | None) -> str:
+    return f"[{i}] {text}\n<{link}>"
+
+
+def pack_context(hits: List[Dict], budget_tokens: int, dup_threshold: float = 0.8) -> Tuple[str, Dict[str, int]]:
+    """
+    hits（関連度順）から予算内のコンテキスト文字列を作る。
+    戻り値の stats には tokens_in / tokens_out / tokens_saved と落とした件数が入る。
+    """
+    texts = [(h.get("text_norm") or "").replace("\n", " ").strip() for h in hits]
+    # 比較用: 全件をそのまま並べた場合
+    tokens_in = estimate_tokens("\n\n".join(format_snippet(i, t, h.get("permalink"))
+                                             for i, (t, h) in enumerate(zip(texts, hits), 1)))
+    picked: List[str] = []
+    seen = np.empty((len(hits), _PERMS), dtype=np.uint64)
+    used = 0
+    dup = over = 0
+    for h, txt in zip(hits, texts):
+        if not txt:
+            continue
+        sig = minhash(txt)
+        if _near_duplicate(sig, seen[:len(picked)], dup_threshold):
+            dup += 1
+            continue
+        link = h.get("permalink")
+        snippet = format_snippet(len(picked) + 1, txt, link)
+        cost = estimate_tokens(snippet) + (2 if picked else 0)
+        if used + cost > budget_tokens:
+            if picked:
+                over += 1
+                continue
+            # 1 件目だけは予算に合わせて本文を切る（パーマリンクは残す）
+            txt = _truncate_to_tokens(txt, budget_tokens - estimate_tokens(format_snippet(1, "", link)) - 1)
+            snippet = format_snippet(1, txt + "…", link)
+            cost = estimate_tokens(snippet)
+        seen[len(picked)] = sig
+        picked.append(snippet)
+        used += cost
+    ctx = "\n\n".join(picked)
+    tokens_out = estimate_tokens(ctx)
+    return ctx, {
+        "tokens_in": tokens_in,
+        "tokens_out": tokens_out,
+        "tokens_saved": max(0, tokens_in - tokens_out),
+        "snippets": len(picked),
+        "dropped_duplicates": dup,
+        "dropped_over_budget": over,
+    }
+
+
+def _truncate_to_tokens(text: str, max_tokens: int) -> str:
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if estimate_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
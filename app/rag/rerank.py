@@ -0,0 +1,100 @@
+"""
+検索結果の 2 段目の並べ替え。retrieve が多めに取った候補（RAG_RERANK_POOL 件）を
+特徴量の重み付き和で並べ直し、同じスレッドからは RAG_RERANK_MAX_PER_THREAD 件までにして上位 k 件を返す。
+search_top_k の緩和段（hit の tier。0=strict, 1=phrase, 2=relaxed）をまたいでは並べ替えない
+（段ごとにクエリが違い BM25 の尺度がそろわないので、段が先・同じ段の中を特徴量で並べる）。
+
+特徴量（どれも 0〜1。coverage 以外は候補をまとめた NumPy 演算で計算する）:
+- relevance : バックエンドのスコア（BM25、密検索と融合したときは RRF）を同じ段の候補内の最大値で割ったもの。
+              スコアが無ければ元の順位から
+- recency   : 0.5 ** (経過日数 / RAG_RERANK_HALF_LIFE_DAYS)
+- coverage  : 質問の語のうち本文に出てくる語の割合（候補 × 語の部分文字列の判定）
+- parent    : スレッドの親（thread_ts == ts）なら 1
+
+重みは RAG_RERANK_W_* で変える（0 でその特徴量を使わない）。
+"""
+import os, re, time, unicodedata
+from typing import Dict, List
+import numpy as np
+
+POOL = int(os.getenv("RAG_RERANK_POOL", "50"))
+MAX_PER_THREAD = int(os.getenv("RAG_RERANK_MAX_PER_THREAD", "2"))
+HALF_LIFE_DAYS = float(os.getenv("RAG_RERANK_HALF_LIFE_DAYS", "90"))
+
+WEIGHTS = {
+    "relevance": float(os.getenv("RAG_RERANK_W_RELEVANCE", "1.0")),
+    "recency": float(os.getenv("RAG_RERANK_W_RECENCY", "0.2")),
+    "coverage": float(os.getenv("RAG_RERANK_W_COVERAGE", "0.5")),
+    "parent": float(os.getenv("RAG_RERANK_W_PARENT", "0.05")),
+}
+
+_SPLIT = re.compile(r"[\s\"'()*:]+")
+
+
+def query_terms(query: str) -> List[str]:
+    """質問の語（NFKC・小文字、重複なし）。FTS / query_string の記号は区切りとして扱う。"""
+    q = unicodedata.normalize("NFKC", query or "").lower()
+    return list(dict.fromkeys(t for t in _SPLIT.split(q) if t and t not in ("and", "or", "not")))
+
+
+def _columns(hits: List[Dict]) -> np.ndarray:
+    """(len(hits), 4) の [score, ts, thread_ts, tier]。候補を 1 回なめるだけにする。tier が無いヒットは 0。"""
+    # ts は "1700000000.000100"（SQLite）と "1700000000.0001"（OpenSearch）が混ざるので数値で扱う
+    return np.array([(h.get("score") or 0.0, float(h.get("ts") or 0.0), float(h.get("thread_ts") or 0.0),
+                      h.get("tier") or 0)
+                     for h in hits], dtype=np.float64).reshape(len(hits), 4)
+
+
+def features(hits: List[Dict], query: str, now: float | None = None,
+             cols: np.ndarray | None = None) -> Dict[str, np.ndarray]:
+    """候補ごとの特徴量（名前 → 長さ len(hits) の配列）。"""
+    n = len(hits)
+    now = time.time() if now is None else now
+    score, ts, thread_ts, tier = (_columns(hits) if cols is None else cols).T
+    if tier.any():
+        # 段ごとの最大値で割る
+        tier = tier.astype(np.intp)
+        top = np.zeros(tier.max() + 1)
+        np.maximum.at(top, tier, score)
+        top = top[tier]
+        relevance = np.where(top > 0, np.clip(score / np.where(top > 0, top, 1.0), 0.0, 1.0), 1.0 - np.arange(n) / n)
+    else:
+        top = score.max(initial=0.0)
+        relevance = np.clip(score / top, 0.0, 1.0) if top > 0 else 1.0 - np.arange(n) / n
+    recency = 0.5 ** (np.maximum(0.0, now - ts) / (86400 * HALF_LIFE_DAYS)) if HALF_LIFE_DAYS > 0 else np.ones(n)
+    terms = query_terms(query)
+    if terms:
+        # 小文字化は 1 回の呼び出しでまとめて
+        texts = "\x00".join(h.get("text_norm") or "" for h in hits).lower().split("\x00")
+        found = np.fromiter((t in text for text in texts for t in terms), dtype=bool, count=n * len(terms))
+        coverage = found.reshape(n, len(terms)).mean(axis=1)
+    else:
+        coverage = np.zeros(n)
+    parent = (thread_ts > 0) & (thread_ts == ts)
+    return {"relevance": relevance, "recency": recency, "coverage": coverage, "parent": parent.astype(np.float64)}
+
+
+def rerank(hits: List[Dict], query: str, k: int, now: float | None = None) -> List[Dict]:
+    """
+    hits を並べ直して上位 k 件。緩和段（tier）が先、同じ段の中は特徴量の重み付き和の順。
+    スレッド（thread_ts、無ければ自身の ts）ごとに MAX_PER_THREAD 件まで。
+    """
+    if len(hits) <= 1:
+        return hits[:k]
+    cols = _columns(hits)
+    total = np.zeros(len(hits))
+    for name, values in features(hits, query, now, cols).items():
+        total += WEIGHTS.get(name, 0.0) * values
+    # lexsort は最後のキーが優先で、同点は元の順（安定）
+    order = np.lexsort((-total, cols[:, 3]))
+    if MAX_PER_THREAD > 0:
+        threads = np.where(cols[:, 2] > 0, cols[:, 2], cols[:, 1])[order]
+        # 並べ替えた順で、同じスレッドの何件目か（0 始まり）。スレッドで安定ソートして先頭からの距離を取る
+        by_thread = np.argsort(threads, kind="stable")
+        grouped = threads[by_thread]
+        new_group = np.r_[True, grouped[1:] != grouped[:-1]]
+        starts = np.maximum.accumulate(np.where(new_group, np.arange(len(grouped)), 0))
+        nth = np.empty_like(by_thread)
+        nth[by_thread] = np.arange(len(grouped)) - starts
+        order = order[nth < MAX_PER_THREAD]
+    return [hits[i] for i in order[:k]]
@@ -1,5 +1,33 @@
-from typing import List, Dict
-from store import search_top_k
+import os, time
+from typing import List, Dict, Optional, Tuple
+from rag.backends import get_backend
+from rag.cache import ChannelLRUCache, normalize_query
+from rag import rerank
+from store import add_write_listener, get_messages
+from utils.passages import best_passage
+import metrics
+
+# BM25 と密ベクトル検索を RRF で融合する（RAG_DENSE=0 で BM25 のみ）
+DENSE = os.getenv("RAG_DENSE", "1") == "1"
+# 融合前に各段から取る候補数と RRF の定数
+FUSION_POOL = int(os.getenv("RAG_FUSION_POOL", "20"))
+RRF_K = 60
+# 新しいメッセージを優先する減衰の半減期（日）。0 で無効
+RECENCY_HALF_LIFE_DAYS = float(os.getenv("RAG_RECENCY_HALF_LIFE_DAYS", "0"))
+# 多めに取った候補を rag.rerank で並べ直す（新しさ・語の網羅・スレッドの重複も見る）。0 で BM25 / RRF の順のまま
+RERANK = os.getenv("RAG_RERANK", "1") == "1"
+if DENSE:
+    from rag.dense import get_index
+
+# 同じ質問が繰り返し来るので検索結果をキャッシュする。
+# 書き込み（upsert_message / mark_deleted）でチャンネル単位に無効化される。
+_CACHE = ChannelLRUCache(
+    maxsize=int(os.getenv("RAG_CACHE_SIZE", "512")),
+    ttl_sec=float(os.getenv("RAG_CACHE_TTL_SEC", "300")),
+    refresh_grace_sec=float(os.getenv("RAG_CACHE_REFRESH_GRACE_SEC", "1.0")),
+)
+add_write_listener(_CACHE.invalidate_channel)
+metrics.add_gauge("slackrag_retrieval_cache", "Retrieval cache counters and size", lambda: retrieval_cache_stats())
 
 
 def _prepare_match_query(q: str) -> str:
@@ -12,11 +40,15 @@ def _prepare_match_query(q: str) -> str:
     return (q or "").strip()
 
 
-def retrieve(query: str, channel_id: str, k: int = 5) -> List[Dict]:
+def retrieve(query: str, channel_id: str, k: int = 5,
+             window: Optional[Tuple[Optional[float], Optional[float]]] = None) -> List[Dict]:
     """RAG 用 BM25 リトリーバ。
 
-    SQLite FTS5 の bm25 を使用してランキングします。bm25 はスコアが低いほど
-    関連度が高いので、上位 k 件を返します。
+    検索バックエンド（OpenSearch / SQLite FTS5 / フェイルオーバー）は
+    RAG_SEARCH_BACKEND で切り替えます。いずれも BM25 でランキングし、
+    上位 k 件を返します（RAG_RERANK=1 なら RAG_RERANK_POOL 件を取って rag.rerank で
+    並べ直した上位 k 件）。window=(since, until)（epoch 秒）を渡すと
+    その期間のメッセージだけを検索します（rag.timewindow で質問文から作る）。
 
     例: "token1 token2" で AND、'"exact phrase"' でフレーズ検索。
     """
@@ -24,7 +56,80 @@ def retrieve(query: str, channel_id: str, k: int = 5) -> List[Dict]:
     if not q:
         return []
 
-    # DB 側で bm25 によるランキングを実施
-    # 必要に応じて候補件数を増やし、上位 k を返す設計にも変更可能
-    hits = search_top_k(q, channel_id, k=max(1, k))
-    return hits[:k]
+    with metrics.stage("retrieve"):
+        key = (channel_id, normalize_query(q), k, window)
+        if window is not None:
+            metrics.annotate(time_window=list(window))
+        cached = _CACHE.get(key)
+        if cached is not None:
+            metrics.annotate(hits=len(cached), retrieval_cache="hit")
+            return [dict(h) for h in cached]
+        gen = _CACHE.generation(channel_id)
+
+        # バックエンド側で bm25 によるランキングを実施し、密ベクトル検索の結果と融合する
+        if RERANK:
+            # 新しさは rerank の特徴量で見るので融合では減衰させない
+            pool = max(k, rerank.POOL)
+            hits = get_backend().search(q, channel_id, k=pool, window=window)
+            if DENSE:
+                with metrics.stage("dense_search"):
+                    dense = get_index().search(q, channel_id, pool, window)
+                hits = rrf_fuse(hits, dense, pool)
+            with metrics.stage("rerank"):
+                hits = rerank.rerank(hits, q, k)
+        elif DENSE:
+            pool = max(k, FUSION_POOL)
+            bm25 = get_backend().search(q, channel_id, k=pool, window=window)
+            with metrics.stage("dense_search"):
+                dense = get_index().search(q, channel_id, pool, window)
+            hits = rrf_fuse(bm25, dense, k, RECENCY_HALF_LIFE_DAYS)
+        elif RECENCY_HALF_LIFE_DAYS > 0:
+            # 減衰で順位が入れ替わるので多めに取ってから並べ直す
+            bm25 = get_backend().search(q, channel_id, k=max(k, FUSION_POOL), window=window)
+            hits = rrf_fuse(bm25, [], k, RECENCY_HALF_LIFE_DAYS)
+        else:
+            hits = get_backend().search(q, channel_id, k=max(1, k), window=window)[:k]
+        # OpenSearch はハイライトの断片を返すが、FTS5 / 密検索だけのヒットは本文のままなので、
+        # 長いメッセージは質問に合うパッセージだけにする（引用先は親の permalink のまま）
+        for h in hits:
+            h["text_norm"] = best_passage(h.get("text_norm"), q)
+        _CACHE.put(key, hits, gen)
+        metrics.annotate(hits=len(hits), retrieval_cache="miss")
+        return [dict(h) for h in hits]
+
+
+def _recency(message_id: str, now: float, half_life_days: float) -> float:
+    """0.5 ** (経過日数 / 半減期)。message id は "<channel>-<ts>"。"""
+    age = max(0.0, now - float(message_id.rsplit("-", 1)[-1])) / 86400
+    return 0.5 ** (age / half_life_days)
+
+
+def rrf_fuse(bm25: List[Dict], dense: List[Tuple[str, float]], k: int, half_life_days: float = 0.0) -> List[Dict]:
+    """
+    Reciprocal Rank Fusion。密検索だけに出た id は SQLite から本文を補う（削除済みは落ちる）。
+    half_life_days > 0 なら融合後のスコアに新しさの減衰を掛ける。
+    """
+    scores: Dict[str, float] = {}
+    for rank, h in enumerate(bm25):
+        scores[h["id"]] = scores.get(h["id"], 0.0) + 1.0 / (RRF_K + rank + 1)
+    for rank, (mid, _) in enumerate(dense):
+        scores[mid] = scores.get(mid, 0.0) + 1.0 / (RRF_K + rank + 1)
+    if half_life_days > 0:
+        now = time.time()
+        for mid in scores:
+            scores[mid] *= _recency(mid, now, half_life_days)
+    by_id = {h["id"]: h for h in bm25}
+    ranked = sorted(scores, key=scores.get, reverse=True)
+    missing = [mid for mid in ranked[:k * 2] if mid not in by_id]
+    by_id.update(get_messages(missing))
+    out = [by_id[mid] for mid in ranked if mid in by_id][:k]
+    # rerank の relevance は融合後のスコアを使う。順位から作るので緩和段（tier）をまたいで比べてよい
+    for h in out:
+        h["score"] = scores[h["id"]]
+        h.pop("tier", None)
+    return out
+
+
+def retrieval_cache_stats() -> Dict:
+    """検索キャッシュのヒット/ミス数など（サイズ調整用）。"""
+    return _CACHE.stats()
@@ -0,0 +1,103 @@
+"""
+質問文の中の期間指定（「先週」「直近30日」「last 30 days」など）を検索の時間窓にする。
+
+extract_time_window("先週のデプロイ障害") → ("デプロイ障害", (先週月曜 0:00, 今週月曜 0:00))
+
+- 時刻は JST で解釈し、窓は epoch 秒の (since, until)。until=None は「今まで」
+- 「直近 N 日」などの相対指定は日の境目に丸める（同じ日の間は同じ窓になり、検索キャッシュが効く）
+- 期間の語は検索語から取り除く（取り除くと空になる場合は元の文のまま）
+"""
+import re, calendar
+from datetime import datetime, timedelta, timezone
+from typing import Optional, Tuple
+
+JST = timezone(timedelta(hours=9))
+
+Window = Tuple[float, Optional[float]]
+
+_JA_UNIT = r"(日|週間|週|[かヶカケヵ]月|年)"
+_PATTERNS = [
+    # 直近30日 / 過去2週間 / ここ3ヶ月 / 最近1年
+    ("rolling", re.compile(r"(?:直近|過去|ここ|最近)\s*(\d+)\s*" + _JA_UNIT + r"(?:間)?(?:以内)?(?:の|で|に|は)?")),
+    # 30日以内 / 2週間以内
+    ("rolling", re.compile(r"(\d+)\s*" + _JA_UNIT + r"(?:間)?以内(?:の|で|に|は)?")),
+    # (in) the last 30 days / past 2 weeks
+    ("rolling", re.compile(r"\b(?:(?:in|over|during|from)\s+)?(?:the\s+)?(?:last|past)\s+(\d+)\s+(day|week|month|year)s?\b",
+                           re.I)),
+    # the past week / past month（1 単位ぶん遡る）
+    ("rolling1", re.compile(r"\b(?:(?:in|over|during|from)\s+)?(?:the\s+)?past\s+(day|week|month|year)\b", re.I)),
+    ("calendar", re.compile(r"(今日|本日|昨日|今週|先週|今月|先月|今年|去年|昨年)(?:の|に|は|で|から)?")),
+    ("calendar", re.compile(r"\b(?:(?:in|from|during|since)\s+)?(today|yesterday|this\s+week|last\s+week|this\s+month|"
+                            r"last\s+month|this\s+year|last\s+year)\b", re.I)),
+]
+
+_UNITS = {"日": "day", "週": "week", "週間": "week", "年": "year",
+          "day": "day", "week": "week", "month": "month", "year": "year"}
+
+
+def _unit(word: str) -> str:
+    word = word.lower()
+    return "month" if word.endswith("月") else _UNITS[word]
+
+
+def _add_months(t: datetime, n: int) -> datetime:
+    y, m = divmod(t.month - 1 + n, 12)
+    y, m = t.year + y, m + 1
+    # 月末は短い月に合わせる（3/31 の 1 ヶ月前 → 2/28）
+    return t.replace(year=y, month=m, day=min(t.day, calendar.monthrange(y, m)[1]))
+
+
+def _rolling(today: datetime, n: int, unit: str) -> Window:
+    if unit == "day":
+        since = today - timedelta(days=n)
+    elif unit == "week":
+        since = today - timedelta(weeks=n)
+    elif unit == "month":
+        since = _add_months(today, -n)
+    else:
+        since = _add_months(today, -12 * n)
+    return since.timestamp(), None
+
+
+def _calendar(today: datetime, word: str) -> Window:
+    word = re.sub(r"\s+", " ", word.lower())
+    monday = today - timedelta(days=today.weekday())
+    month = today.replace(day=1)
+    year = month.replace(month=1)
+    if word in ("今日", "本日", "today"):
+        return today.timestamp(), None
+    if word in ("昨日", "yesterday"):
+        return (today - timedelta(days=1)).timestamp(), today.timestamp()
+    if word in ("今週", "this week"):
+        return monday.timestamp(), None
+    if word in ("先週", "last week"):
+        return (monday - timedelta(weeks=1)).timestamp(), monday.timestamp()
+    if word in ("今月", "this month"):
+        return month.timestamp(), None
+    if word in ("先月", "last month"):
+        return _add_months(month, -1).timestamp(), month.timestamp()
+    if word in ("今年", "this year"):
+        return year.timestamp(), None
+    return year.replace(year=year.year - 1).timestamp(), year.timestamp()
+
+
+def extract_time_window(text: str, now: float | None = None) -> Tuple[str, Optional[Window]]:
+    """(期間の語を除いた検索語, (since, until) または None)。最初に見つかった期間指定だけを使う。"""
+    today = datetime.fromtimestamp(now, JST) if now is not None else datetime.now(JST)
+    today = today.replace(hour=0, minute=0, second=0, microsecond=0)
+    for kind, pattern in _PATTERNS:
+        m = pattern.search(text or "")
+        if not m:
+            continue
+        if kind == "rolling":
+            n = int(m.group(1))
+            if n <= 0:
+                continue
+            window = _rolling(today, n, _unit(m.group(2)))
+        elif kind == "rolling1":
+            window = _rolling(today, 1, _unit(m.group(1)))
+        else:
+            window = _calendar(today, m.group(1))
+        rest = re.sub(r"\s+", " ", text[:m.start()] + " " + text[m.end():]).strip()
+        return (rest or text.strip()), window
+    return (text or "").strip(), None
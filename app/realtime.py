@@ -0,0 +1,108 @@
+"""
+Slack のメッセージイベント（新規・編集・削除）をリアルタイムに取り込む。
+
+イベントは上限付きのキューに積み、バックグラウンドのライターが
+件数 (REALTIME_FLUSH_BATCH) か時間 (REALTIME_FLUSH_SEC) のどちらか早い方で
+まとめて upsert_messages / mark_deleted_many に流す（write-behind）。
+"""
+import time, queue, logging, threading
+from typing import Dict, Any, List, Tuple
+from store import upsert_messages, mark_deleted_many
+from ingest import CHANNELS, build_permalink, to_record
+import metrics
+
+log = logging.getLogger(__name__)
+
+# 取り込む通常メッセージの subtype（None は通常投稿）
+_MESSAGE_SUBTYPES = {None, "thread_broadcast", "file_share"}
+
+
+class WriteBehindWriter:
+    def __init__(self, workspace_url: str, channels: List[str] = CHANNELS,
+                 maxsize: int = 10000, batch_size: int = 100, flush_sec: float = 1.0):
+        self.workspace_url = workspace_url
+        self.channels = set(channels)
+        self.batch_size = batch_size
+        self.flush_sec = flush_sec
+        self._queue: "queue.Queue[Tuple[str, Any]]" = queue.Queue(maxsize=maxsize)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="write-behind", daemon=True)
+        self.dropped = 0
+        self.flushed = 0
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self, timeout: float = 10.0):
+        """残りを書き出してから止める。"""
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def handle_event(self, event: Dict[str, Any], block: bool = True) -> bool:
+        """message イベントを (op, payload) に変換してキューに積む。対象外なら False。"""
+        if event.get("type") != "message" or event.get("channel_type") == "im":
+            return False
+        channel_id = event.get("channel")
+        if channel_id not in self.channels:
+            return False
+        subtype = event.get("subtype")
+        if subtype == "message_deleted":
+            item = ("delete", f"{channel_id}-{event['deleted_ts']}")
+        elif subtype == "message_changed":
+            msg = event.get("message") or {}
+            if msg.get("subtype") == "tombstone":
+                # スレッド親の削除は tombstone への変更として届く
+                item = ("delete", f"{channel_id}-{msg['ts']}")
+            else:
+                item = ("upsert", self._record(channel_id, msg))
+        elif subtype in _MESSAGE_SUBTYPES and "ts" in event:
+            item = ("upsert", self._record(channel_id, event))
+        else:
+            return False
+        try:
+            # バースト時はキューが空くまで少し待ち、それでも満杯なら捨てる（夜間同期で回収される）
+            self._queue.put(item, block=block, timeout=1.0 if block else None)
+        except queue.Full:
+            self.dropped += 1
+            log.warning("write-behind queue full; dropped %s (%d dropped so far)", item[0], self.dropped)
+            return False
+        return True
+
+    def stats(self) -> Dict[str, int]:
+        return {"queued": self._queue.qsize(), "dropped": self.dropped, "flushed": self.flushed}
+
+    def _record(self, channel_id: str, msg: Dict[str, Any]) -> Dict[str, Any]:
+        pl = build_permalink(self.workspace_url, channel_id, msg["ts"], msg.get("thread_ts"))
+        return to_record(channel_id, msg, pl)
+
+    def _run(self):
+        while not (self._stop.is_set() and self._queue.empty()):
+            batch = []
+            deadline = time.monotonic() + self.flush_sec
+            while len(batch) < self.batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            if batch:
+                self._flush(batch)
+
+    def _flush(self, batch: List[Tuple[str, Any]]):
+        # 同じメッセージへの操作は最後のものだけ残す
+        last: Dict[str, Tuple[str, Any]] = {}
+        for op, payload in batch:
+            mid = payload["id"] if op == "upsert" else payload
+            last.pop(mid, None)
+            last[mid] = (op, payload)
+        upserts = [p for op, p in last.values() if op == "upsert"]
+        deletes = [p for op, p in last.values() if op == "delete"]
+        try:
+            with metrics.stage("realtime_flush"):
+                upsert_messages(upserts)
+                mark_deleted_many(deletes)
+            self.flushed += len(last)
+        except Exception:
+            log.exception("write-behind flush failed (%d ops)", len(last))
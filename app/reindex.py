@@ -0,0 +1,196 @@
+"""
+messages（SQLite が正）から OpenSearch のインデックスを作り直す。Slack の再取得は不要。
+
+1. 版付きの新しいインデックス（<OPENSEARCH_INDEX>_v<日時>、月ごとなら <OPENSEARCH_INDEX>-YYYY.MM_v<日時>）を
+   refresh 無効・レプリカ 0 で作る
+2. messages を rowid の範囲ごとに読み、並列の _bulk で投入する
+3. 投入中に書き込まれた行（updated_at が開始以降）を入れ直し、refresh / レプリカを戻す
+4. エイリアス（読み取り用と月ごとの書き込み用）を 1 回の _aliases で新しいインデックスへ付け替え、旧インデックスを消す
+   （付け替え直前の書き込みは旧インデックスに入るので、付け替え後にもう一度追いつかせる）
+
+search_top_k はエイリアス越しに検索するので、途中まで入ったインデックスは見えない。
+アナライザ・マッピングを変えたとき（kuromoji が後から使えるようになった等）と、
+OPENSEARCH_PARTITION を切り替えたとき（1 つのインデックス → 月ごと）に使う。
+
+    python app/reindex.py --workers 4 --batch 1000
+"""
+import os, time, logging, argparse, threading, contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Any, Dict, List, Tuple
+import metrics
+import store
+from store import (init_db, get_conn, _create_os_index, _os_doc_from_row, _bulk_ok_ids,
+                   os_bulk_index, os_partition, os_swap_aliases, os_versioned_index)
+
+log = logging.getLogger(__name__)
+
+WORKERS = int(os.getenv("REINDEX_WORKERS", "4"))
+BATCH = int(os.getenv("REINDEX_BATCH", "1000"))
+BULK_ATTEMPTS = int(os.getenv("REINDEX_BULK_ATTEMPTS", "3"))
+# 投入後に戻す値
+REFRESH_INTERVAL = os.getenv("OPENSEARCH_REFRESH_INTERVAL", "1s")
+REPLICAS = int(os.getenv("OPENSEARCH_REPLICAS", "0"))
+
+REINDEXED = metrics.counter("slackrag_reindex_docs_total", "Documents written by reindex, by phase")
+
+
+def _ranges(lo: int, hi: int, size: int) -> List[Tuple[int, int]]:
+    return [(start, min(start + size - 1, hi)) for start in range(lo, hi + 1, size)]
+
+
+class _Targets:
+    """書き込みエイリアス（パーティション）→ 新しい版のインデックス。必要になった月の分だけ作る。"""
+
+    def __init__(self, version: str):
+        self.version = version
+        self.indices: Dict[str, str] = {}
+        self.analyzer = ""
+        self._lock = threading.Lock()
+
+    def get(self, partition: str) -> str:
+        with self._lock:
+            index = self.indices.get(partition)
+            if index is None:
+                index = os_versioned_index(partition, self.version)
+                client = store._os_client()
+                if client.indices.exists(index=index):
+                    raise RuntimeError(f"{index} already exists; retry in a second")
+                self.analyzer = _create_os_index(client, index, index_settings={
+                    "refresh_interval": "-1", "number_of_replicas": 0})
+                self.indices[partition] = index
+            return index
+
+
+def _bulk(index: str, rows) -> List[str]:
+    """rows を index へ入れる。BULK_ATTEMPTS 回送っても入らなかった id を返す。"""
+    docs = [_os_doc_from_row(r) for r in rows]
+    for attempt in range(BULK_ATTEMPTS):
+        if attempt:
+            time.sleep(min(8.0, 2 ** attempt))
+        try:
+            resp = os_bulk_index(docs, index=index)
+            ok = _bulk_ok_ids(resp, [d["id"] for d in docs])
+        except Exception as e:
+            log.warning("reindex bulk failed (%d docs, attempt %d/%d): %s", len(docs), attempt + 1, BULK_ATTEMPTS, e)
+            ok = set()
+        docs = [d for d in docs if d["id"] not in ok]
+        if not docs:
+            return []
+    return [d["id"] for d in docs]
+
+
+def _bulk_partitioned(targets: _Targets, rows) -> List[str]:
+    """rows をパーティションごとに分けて入れる（rowid の範囲はほぼ時系列なので大抵 1〜2 個）。"""
+    groups: Dict[str, list] = {}
+    for r in rows:
+        groups.setdefault(os_partition(r["ts"]), []).append(r)
+    failed = []
+    for partition, group in groups.items():
+        failed += _bulk(targets.get(partition), group)
+    return failed
+
+
+def _load_range(targets: _Targets, lo: int, hi: int) -> Tuple[int, List[str]]:
+    """rowid が [lo, hi] の行を投入する。(読んだ行数, 失敗した id)。"""
+    rows = get_conn().execute("SELECT * FROM messages WHERE rowid BETWEEN ? AND ?", (lo, hi)).fetchall()
+    if not rows:
+        return 0, []
+    with metrics.stage("reindex_bulk"):
+        failed = _bulk_partitioned(targets, rows)
+    REINDEXED.inc(len(rows) - len(failed), phase="load")
+    return len(rows), failed
+
+
+def _catch_up(targets: _Targets, since: int, batch: int) -> int:
+    """updated_at >= since の行（投入中の新着・編集・削除）を入れ直す。入れた行数を返す。"""
+    rows = get_conn().execute("SELECT * FROM messages WHERE updated_at >= ? ORDER BY rowid", (since,)).fetchall()
+    failed = []
+    for i in range(0, len(rows), batch):
+        failed += _bulk_partitioned(targets, rows[i:i + batch])
+    if failed:
+        raise RuntimeError(f"reindex catch-up failed for {len(failed)} docs (e.g. {failed[:3]})")
+    REINDEXED.inc(len(rows), phase="catch_up")
+    return len(rows)
+
+
+def reindex(workers: int = WORKERS, batch: int = BATCH, keep_old: bool = False) -> Dict[str, Any]:
+    """
+    新しい版のインデックスへ全件入れ直してエイリアスを付け替える。
+    投入に失敗した行があれば付け替えずに新しいインデックスを消して RuntimeError。
+    """
+    init_db()
+    with metrics.request("reindex"):
+        return _reindex(workers, batch, keep_old)
+
+
+def _reindex(workers: int, batch: int, keep_old: bool) -> Dict[str, Any]:
+    client = store._os_client()
+    alias = os.getenv("OPENSEARCH_INDEX", "slack_messages")
+    targets = _Targets(time.strftime("%Y%m%d%H%M%S"))
+    if store.PARTITION != "month":
+        # 空の messages でもインデックスは作っておく
+        targets.get(alias)
+    print(f"Reindexing {alias} (partition={store.PARTITION}, version={targets.version}, "
+          f"workers={workers}, batch={batch})")
+
+    started = time.perf_counter()
+    # 秒単位の updated_at と比べるので 1 秒手前から追いつかせる
+    since = int(time.time()) - 1
+    lo, hi, total = get_conn().execute("SELECT MIN(rowid), MAX(rowid), COUNT(*) FROM messages").fetchone()
+    done, failed = 0, []
+    last_report = started
+    try:
+        if total:
+            with metrics.stage("reindex_load"), ThreadPoolExecutor(max_workers=workers) as pool:
+                futures = [pool.submit(contextvars.copy_context().run, _load_range, targets, a, b)
+                           for a, b in _ranges(lo, hi, batch)]
+                for f in as_completed(futures):
+                    n, bad = f.result()
+                    done += n
+                    failed += bad
+                    now = time.perf_counter()
+                    if now - last_report >= 2.0 or done == total:
+                        last_report = now
+                        print(f"  {done}/{total} docs ({done / total:.0%}) {done / (now - started):.0f} docs/s")
+        if failed:
+            raise RuntimeError(f"reindex failed for {len(failed)} docs (e.g. {failed[:3]})")
+        with metrics.stage("reindex_catch_up"):
+            caught_up = _catch_up(targets, since, batch)
+            since = int(time.time()) - 1
+        with metrics.stage("reindex_refresh"):
+            for index in targets.indices.values():
+                client.indices.put_settings(index=index, body={"index": {
+                    "refresh_interval": REFRESH_INTERVAL, "number_of_replicas": REPLICAS}})
+                client.indices.refresh(index=index)
+    except BaseException:
+        log.error("reindex aborted; deleting %s (alias %s is unchanged)", ", ".join(targets.indices.values()), alias)
+        if targets.indices:
+            client.indices.delete(index=",".join(targets.indices.values()))
+        raise
+
+    with metrics.stage("reindex_swap"):
+        old = os_swap_aliases(alias, targets.indices)
+    # 付け替え前に旧インデックスへ入った書き込みを拾う
+    with metrics.stage("reindex_catch_up"):
+        caught_up += _catch_up(targets, since, batch)
+    if old and not keep_old:
+        client.indices.delete(index=",".join(old))
+    elapsed = time.perf_counter() - started
+    rate = done / elapsed if elapsed > 0 else 0.0
+    indices = sorted(targets.indices.values())
+    print(f"Reindex done. {done} docs (+{caught_up} caught up) in {elapsed:.2f}s ({rate:.1f} docs/s); "
+          f"{alias} -> {len(indices)} index(es), analyzer {targets.analyzer}"
+          + (f"; {'kept' if keep_old else 'deleted'} {len(old)} old index(es)" if old else ""))
+    metrics.annotate(indices=len(indices), docs=done, caught_up=caught_up)
+    return {"indices": indices, "alias": alias, "analyzer": targets.analyzer, "docs": done, "caught_up": caught_up,
+            "seconds": elapsed, "docs_per_sec": rate, "old_indices": old}
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="SQLite → 新しい OpenSearch インデックスへ入れ直してエイリアスを付け替える")
+    ap.add_argument("--workers", type=int, default=WORKERS, help="並列の _bulk 数")
+    ap.add_argument("--batch", type=int, default=BATCH, help="1 回の _bulk に入れる rowid の範囲")
+    ap.add_argument("--keep-old", action="store_true", help="付け替え後も旧インデックスを消さない（切り戻し用）")
+    args = ap.parse_args()
+    metrics.configure_logging()
+    reindex(args.workers, args.batch, args.keep_old)
@@ -0,0 +1,165 @@
+"""
+messages（SQLite が正）の列指向スナップショット（Parquet, zstd）。Slack を再取得せずに新しい環境を立ち上げる。
+
+    python app/snapshot.py export data/snapshot.parquet          # messages → Parquet
+    python app/snapshot.py import data/snapshot.parquet          # Parquet → SQLite / FTS5 → OpenSearch
+    python app/snapshot.py stats  data/snapshot.parquet          # チャンネル × 月の件数など
+
+- export は rowid 順に batch 行ずつ読んで 1 行グループずつ書く（メモリは batch 行分だけ）
+- import は 1 トランザクションで messages に入れ、FTS5 はトリガーを外して最後に 1 回 rebuild する。
+  既存の行は updated_at が新しい方を残す。続けて reindex.py と同じ手順で OpenSearch へ _bulk で入れる
+- sync_state（チャンネルごとの同期済み ts）はファイルのメタデータに入れ、import で進める
+  （取り込み後の増分同期はスナップショットの続きから）
+- ファイルは pandas / pyarrow でそのまま読める（read_snapshot）。ベクトル索引は含めないので
+  必要なら ingest.py --rebuild-vectors
+"""
+import os, json, time, argparse
+from typing import Any, Dict, Iterator, List
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import metrics
+import reindex
+import store
+from store import init_db, get_conn, content_hash, load_messages, get_sync_state, set_sync_state, MESSAGE_COLUMNS
+
+BATCH = int(os.getenv("SNAPSHOT_BATCH", "50000"))
+COMPRESSION = os.getenv("SNAPSHOT_COMPRESSION", "zstd")
+FORMAT_VERSION = "1"
+
+SCHEMA = pa.schema([
+    ("id", pa.string()),
+    ("channel_id", pa.string()),
+    ("ts", pa.string()),
+    ("thread_ts", pa.string()),
+    ("user_id", pa.string()),
+    ("text_norm", pa.string()),
+    ("permalink", pa.string()),
+    ("created_at", pa.int64()),
+    ("updated_at", pa.int64()),
+    ("deleted", pa.bool_()),
+    ("content_hash", pa.string()),
+])
+
+SNAPSHOT_ROWS = metrics.counter("slackrag_snapshot_rows_total", "Rows written / read by snapshot export / import")
+
+
+def _batch(rows) -> pa.RecordBatch:
+    cols: Dict[str, List[Any]] = {name: [] for name in SCHEMA.names}
+    for r in rows:
+        for name in SCHEMA.names:
+            cols[name].append(r[name])
+        # 旧スキーマの行（content_hash が未設定）はここで埋める
+        if cols["content_hash"][-1] is None:
+            cols["content_hash"][-1] = content_hash(r["text_norm"], r["permalink"])
+        cols["deleted"][-1] = bool(cols["deleted"][-1])
+    return pa.RecordBatch.from_pydict(cols, schema=SCHEMA)
+
+
+def export_snapshot(path: str, batch: int = BATCH) -> Dict[str, Any]:
+    """messages を path へ書き出す（一時ファイルに書いてから置き換える）。"""
+    init_db()
+    started = time.perf_counter()
+    conn = get_conn()
+    sync_state = {r["channel_id"]: r["last_ts"] for r in conn.execute("SELECT channel_id, last_ts FROM sync_state")}
+    schema = SCHEMA.with_metadata({
+        "slackrag.snapshot": FORMAT_VERSION,
+        "slackrag.exported_at": str(int(time.time())),
+        "slackrag.sync_state": json.dumps(sync_state),
+    })
+    tmp = path + ".tmp"
+    total = 0
+    with metrics.request("snapshot_export"):
+        cur = conn.execute(f"SELECT {', '.join(MESSAGE_COLUMNS)} FROM messages ORDER BY rowid")
+        with pq.ParquetWriter(tmp, schema, compression=COMPRESSION) as writer:
+            while True:
+                rows = cur.fetchmany(batch)
+                if not rows:
+                    break
+                with metrics.stage("snapshot_write"):
+                    writer.write_batch(_batch(rows), row_group_size=batch)
+                total += len(rows)
+                SNAPSHOT_ROWS.inc(len(rows), phase="export")
+        os.replace(tmp, path)
+        metrics.annotate(rows=total)
+    elapsed = time.perf_counter() - started
+    size = os.path.getsize(path)
+    print(f"Exported {total} messages to {path} ({size / 1e6:.1f} MB, {COMPRESSION}) in {elapsed:.2f}s")
+    return {"rows": total, "bytes": size, "seconds": elapsed, "sync_state": sync_state}
+
+
+def _read_batches(path: str, batch: int) -> Iterator[List[tuple]]:
+    f = pq.ParquetFile(path)
+    for rb in f.iter_batches(batch_size=batch, columns=MESSAGE_COLUMNS):
+        cols = [rb.column(name).to_pylist() for name in MESSAGE_COLUMNS]
+        rows = list(zip(*cols))
+        SNAPSHOT_ROWS.inc(len(rows), phase="import")
+        yield rows
+
+
+def import_snapshot(path: str, batch: int = BATCH, opensearch: bool = True,
+                    workers: int | None = None) -> Dict[str, Any]:
+    """
+    path を SQLite（messages / messages_fts）へ入れ、opensearch=True なら reindex で OpenSearch も作り直す。
+    sync_state はスナップショットの方が進んでいるチャンネルだけ進める。
+    """
+    meta = pq.read_schema(path).metadata or {}
+    if meta.get(b"slackrag.snapshot") != FORMAT_VERSION.encode():
+        raise ValueError(f"{path} is not a slackrag snapshot (format {FORMAT_VERSION})")
+    init_db()
+    started = time.perf_counter()
+    with metrics.request("snapshot_import"):
+        with metrics.stage("snapshot_load"):
+            total = load_messages(_read_batches(path, batch))
+        for channel_id, last_ts in json.loads(meta.get(b"slackrag.sync_state", b"{}")).items():
+            current = get_sync_state(channel_id)
+            if last_ts and (current is None or float(last_ts) > float(current)):
+                set_sync_state(channel_id, last_ts)
+        metrics.annotate(rows=total)
+    loaded = time.perf_counter() - started
+    print(f"Imported {total} messages into {store.DB_PATH} (FTS rebuilt) in {loaded:.2f}s; "
+          "run ingest.py --rebuild-vectors for dense retrieval")
+    out: Dict[str, Any] = {"rows": total, "sqlite_seconds": loaded}
+    if opensearch:
+        out["reindex"] = reindex.reindex(workers or reindex.WORKERS, reindex.BATCH)
+    out["seconds"] = time.perf_counter() - started
+    return out
+
+
+def read_snapshot(path: str, columns: List[str] | None = None, filters=None):
+    """
+    分析用に pandas.DataFrame で読む。filters は pyarrow の述語
+    （例: [("channel_id", "==", "C123"), ("deleted", "==", False)]）で、行グループ単位で読み飛ばす。
+    ts は float の列 ts_epoch も付ける。
+    """
+    df = pq.read_table(path, columns=columns, filters=filters).to_pandas()
+    if "ts" in df.columns:
+        df["ts_epoch"] = df["ts"].astype("float64")
+    return df
+
+
+def stats(path: str) -> str:
+    """チャンネル × 月の件数・削除数・本文の長さの中央値。"""
+    df = read_snapshot(path, columns=["channel_id", "ts", "deleted", "text_norm"])
+    df["month"] = pd.to_datetime(df["ts_epoch"], unit="s", utc=True).dt.strftime("%Y-%m")
+    df["chars"] = df["text_norm"].str.len()
+    table = df.groupby(["channel_id", "month"]).agg(
+        messages=("ts", "size"), deleted=("deleted", "sum"), median_chars=("chars", "median"))
+    return table.to_string()
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser(description="messages の Parquet スナップショット（export / import / stats）")
+    ap.add_argument("command", choices=["export", "import", "stats"])
+    ap.add_argument("path")
+    ap.add_argument("--batch", type=int, default=BATCH, help="1 行グループ / 1 回の executemany の行数")
+    ap.add_argument("--no-opensearch", action="store_true", help="import で OpenSearch を作り直さない")
+    ap.add_argument("--workers", type=int, help="import 後の reindex の並列数")
+    args = ap.parse_args()
+    metrics.configure_logging()
+    if args.command == "export":
+        export_snapshot(args.path, args.batch)
+    elif args.command == "import":
+        import_snapshot(args.path, args.batch, opensearch=not args.no_opensearch, workers=args.workers)
+    else:
+        print(stats(args.path))
@@ -1,19 +1,100 @@
 import sqlite3
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Callable, Iterable, Tuple
 import re
 from opensearchpy import OpenSearch, RequestsHttpConnection
+import hashlib
 import json
+import logging
 import os
+import threading
+import time
+from datetime import datetime, timezone
+import metrics
+from utils.passages import split_passages, passage_ids, max_passages, parent_id, SEP as PASSAGE_SEP
 
-DB_PATH = "data/db.sqlite"
+log = logging.getLogger(__name__)
 
-def get_conn():
-    conn = sqlite3.connect(DB_PATH)
+SEARCH_HITS = metrics.histogram("slackrag_search_hits", "Hits returned per search call", metrics.SIZE_BUCKETS)
+SEARCH_ERRORS = metrics.counter("slackrag_search_errors_total", "Failed search calls by backend")
+
+DB_PATH = os.getenv("SQLITE_PATH", "data/db.sqlite")
+# FTS5 のトークナイザ（trigram は SQLite 3.34 以降）
+FTS_TOKENIZER = os.getenv("SQLITE_FTS_TOKENIZER", "trigram")
+
+# ---------- SQLite connections ----------
+# スレッドごとに 1 本の接続を開いたまま使い回す（開く・PRAGMA を流す費用はスレッドで 1 回だけ、
+# sqlite3 の文キャッシュもそのまま効く）。書き込み（with conn:）はプロセス内でロックを取って 1 つずつ流す
+# （SQLite の書き込みはどのみち 1 つずつなので、busy_timeout のポーリングで待たせない）。
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+SQLITE_CACHE_KB = int(os.getenv("SQLITE_CACHE_KB", str(64 * 1024)))
+SQLITE_BUSY_TIMEOUT_SEC = float(os.getenv("SQLITE_BUSY_TIMEOUT_SEC", "5"))
+SQLITE_STATEMENT_CACHE = int(os.getenv("SQLITE_STATEMENT_CACHE", "256"))
+
+_WRITE_LOCK = threading.RLock()
+_LOCAL = threading.local()
+
+class PooledConnection(sqlite3.Connection):
+    """
+    get_conn() が返すスレッドごとの接続。
+    - with conn: は書き込みトランザクション。プロセス内の単一ライターのロックを取ってから始める
+    - close() は接続を閉じてプールから外す（次の get_conn() で開き直す）。普段は閉じずに使い回す
+    """
+
+    def __enter__(self):
+        _WRITE_LOCK.acquire()
+        try:
+            return super().__enter__()
+        except BaseException:
+            _WRITE_LOCK.release()
+            raise
+
+    def __exit__(self, *exc):
+        try:
+            return super().__exit__(*exc)
+        finally:
+            _WRITE_LOCK.release()
+
+    def close(self):
+        if getattr(_LOCAL, "conn", None) is self:
+            _LOCAL.conn = None
+        super().close()
+
+def _open_conn(path: str) -> PooledConnection:
+    conn = sqlite3.connect(path, timeout=SQLITE_BUSY_TIMEOUT_SEC, factory=PooledConnection,
+                           cached_statements=SQLITE_STATEMENT_CACHE)
     conn.row_factory = sqlite3.Row
+    # journal_mode=WAL はファイルに残るので init_db で 1 回。以下は接続ごとの設定
+    conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+    conn.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_KB}")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    return conn
+
+def get_conn() -> PooledConnection:
+    """呼び出したスレッドの接続（無ければ開く）。閉じずにそのまま返してよい。"""
+    conn = getattr(_LOCAL, "conn", None)
+    if conn is None or conn.path != DB_PATH:
+        if conn is not None:
+            conn.close()
+        conn = _open_conn(DB_PATH)
+        conn.path = DB_PATH
+        _LOCAL.conn = conn
     return conn
 
 # ---------- OpenSearch helpers ----------
-def _os_client() -> OpenSearch:
+# RAG_SEARCH_BACKEND=fts5（rag/backends.py と同じ変数）では OpenSearch を一切使わない。
+# 書き込みは SQLite / FTS5 だけで完結し、outbox にも積まない
+OPENSEARCH_ENABLED = os.getenv("RAG_SEARCH_BACKEND", "failover").lower() != "fts5"
+
+# プロセス全体で 1 つのクライアント（keep-alive の接続プール）を共有する。
+# Bolt のワーカースレッドから同時に使われるので生成はロックで守る。
+_OS_CLIENT: OpenSearch | None = None
+_OS_LOCK = threading.RLock()
+# 存在確認・作成済みのインデックス名（プロセス内で 1 回だけ確認する）
+_OS_READY_INDICES: set[str] = set()
+
+def _build_os_client() -> OpenSearch:
     host = os.getenv("OPENSEARCH_HOST", "http://localhost:9200")
     user = os.getenv("OPENSEARCH_USER", "")
     password = os.getenv("OPENSEARCH_PASSWORD", "")
@@ -28,17 +109,88 @@ def _os_client() -> OpenSearch:
         verify_certs=False,
         ssl_show_warn=False,
         connection_class=RequestsHttpConnection,
+        pool_maxsize=int(os.getenv("OPENSEARCH_POOL_MAXSIZE", "16")),
+        timeout=float(os.getenv("OPENSEARCH_TIMEOUT", "10")),
     )
 
-def ensure_os_index():
-    client = _os_client()
-    index = os.getenv("OPENSEARCH_INDEX", "slack_messages")
-    if client.indices.exists(index=index):
+def _os_client() -> OpenSearch:
+    global _OS_CLIENT
+    if _OS_CLIENT is None:
+        with _OS_LOCK:
+            if _OS_CLIENT is None:
+                _OS_CLIENT = _build_os_client()
+    return _OS_CLIENT
+
+def reset_os_client():
+    """共有クライアントとインデックス確認済みキャッシュを破棄する（設定変更時・テスト用）。"""
+    global _OS_CLIENT
+    with _OS_LOCK:
+        _OS_CLIENT = None
+        _OS_READY_INDICES.clear()
+
+# 時間パーティション（OPENSEARCH_PARTITION=month で月ごとのインデックス）。
+# 書き込みは月のエイリアス <OPENSEARCH_INDEX>-YYYY.MM（UTC）へ、検索は読み取りエイリアス OPENSEARCH_INDEX か、
+# 時間窓に掛かる月のエイリアスだけへ投げる。none（既定）は 1 つのインデックス。
+PARTITION = os.getenv("OPENSEARCH_PARTITION", "none").lower()
+
+def os_partition(ts: float | str | None, alias: str | None = None) -> str:
+    """ts（Slack の ts）のメッセージを書き込むエイリアス名。"""
+    alias = alias or os.getenv("OPENSEARCH_INDEX", "slack_messages")
+    if PARTITION != "month":
+        return alias
+    t = datetime.fromtimestamp(float(ts or 0), timezone.utc)
+    return f"{alias}-{t:%Y.%m}"
+
+def os_partitions_between(since: float, until: float, alias: str | None = None) -> List[str]:
+    """[since, until) に掛かる月のエイリアス名（古い順）。"""
+    alias = alias or os.getenv("OPENSEARCH_INDEX", "slack_messages")
+    t = datetime.fromtimestamp(since, timezone.utc)
+    end = datetime.fromtimestamp(max(since, until), timezone.utc)
+    y, m = t.year, t.month
+    out = []
+    while (y, m) <= (end.year, end.month):
+        out.append(f"{alias}-{y:04d}.{m:02d}")
+        y, m = (y + 1, 1) if m == 12 else (y, m + 1)
+    return out
+
+def _message_ts(message_id: str) -> str:
+    """message id（"<channel>-<ts>"、パッセージなら "<channel>-<ts>#<番号>"）の ts。"""
+    return parent_id(message_id).rsplit("-", 1)[-1]
+
+def ensure_os_index(partition: str | None = None):
+    """
+    OPENSEARCH_INDEX はエイリアス名として扱う。無ければ版付きのインデックス（<名前>_v<日時>）を作って
+    エイリアスを張る。マッピング変更時は reindex.py で新しい版へ入れ直してエイリアスを付け替える。
+    旧構成の同名の実インデックスがあればそのまま使う。
+    partition（月のエイリアス）を渡すと、その月のインデックスを作って読み取りエイリアスにも加える。
+    """
+    if not OPENSEARCH_ENABLED:
+        return
+    alias = os.getenv("OPENSEARCH_INDEX", "slack_messages")
+    name = partition or alias
+    if name in _OS_READY_INDICES:
         return
+    with _OS_LOCK:
+        if name in _OS_READY_INDICES:
+            return
+        client = _os_client()
+        # 月ごとの場合、読み取りエイリアスは最初の月を作るときに張られる
+        if not client.indices.exists(index=name) and (PARTITION != "month" or name != alias):
+            _create_os_index(client, os_versioned_index(name), aliases=[alias] if name == alias else [name, alias])
+        _OS_READY_INDICES.add(name)
+
+def os_versioned_index(alias: str, version: str | None = None) -> str:
+    return f"{alias}_v{version or time.strftime('%Y%m%d%H%M%S')}"
+
+def _create_os_index(client: OpenSearch, index: str, aliases: List[str] | None = None,
+                     index_settings: Dict[str, Any] | None = None) -> str:
+    """インデックスを作る（既にあれば何もしない）。使ったアナライザ名を返す。"""
+    if client.indices.exists(index=index):
+        return "existing"
     # Japanese-friendly analyzer (kuromoji). If plugin unavailable, it falls back to standard.
     settings = {
         "settings": {
-            "index": {"number_of_shards": 1, "number_of_replicas": 0},
+            "index": {"number_of_shards": 1, "number_of_replicas": 0, **(index_settings or {})},
             "analysis": {
                 "analyzer": {
                     "ja_kuromoji": {
@@ -64,32 +216,171 @@ def ensure_os_index():
                 },
                 "created_at": {"type": "date", "format": "epoch_second"},
                 "updated_at": {"type": "date", "format": "epoch_second"},
-                "deleted": {"type": "boolean"}
+                "deleted": {"type": "boolean"},
+                # 長いメッセージのパッセージ（子ドキュメント）。親は chunked=true で本文を持たない
+                "parent_id": {"type": "keyword"},
+                "passage": {"type": "integer"},
+                "offset": {"type": "integer"},
+                "chunked": {"type": "boolean"}
             }
         }
     }
+    if aliases:
+        settings["aliases"] = {a: {} for a in aliases}
     try:
         client.indices.create(index=index, body=settings)
-    except Exception:
+        return "ja_kuromoji"
+    except Exception as e:
         # fallback to standard analyzer if kuromoji is unavailable
+        log.warning("creating %s with kuromoji failed (%s); falling back to the standard analyzer", index, e)
+        settings["settings"].pop("analysis")
         settings["mappings"]["properties"]["text_norm"] = {"type": "text"}
         client.indices.create(index=index, body=settings)
+        return "standard"
 
-def os_index_message(doc: Dict[str, Any]):
+def os_swap_aliases(alias: str, targets: Dict[str, str]) -> List[str]:
+    """
+    targets（書き込みエイリアス → 新しいインデックス）へ 1 回の _aliases で付け替え、読み取りエイリアス alias も
+    新しいインデックスだけを指すようにする（検索側からは途中の状態が見えない）。
+    付け替え前に指していたインデックスを返す（削除は呼び出し側で）。
+    alias と同名の実インデックス（旧構成）は同じ操作の中で削除する。
+    """
     client = _os_client()
-    index = os.getenv("OPENSEARCH_INDEX", "slack_messages")
-    ensure_os_index()
+    actions: List[Dict[str, Any]] = []
+    old: List[str] = []
+    new = set(targets.values())
+    for name in dict.fromkeys([alias, *targets]):
+        if client.indices.exists_alias(name=name):
+            current = [i for i in client.indices.get_alias(name=name) if i not in new]
+            actions += [{"remove": {"index": i, "alias": name}} for i in current]
+            old += [i for i in current if i not in old]
+        elif name == alias and client.indices.exists(index=alias):
+            actions.append({"remove_index": {"index": alias}})
+    for name, index in targets.items():
+        actions.append({"add": {"index": index, "alias": name}})
+        if name != alias:
+            actions.append({"add": {"index": index, "alias": alias}})
+    client.indices.update_aliases(body={"actions": actions})
+    with _OS_LOCK:
+        _OS_READY_INDICES.update(targets)
+    return old
+
+def _expand_passages(doc: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    メッセージのドキュメント → OpenSearch に入れるドキュメント。短いメッセージはそのまま 1 件。
+    長いメッセージは本文を持たない親（chunked=true）と "<id>#<番号>" のパッセージに分ける。
+    パッセージは親と同じ ts（＝同じパーティション）・permalink・deleted を持ち、parent_id で親を指す。
+    """
+    passages = split_passages(doc.get("text_norm"))
+    if not passages:
+        return [{**doc, "parent_id": doc["id"], "chunked": False}]
+    out = [{**doc, "text_norm": "", "parent_id": doc["id"], "chunked": True}]
+    for i, (offset, text) in enumerate(passages):
+        out.append({**doc, "id": f"{doc['id']}{PASSAGE_SEP}{i}", "parent_id": doc["id"], "passage": i,
+                    "offset": offset, "text_norm": text, "chunked": False})
+    return out
+
+def _stale_passage_ids(rec: Dict[str, Any], old_len: int | None) -> List[str]:
+    """編集で本文が短くなったときに残る古いパッセージの id（旧本文の長さから上限で見積もる）。"""
+    stop = max_passages(old_len)
+    if not stop:
+        return []
+    return passage_ids(rec["id"], None, start=len(split_passages(rec["text_norm"])), stop=stop)
+
+def os_index_message(doc: Dict[str, Any], stale_ids: List[str] | None = None):
+    docs = _expand_passages(doc)
+    if len(docs) > 1 or stale_ids:
+        # パッセージがあれば親とまとめて 1 回の _bulk で
+        resp = os_bulk_index([doc], delete_ids=stale_ids)
+        if doc["id"] not in _bulk_ok_ids(resp, [doc["id"]]):
+            raise RuntimeError(f"bulk index failed for {doc['id']}")
+        return
+    client = _os_client()
+    index = os_partition(doc["ts"])
+    ensure_os_index(index)
     # upsert by id
     #client.index(index=index, id=doc["id"], body=doc, refresh="true")
-    client.index(index=index, id=doc["id"], body=doc)
+    client.index(index=index, id=doc["id"], body=docs[0])
 
 
 def os_mark_deleted(message_id: str):
     client = _os_client()
-    index = os.getenv("OPENSEARCH_INDEX", "slack_messages")
+    index = os_partition(_message_ts(message_id))
     if client.exists(index=index, id=message_id):
         client.update(index=index, id=message_id, body={"doc": {"deleted": True}})
 
+def os_bulk_mark_deleted(message_ids: List[str]):
+    """
+    deleted=true の部分更新を 1 回の _bulk で送る（未登録の id は個別エラーとして無視される）。
+    パッセージを持つメッセージは呼び出し側でパッセージの id も含めて渡す。
+    """
+    if not message_ids:
+        return
+    client = _os_client()
+    body = []
+    for mid in message_ids:
+        body.append({"update": {"_index": os_partition(_message_ts(mid)), "_id": mid}})
+        body.append({"doc": {"deleted": True}})
+    return client.bulk(body=body)
+
+def os_bulk_index(docs: List[Dict[str, Any]], index: str | None = None, delete_ids: List[str] | None = None):
+    """
+    1 ページ分のドキュメントを 1 回の _bulk リクエストで投入する。
+    長いメッセージはパッセージに分けて親と一緒に入れる（_expand_passages）。
+    delete_ids（古いパッセージなど）は同じリクエストで削除する。
+    index を渡すとエイリアスではなくそのインデックスへ入れる（reindex 用）。
+    """
+    if not docs and not delete_ids:
+        return
+    client = _os_client()
+    body = []
+    for doc in docs:
+        target = index or os_partition(doc["ts"])
+        if index is None:
+            ensure_os_index(target)
+        for d in _expand_passages(doc):
+            body.append({"index": {"_index": target, "_id": d["id"]}})
+            body.append(d)
+    for did in delete_ids or ():
+        body.append({"delete": {"_index": index or os_partition(_message_ts(did)), "_id": did}})
+    return client.bulk(body=body)
+
+def _bulk_ok_ids(resp: Dict[str, Any] | None, ids: List[str]) -> set:
+    """
+    _bulk の応答から成功した id を返す。404（対象なし）は成功扱い。
+    パッセージ（"<id>#<番号>"）が 1 つでも失敗したメッセージは失敗扱い（outbox から丸ごと再送する）。
+    """
+    if not resp or not resp.get("errors"):
+        return set(ids)
+    seen, failed = set(), set()
+    for item in resp.get("items", []):
+        (res,) = item.values()
+        mid = parent_id(res.get("_id") or "")
+        seen.add(mid)
+        if res.get("status", 500) >= 300 and res.get("status") != 404:
+            failed.add(mid)
+    return {i for i in ids if i in seen and i not in failed}
+
+# messages → messages_fts を同期するトリガー（load_messages の間は外して最後にまとめて rebuild する）
+_FTS_TRIGGERS = {
+    "messages_ai": """
+    CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
+      INSERT INTO messages_fts(rowid, id, text_norm) VALUES (new.rowid, new.id, new.text_norm);
+    END;
+    """,
+    "messages_ad": """
+    CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
+      INSERT INTO messages_fts(messages_fts, rowid, id, text_norm) VALUES('delete', old.rowid, old.id, old.text_norm);
+    END;
+    """,
+    "messages_au": """
+    CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE OF text_norm ON messages BEGIN
+      INSERT INTO messages_fts(messages_fts, rowid, id, text_norm) VALUES('delete', old.rowid, old.id, old.text_norm);
+      INSERT INTO messages_fts(rowid, id, text_norm) VALUES (new.rowid, new.id, new.text_norm);
+    END;
+    """,
+}
+
 def init_db():
     conn = get_conn()
     cur = conn.cursor()
@@ -105,30 +396,68 @@ def init_db():
       permalink TEXT,
       created_at INTEGER,
       updated_at INTEGER,
-      deleted INTEGER DEFAULT 0
+      deleted INTEGER DEFAULT 0,
+      content_hash TEXT
     );
     """)
+    # 旧スキーマには content_hash が無いので追加する（NULL の行は次の upsert で埋まる）
+    cols = {r["name"] for r in cur.execute("PRAGMA table_info(messages)")}
+    if "content_hash" not in cols:
+        cur.execute("ALTER TABLE messages ADD COLUMN content_hash TEXT;")
+    # 時間窓つきの検索（search_fts の window）・チャンネル内の新しい順
+    cur.execute("CREATE INDEX IF NOT EXISTS messages_channel_ts ON messages(channel_id, ts);")
+    # 更新系トリガーは対象列が SET されたときだけ動かす。旧定義（全 UPDATE で発火）は作り直す
+    for name in ("messages_au", "messages_answer_cache_au"):
+        row = cur.execute("SELECT sql FROM sqlite_master WHERE type='trigger' AND name=?", (name,)).fetchone()
+        if row is not None and "UPDATE OF" not in row["sql"]:
+            cur.execute(f"DROP TRIGGER {name};")
     # FTS5 仮想テーブル（全文検索用）
-    cur.execute("""
+    # 日本語は空白で区切られないので trigram トークナイザを使う。
+    # 旧スキーマ（unicode61）の DB は作り直して messages から再構築する。
+    row = cur.execute("SELECT sql FROM sqlite_master WHERE name='messages_fts'").fetchone()
+    rebuild = row is None or FTS_TOKENIZER not in row["sql"]
+    if row is not None and rebuild:
+        cur.execute("DROP TABLE messages_fts;")
+    cur.execute(f"""
     CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(
-      id UNINDEXED, text_norm, content='messages', content_rowid='rowid'
+      id UNINDEXED, text_norm, content='messages', content_rowid='rowid', tokenize='{FTS_TOKENIZER}'
     );
     """)
+    if rebuild:
+        cur.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild');")
     # トリガー（同期）
+    for sql in _FTS_TRIGGERS.values():
+        cur.execute(sql)
+    # LLM 回答キャッシュ（キー→回答）と、回答が引用したメッセージの索引。
+    # 引用メッセージが更新・削除されたらトリガーで該当回答を捨てる。
     cur.execute("""
-    CREATE TRIGGER IF NOT EXISTS messages_ai AFTER INSERT ON messages BEGIN
-      INSERT INTO messages_fts(rowid, id, text_norm) VALUES (new.rowid, new.id, new.text_norm);
+    CREATE TABLE IF NOT EXISTS answer_cache (
+      key TEXT PRIMARY KEY,
+      answer TEXT NOT NULL,
+      created_at INTEGER
+    );
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS answer_cache_refs (
+      message_id TEXT NOT NULL,
+      key TEXT NOT NULL,
+      PRIMARY KEY (message_id, key)
+    );
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS answer_cache_refs_key ON answer_cache_refs(key);")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS answer_cache_ad AFTER DELETE ON answer_cache BEGIN
+      DELETE FROM answer_cache_refs WHERE key = old.key;
     END;
     """)
     cur.execute("""
-    CREATE TRIGGER IF NOT EXISTS messages_ad AFTER DELETE ON messages BEGIN
-      INSERT INTO messages_fts(messages_fts, rowid, id, text_norm) VALUES('delete', old.rowid, old.id, old.text_norm);
+    CREATE TRIGGER IF NOT EXISTS messages_answer_cache_au AFTER UPDATE OF text_norm, permalink, deleted ON messages BEGIN
+      DELETE FROM answer_cache WHERE key IN (SELECT key FROM answer_cache_refs WHERE message_id = old.id);
     END;
     """)
     cur.execute("""
-    CREATE TRIGGER IF NOT EXISTS messages_au AFTER UPDATE ON messages BEGIN
-      INSERT INTO messages_fts(messages_fts, rowid, id, text_norm) VALUES('delete', old.rowid, old.id, old.text_norm);
-      INSERT INTO messages_fts(rowid, id, text_norm) VALUES (new.rowid, new.id, new.text_norm);
+    CREATE TRIGGER IF NOT EXISTS messages_answer_cache_ad AFTER DELETE ON messages BEGIN
+      DELETE FROM answer_cache WHERE key IN (SELECT key FROM answer_cache_refs WHERE message_id = old.id);
     END;
     """)
     cur.execute("""
@@ -138,52 +467,392 @@ def init_db():
       updated_at INTEGER
     );
     """)
+    # OpenSearch への反映待ち（outbox）。messages と同じトランザクションで積み、
+    # 反映できたら消す。失敗分は replay_outbox がバックオフしながら再送する。
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS os_outbox (
+      seq INTEGER PRIMARY KEY AUTOINCREMENT,
+      message_id TEXT NOT NULL,
+      created_at REAL NOT NULL,
+      attempts INTEGER DEFAULT 0,
+      next_attempt_at REAL DEFAULT 0,
+      old_len INTEGER
+    );
+    """)
+    # old_len: 編集前の本文の長さ（再送時に古いパッセージを消す範囲）。新規・削除は 0
+    cols = {r["name"] for r in cur.execute("PRAGMA table_info(os_outbox)")}
+    if "old_len" not in cols:
+        cur.execute("ALTER TABLE os_outbox ADD COLUMN old_len INTEGER;")
+    cur.execute("CREATE INDEX IF NOT EXISTS os_outbox_message ON os_outbox(message_id);")
+    cur.execute("CREATE INDEX IF NOT EXISTS os_outbox_next ON os_outbox(next_attempt_at);")
+    # ベクトル索引（rag/dense.py）の message_id → 行番号。ts は時間窓の絞り込み用
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS message_vectors (
+      message_id TEXT PRIMARY KEY,
+      channel_id TEXT NOT NULL,
+      row INTEGER NOT NULL,
+      ts REAL
+    );
+    """)
+    cols = {r["name"] for r in cur.execute("PRAGMA table_info(message_vectors)")}
+    if "ts" not in cols:
+        cur.execute("ALTER TABLE message_vectors ADD COLUMN ts REAL;")
+        # message id は "<channel>-<ts>"
+        cur.execute("UPDATE message_vectors SET ts = CAST(substr(message_id, instr(message_id, '-') + 1) AS REAL)")
+    cur.execute("CREATE INDEX IF NOT EXISTS message_vectors_channel ON message_vectors(channel_id, row);")
+    # ベクトル行列ファイルの世代（dense.rebuild が message_vectors の差し替えと同じトランザクションで進める）
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS vector_index (
+      id INTEGER PRIMARY KEY CHECK (id = 0),
+      generation INTEGER NOT NULL
+    );
+    """)
+    # チャンネルごとの同期済み最大 ts（増分同期の oldest に使う）
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS sync_state (
+      channel_id TEXT PRIMARY KEY,
+      last_ts TEXT,
+      updated_at INTEGER
+    );
+    """)
     conn.commit()
-    conn.close()
 
-def upsert_message(rec: Dict[str, Any]):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("""
-    INSERT INTO messages (id, channel_id, ts, thread_ts, user_id, text_norm, permalink, created_at, updated_at, deleted)
-    VALUES (:id, :channel_id, :ts, :thread_ts, :user_id, :text_norm, :permalink, strftime('%s','now'), strftime('%s','now'), 0)
+_UPSERT_SQL = """
+    INSERT INTO messages (id, channel_id, ts, thread_ts, user_id, text_norm, permalink, created_at, updated_at, deleted, content_hash)
+    VALUES (:id, :channel_id, :ts, :thread_ts, :user_id, :text_norm, :permalink, strftime('%s','now'), strftime('%s','now'), 0, :content_hash)
     ON CONFLICT(id) DO UPDATE SET
       text_norm=excluded.text_norm,
       permalink=COALESCE(excluded.permalink, messages.permalink),
       updated_at=strftime('%s','now'),
-      deleted=0;
-    """, rec)
-    conn.commit()
-    conn.close()
-    # Also index to OpenSearch (upsert)
+      deleted=0,
+      content_hash=excluded.content_hash;
+"""
+
+MESSAGE_COLUMNS = ["id", "channel_id", "ts", "thread_ts", "user_id", "text_norm", "permalink",
+                   "created_at", "updated_at", "deleted", "content_hash"]
+
+# 取り込み（snapshot）用。既存の行は取り込む側の方が新しいときだけ上書きする
+_LOAD_SQL = f"""
+    INSERT INTO messages ({", ".join(MESSAGE_COLUMNS)}) VALUES ({", ".join("?" * len(MESSAGE_COLUMNS))})
+    ON CONFLICT(id) DO UPDATE SET
+      {", ".join(f"{c}=excluded.{c}" for c in MESSAGE_COLUMNS[1:])}
+    WHERE excluded.updated_at >= COALESCE(messages.updated_at, 0);
+"""
+
+def load_messages(batches: Iterable[List[tuple]]) -> int:
+    """
+    MESSAGE_COLUMNS 順のタプルのバッチを 1 トランザクションで messages に入れる。
+    FTS5 の同期トリガーを外して入れ、最後に messages_fts を 1 回 rebuild してトリガーを戻す
+    （途中で失敗すればトリガーの削除ごとロールバックされる）。OpenSearch には触れない（reindex.py で入れる）。
+    入れた行数を返す。
+    """
+    total = 0
+    conn = get_conn()
+    # 1 トランザクションなので途中の fsync は要らない
+    conn.execute("PRAGMA synchronous=OFF")
     try:
-        os_doc = {
-            "id": rec["id"],
-            "channel_id": rec["channel_id"],
-            "ts": float(rec["ts"]) if rec.get("ts") else 0.0,
-            "thread_ts": float(rec["thread_ts"]) if rec.get("thread_ts") else 0.0,
-            "user_id": rec.get("user_id"),
-            "text_norm": rec.get("text_norm") or "",
-            "permalink": rec.get("permalink"),
-            "created_at": int(__import__("time").time()),
-            "updated_at": int(__import__("time").time()),
-            "deleted": False
-        }
-        os_index_message(os_doc)
-    except Exception as e:
-        # don't crash ingestion on OS failures
-        pass
+        with conn:
+            conn.execute("BEGIN IMMEDIATE")
+            for name in _FTS_TRIGGERS:
+                conn.execute(f"DROP TRIGGER IF EXISTS {name}")
+            for rows in batches:
+                conn.executemany(_LOAD_SQL, rows)
+                total += len(rows)
+            with metrics.stage("fts_rebuild"):
+                conn.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+            for sql in _FTS_TRIGGERS.values():
+                conn.execute(sql)
+    finally:
+        conn.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+    return total
+
+def content_hash(text_norm: str | None, permalink: str | None) -> str:
+    return hashlib.sha1(f"{text_norm or ''}\x00{permalink or ''}".encode("utf-8")).hexdigest()
+
+def _classify(conn: sqlite3.Connection, recs: List[Dict[str, Any]],
+              old_lens: Dict[str, int] | None = None) -> Dict[str, List[Dict[str, Any]]]:
+    """
+    既存行の content_hash とまとめて比較し、new / changed / unchanged に振り分ける。
+    削除済みの行は本文が同じでも復活させるため changed 扱い。
+    content_hash が未設定（旧スキーマ）の行は本文から計算し、同じならハッシュだけ埋める。
+    old_lens を渡すと changed の行の旧本文の長さを入れる（古いパッセージの掃除用）。
+    """
+    for r in recs:
+        r["content_hash"] = content_hash(r.get("text_norm"), r.get("permalink"))
+    ids = [r["id"] for r in recs]
+    placeholders = ",".join("?" * len(ids))
+    existing = {row["id"]: row for row in conn.execute(f"""
+      SELECT id, deleted, content_hash, length(text_norm) AS old_len,
+             CASE WHEN content_hash IS NULL THEN text_norm END AS old_text,
+             CASE WHEN content_hash IS NULL THEN permalink END AS old_permalink
+      FROM messages WHERE id IN ({placeholders})
+    """, ids)}
+    out: Dict[str, List[Dict[str, Any]]] = {"new": [], "changed": [], "unchanged": []}
+    backfill = []
+    for r in recs:
+        row = existing.get(r["id"])
+        if row is None:
+            out["new"].append(r)
+            continue
+        old = row["content_hash"]
+        if old is None:
+            old = content_hash(row["old_text"], row["old_permalink"])
+            if old == r["content_hash"]:
+                backfill.append((old, r["id"]))
+        if row["deleted"] or old != r["content_hash"]:
+            out["changed"].append(r)
+            if old_lens is not None:
+                old_lens[r["id"]] = row["old_len"] or 0
+        else:
+            out["unchanged"].append(r)
+    if backfill:
+        conn.executemany("UPDATE messages SET content_hash=? WHERE id=?", backfill)
+    return out
+
+def _os_doc(rec: Dict[str, Any]) -> Dict[str, Any]:
+    now = int(time.time())
+    return {
+        "id": rec["id"],
+        "channel_id": rec["channel_id"],
+        "ts": float(rec["ts"]) if rec.get("ts") else 0.0,
+        "thread_ts": float(rec["thread_ts"]) if rec.get("thread_ts") else 0.0,
+        "user_id": rec.get("user_id"),
+        "text_norm": rec.get("text_norm") or "",
+        "permalink": rec.get("permalink"),
+        "created_at": now,
+        "updated_at": now,
+        "deleted": False
+    }
+
+# 書き込み後に呼ぶリスナー（キャッシュ無効化など）。fn(channel_id, message_ids)
+_WRITE_LISTENERS: List[Callable[[str, List[str]], None]] = []
+
+def add_write_listener(fn: Callable[[str, List[str]], None]):
+    _WRITE_LISTENERS.append(fn)
+
+# upsert 後にレコード本体を受け取るリスナー（ベクトル索引の追記など）。fn(recs)
+_UPSERT_LISTENERS: List[Callable[[List[Dict[str, Any]]], None]] = []
+
+def add_upsert_listener(fn: Callable[[List[Dict[str, Any]]], None]):
+    _UPSERT_LISTENERS.append(fn)
+
+def _notify_upsert(recs: List[Dict[str, Any]]):
+    for fn in _UPSERT_LISTENERS:
+        try:
+            fn(recs)
+        except Exception:
+            log.exception("upsert listener %s failed", getattr(fn, "__name__", fn))
+
+def _notify_write(recs: List[Dict[str, Any]]):
+    by_channel: Dict[str, List[str]] = {}
+    for r in recs:
+        by_channel.setdefault(r["channel_id"], []).append(r["id"])
+    for channel_id, ids in by_channel.items():
+        for fn in _WRITE_LISTENERS:
+            try:
+                fn(channel_id, ids)
+            except Exception:
+                log.exception("write listener %s failed", getattr(fn, "__name__", fn))
+
+def _enqueue_outbox(conn: sqlite3.Connection, message_ids: List[str],
+                    old_lens: Dict[str, int] | None = None) -> int:
+    """
+    outbox に積み、今回積んだ最大 seq を返す（呼び出し側のトランザクション内で使う）。
+    old_lens は編集された行の旧本文の長さ（_classify が埋めたもの）。
+    """
+    now = time.time()
+    old_lens = old_lens or {}
+    conn.executemany("INSERT INTO os_outbox (message_id, created_at, old_len) VALUES (?, ?, ?)",
+                     [(mid, now, old_lens.get(mid, 0)) for mid in message_ids])
+    return conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+
+def _ack_outbox(message_ids, upto_seq: int):
+    """OpenSearch に反映できた id の outbox を消す（upto_seq より後に積まれた分は残す）。"""
+    if not message_ids:
+        return
+    conn = get_conn()
+    with conn:
+        conn.executemany("DELETE FROM os_outbox WHERE message_id=? AND seq<=?",
+                         [(mid, upto_seq) for mid in message_ids])
+
+def upsert_message(rec: Dict[str, Any]) -> Dict[str, int]:
+    old_lens: Dict[str, int] = {}
+    conn = get_conn()
+    with conn:
+        kinds = _classify(conn, [rec], old_lens)
+        if not kinds["unchanged"]:
+            conn.execute(_UPSERT_SQL, rec)
+            if OPENSEARCH_ENABLED:
+                upto = _enqueue_outbox(conn, [rec["id"]], old_lens)
+    counts = {k: len(v) for k, v in kinds.items()}
+    if kinds["unchanged"]:
+        return counts
+    # Also index to OpenSearch (upsert)。失敗分は outbox から再送される
+    if OPENSEARCH_ENABLED:
+        try:
+            os_index_message(_os_doc(rec), _stale_passage_ids(rec, old_lens.get(rec["id"])))
+            _ack_outbox([rec["id"]], upto)
+        except Exception as e:
+            log.warning("OpenSearch index failed for %s; queued for replay: %s", rec["id"], e)
+    _notify_upsert([rec])
+    _notify_write([rec])
+    return counts
+
+def upsert_messages(recs: List[Dict[str, Any]]) -> Dict[str, int]:
+    """
+    バッチ版 upsert。1 トランザクションの executemany と 1 回の _bulk で書き込む。
+    content_hash が変わらない行は SQLite / FTS5 / OpenSearch のどれにも触れない。
+    戻り値は new / changed / unchanged の件数。
+    """
+    if not recs:
+        return {"new": 0, "changed": 0, "unchanged": 0}
+    old_lens: Dict[str, int] = {}
+    conn = get_conn()
+    with conn:
+        kinds = _classify(conn, recs, old_lens)
+        recs = kinds["new"] + kinds["changed"]
+        if recs:
+            ids = [r["id"] for r in recs]
+            conn.executemany(_UPSERT_SQL, recs)
+            if OPENSEARCH_ENABLED:
+                upto = _enqueue_outbox(conn, ids, old_lens)
+    counts = {k: len(v) for k, v in kinds.items()}
+    if not recs:
+        return counts
+    if OPENSEARCH_ENABLED:
+        try:
+            stale = [pid for r in kinds["changed"] for pid in _stale_passage_ids(r, old_lens.get(r["id"]))]
+            resp = os_bulk_index([_os_doc(r) for r in recs], delete_ids=stale)
+            ok = _bulk_ok_ids(resp, ids)
+            _ack_outbox(ok, upto)
+            if len(ok) < len(ids):
+                log.warning("OpenSearch bulk index: %d/%d failed; queued for replay", len(ids) - len(ok), len(ids))
+        except Exception as e:
+            log.warning("OpenSearch bulk index failed (%d docs); queued for replay: %s", len(ids), e)
+    _notify_upsert(recs)
+    _notify_write(recs)
+    return counts
 
 def mark_deleted(message_id: str):
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE messages SET deleted=1, updated_at=strftime('%s','now') WHERE id=?", (message_id,))
-    conn.commit()
-    conn.close()
+    with conn:
+        row = conn.execute("SELECT channel_id, text_norm FROM messages WHERE id=?", (message_id,)).fetchone()
+        conn.execute("UPDATE messages SET deleted=1, updated_at=strftime('%s','now') WHERE id=?", (message_id,))
+        if OPENSEARCH_ENABLED:
+            upto = _enqueue_outbox(conn, [message_id])
+    if OPENSEARCH_ENABLED:
+        try:
+            passages = passage_ids(message_id, row["text_norm"]) if row else []
+            if passages:
+                resp = os_bulk_mark_deleted([message_id, *passages])
+                _ack_outbox(_bulk_ok_ids(resp, [message_id]), upto)
+            else:
+                os_mark_deleted(message_id)
+                _ack_outbox([message_id], upto)
+        except Exception as e:
+            log.warning("OpenSearch delete failed for %s; queued for replay: %s", message_id, e)
+    if row:
+        _notify_write([{"id": message_id, "channel_id": row["channel_id"]}])
+
+def mark_deleted_many(message_ids: List[str]):
+    """
+    バッチ版 mark_deleted。1 トランザクションの executemany と 1 回の _bulk で書き込む。
+    """
+    if not message_ids:
+        return
+    conn = get_conn()
+    with conn:
+        placeholders = ",".join("?" * len(message_ids))
+        rows = conn.execute(f"SELECT id, channel_id, text_norm FROM messages WHERE id IN ({placeholders})",
+                            message_ids).fetchall()
+        conn.executemany("UPDATE messages SET deleted=1, updated_at=strftime('%s','now') WHERE id=?",
+                         [(mid,) for mid in message_ids])
+        if OPENSEARCH_ENABLED:
+            upto = _enqueue_outbox(conn, message_ids)
+    if OPENSEARCH_ENABLED:
+        try:
+            resp = os_bulk_mark_deleted(message_ids + [pid for r in rows for pid in passage_ids(r["id"], r["text_norm"])])
+            _ack_outbox(_bulk_ok_ids(resp, message_ids), upto)
+        except Exception as e:
+            log.warning("OpenSearch bulk delete failed (%d ids); queued for replay: %s", len(message_ids), e)
+    _notify_write([{"id": r["id"], "channel_id": r["channel_id"]} for r in rows])
+
+def _os_doc_from_row(row: sqlite3.Row) -> Dict[str, Any]:
+    """messages の行（正）から OpenSearch ドキュメントを作る。何度送っても同じ結果になる。"""
+    return {
+        "id": row["id"],
+        "channel_id": row["channel_id"],
+        "ts": float(row["ts"]) if row["ts"] else 0.0,
+        "thread_ts": float(row["thread_ts"]) if row["thread_ts"] else 0.0,
+        "user_id": row["user_id"],
+        "text_norm": row["text_norm"] or "",
+        "permalink": row["permalink"],
+        "created_at": row["created_at"],
+        "updated_at": row["updated_at"],
+        "deleted": bool(row["deleted"]),
+    }
+
+# Slack のメッセージ本文の上限。old_len 列より前に積まれた行は旧本文の長さが分からないので、これとみなす
+_SLACK_MAX_CHARS = 40000
+
+def _legacy_old_len(pending: sqlite3.Row, row: sqlite3.Row) -> int:
+    if pending["old_len"] is not None:
+        return pending["old_len"]
+    return _SLACK_MAX_CHARS if row["updated_at"] != row["created_at"] else 0
+
+def replay_outbox(limit: int = 500, base_backoff: float = 1.0, max_backoff: float = 300.0) -> Dict[str, int]:
+    """
+    outbox の再送。message_id ごとにまとめ、SQLite の現在の行を丸ごと index する
+    （削除済みなら deleted=true のドキュメント）ので、何度実行しても冪等。
+    編集された行は、積んだときに記録した旧本文の長さから、残りうるパッセージを同じ _bulk で消す
+    （旧本文が分けない長さなら何もしない）。
+    1 回の呼び出しで最大 limit 件を 1 回の _bulk で送る。失敗分は指数バックオフ。
+    OpenSearch を使わない構成（RAG_SEARCH_BACKEND=fts5）では何もしない。
+    """
+    if not OPENSEARCH_ENABLED:
+        return {"replayed": 0, "failed": 0}
+    now = time.time()
+    conn = get_conn()
+    pending = conn.execute("""
+      SELECT message_id, MAX(seq) AS upto, MAX(attempts) AS attempts, MAX(old_len) AS old_len
+      FROM os_outbox WHERE next_attempt_at <= ?
+      GROUP BY message_id ORDER BY MIN(seq) LIMIT ?
+    """, (now, limit)).fetchall()
+    if not pending:
+        return {"replayed": 0, "failed": 0}
+    ids = [p["message_id"] for p in pending]
+    placeholders = ",".join("?" * len(ids))
+    rows = {r["id"]: r for r in conn.execute(f"SELECT * FROM messages WHERE id IN ({placeholders})", ids)}
+    # messages から消えた id は送るものが無いので完了扱い
+    ok = {i for i in ids if i not in rows}
+    docs = [_os_doc_from_row(rows[i]) for i in ids if i in rows]
+    # 同じ id の編集が複数積まれていれば一番長かった旧本文の分まで消す
+    stale = [pid for p in pending if p["message_id"] in rows
+             for pid in _stale_passage_ids(rows[p["message_id"]], _legacy_old_len(p, rows[p["message_id"]]))]
     try:
-        os_mark_deleted(message_id)
-    except Exception:
-        pass
+        resp = os_bulk_index(docs, delete_ids=stale)
+        ok |= _bulk_ok_ids(resp, [d["id"] for d in docs])
+    except Exception as e:
+        log.warning("outbox replay failed (%d docs): %s", len(docs), e)
+    failed = [p for p in pending if p["message_id"] not in ok]
+    with conn:
+        conn.executemany("DELETE FROM os_outbox WHERE message_id=? AND seq<=?",
+                         [(p["message_id"], p["upto"]) for p in pending if p["message_id"] in ok])
+        conn.executemany("""
+          UPDATE os_outbox SET attempts=attempts+1, next_attempt_at=?
+          WHERE message_id=? AND seq<=?
+        """, [(now + min(max_backoff, base_backoff * 2 ** p["attempts"]), p["message_id"], p["upto"])
+              for p in failed])
+    return {"replayed": len(pending) - len(failed), "failed": len(failed)}
+
+def outbox_stats() -> Dict[str, float]:
+    """outbox の深さ（未反映件数）と、最も古い未反映の経過秒数（replay lag）。"""
+    conn = get_conn()
+    row = conn.execute("SELECT COUNT(*) AS depth, MIN(created_at) AS oldest FROM os_outbox").fetchone()
+    return {
+        "depth": row["depth"],
+        "lag_sec": (time.time() - row["oldest"]) if row["oldest"] else 0.0,
+    }
 
 def _fts5_safe_query(q: str) -> str | None:
     """
@@ -204,71 +873,314 @@ def _fts5_safe_query(q: str) -> str | None:
     # FTS5 は空白=AND
     return " ".join(terms)
 
-def search_top_k(query: str, channel_id: str, k: int = 5) -> List[Dict[str, Any]]:
+def search_fts(query: str, channel_id: str, k: int = 5,
+               window: Tuple[float | None, float | None] | None = None) -> List[Dict[str, Any]]:
     """
-    Search via OpenSearch (BM25). Filters to channel_id and deleted=false.
-    Uses query_string with AND semantics; supports Japanese via analyzer if available.
+    Search via SQLite FTS5 (bm25). OpenSearch を使わないローカル検索。
+    trigram は 3 文字未満の語を MATCH できないので、短い語は LIKE で絞り込む。
+    bm25 はスコアが低いほど関連度が高い。window=(since, until) は ts の範囲で絞る。
     """
-    client = _os_client()
-    index = os.getenv("OPENSEARCH_INDEX", "slack_messages")
-    ensure_os_index()
-    # sanitize empty query
-    q = (query or "").strip()
-    if not q:
+    safe = _fts5_safe_query(query)
+    if not safe:
         return []
+    terms = safe.split()
+    long_terms = [t for t in terms if len(t) >= 3]
+    short_terms = [t for t in terms if len(t) < 3]
 
-    body = {
-        "size": max(1, k),
-        "query": {
-            "bool": {
-                "must": [
-                    { "query_string": {
-                        "query": q,
-                        "default_field": "text_norm",
-                        "default_operator": "AND"
-                    }}
-                ],
-                "filter": [
-                    {"term": {"channel_id": channel_id}},
-                    {"term": {"deleted": False}}
-                ]
-            }
-        },
-        "sort": [
-            {"_score": "desc"},
-            {"ts": "desc"}
-        ]
-    }
-    res = client.search(index=index, body=body)
+    where = ["m.channel_id = ?", "m.deleted = 0"]
+    params: List[Any] = [channel_id]
+    for t in short_terms:
+        where.append("m.text_norm LIKE ?")
+        params.append(f"%{t}%")
+    # ts は "1700000000.000100" 形式なので文字列のまま比べられる（messages_channel_ts を使う）
+    since, until = window or (None, None)
+    if since is not None:
+        where.append("m.ts >= ?")
+        params.append(f"{since:.6f}")
+    if until is not None:
+        where.append("m.ts < ?")
+        params.append(f"{until:.6f}")
+    if long_terms:
+        sql = f"""
+        SELECT m.id, m.text_norm, m.permalink, m.user_id, m.ts, m.thread_ts, m.updated_at, bm25(messages_fts) AS score
+        FROM messages_fts JOIN messages m ON m.rowid = messages_fts.rowid
+        WHERE messages_fts MATCH ? AND {" AND ".join(where)}
+        ORDER BY score, CAST(m.ts AS REAL) DESC
+        LIMIT ?
+        """
+        params = [" AND ".join(f'"{t}"' for t in long_terms)] + params
+    else:
+        sql = f"""
+        SELECT m.id, m.text_norm, m.permalink, m.user_id, m.ts, m.thread_ts, m.updated_at, 0.0 AS score
+        FROM messages m
+        WHERE {" AND ".join(where)}
+        ORDER BY CAST(m.ts AS REAL) DESC
+        LIMIT ?
+        """
+    params.append(max(1, k))
+    conn = get_conn()
+    with metrics.stage("fts_search"):
+        rows = conn.execute(sql, params).fetchall()
+    SEARCH_HITS.observe(len(rows), backend="fts5")
+    return [{
+        "id": r["id"],
+        "text_norm": r["text_norm"],
+        "permalink": r["permalink"],
+        "user_id": r["user_id"],
+        "ts": r["ts"],
+        "thread_ts": r["thread_ts"],
+        "updated_at": r["updated_at"],
+        # bm25() は小さいほど関連が高いので符号を反転（他のバックエンドと同じく大きいほど良い）
+        "score": -r["score"],
+    } for r in rows]
+
+# search_top_k の緩和段（_msearch で 1 往復にまとめて投げる）
+# phrase: 語の 75% 以上 + 語順どおりの並びを加点 / relaxed: どれか 1 語
+RELAXED_MSM = os.getenv("OPENSEARCH_RELAXED_MSM", "75%")
+PHRASE_SLOP = int(os.getenv("OPENSEARCH_PHRASE_SLOP", "3"))
+PHRASE_BOOST = float(os.getenv("OPENSEARCH_PHRASE_BOOST", "4"))
+# ユーザーが query_string の構文（フレーズ・演算子・フィールド指定など）を書いたら緩和しない
+_QS_SYNTAX = re.compile(r'["*?~:()\[\]{}]|\b(AND|OR|NOT)\b|(^|\s)[+-]\S')
+
+# 本文は _source で返さず、ハイライトの断片（fragment_size 文字 × number_of_fragments）だけを返す
+FRAGMENT_CHARS = int(os.getenv("OPENSEARCH_FRAGMENT_CHARS", "300"))
+FRAGMENTS = int(os.getenv("OPENSEARCH_FRAGMENTS", "2"))
+_SOURCE_FIELDS = ["id", "parent_id", "permalink", "user_id", "ts", "thread_ts", "updated_at"]
+_HIGHLIGHT = {
+    "pre_tags": [""], "post_tags": [""],
+    "fields": {"text_norm": {"fragment_size": FRAGMENT_CHARS, "number_of_fragments": FRAGMENTS,
+                             "no_match_size": FRAGMENT_CHARS}},
+}
+
+class SearchQueryError(ValueError):
+    """クエリ自体が受け付けられなかった（4xx。構文エラーなど）。クラスタの障害ではない。"""
+
+    def __init__(self, message: str, status_code: int):
+        super().__init__(message)
+        self.status_code = status_code
+
+def is_request_error(status) -> bool:
+    """クエリ側の誤りによる 4xx か（429 は混雑なので含めない）。"""
+    return isinstance(status, int) and 400 <= status < 500 and status != 429
+
+SEARCH_TIER = metrics.counter("slackrag_search_tier_total", "Which relaxation tier answered search_top_k")
+
+def _relaxation_tiers(q: str) -> List[tuple]:
+    """(段の名前, query) のリスト。緩めても結果が変わらない 1 語のクエリや構文付きのクエリは strict だけ。"""
+    tiers = [("strict", {"query_string": {"query": q, "default_field": "text_norm", "default_operator": "AND"}})]
+    if len(q.split()) < 2 or _QS_SYNTAX.search(q):
+        return tiers
+    tiers.append(("phrase", {"bool": {
+        "must": [{"match": {"text_norm": {"query": q, "minimum_should_match": RELAXED_MSM}}}],
+        "should": [{"match_phrase": {"text_norm": {"query": q, "slop": PHRASE_SLOP, "boost": PHRASE_BOOST}}}],
+    }}))
+    tiers.append(("relaxed", {"match": {"text_norm": {"query": q, "operator": "or"}}}))
+    return tiers
+
+def _os_hits(res: Dict[str, Any], tier: int = 0) -> List[Dict[str, Any]]:
+    """
+    ヒット → 親メッセージ単位のヒット。パッセージは親の id で返し、同じ親の 2 件目以降は捨てる。
+    text_norm はハイライトの断片（無ければ _source の本文）。tier は緩和段の番号（_relaxation_tiers の順）。
+    """
     hits = []
+    seen = set()
     for h in res.get("hits", {}).get("hits", []):
         src = h.get("_source", {})
+        mid = src.get("parent_id") or src.get("id")
+        if mid in seen:
+            continue
+        seen.add(mid)
+        fragments = h.get("highlight", {}).get("text_norm")
         hits.append({
-            "id": src.get("id"),
-            "text_norm": src.get("text_norm"),
+            "id": mid,
+            "text_norm": " … ".join(fragments) if fragments else src.get("text_norm"),
             "permalink": src.get("permalink"),
             "user_id": src.get("user_id"),
             "ts": str(src.get("ts")),
+            "thread_ts": str(src["thread_ts"]) if src.get("thread_ts") else None,
+            "score": h.get("_score"),
+            "updated_at": src.get("updated_at"),
+            "tier": tier,
         })
+    return hits
+
+def search_top_k(query: str, channel_id: str, k: int = 5,
+                 window: Tuple[float | None, float | None] | None = None) -> List[Dict[str, Any]]:
+    """
+    Search via OpenSearch (BM25). Filters to channel_id and deleted=false.
+    strict（query_string の AND）・phrase・relaxed の各段を 1 回の _msearch で投げ、
+    strict が k 件以上ならそれだけを、足りなければ strict → phrase → relaxed の順に
+    重複を除いて k 件まで補う（0 件でユーザーが聞き直す往復を減らす）。
+    段ごとにクエリが違い score の尺度がそろわないので、各ヒットに段の番号 tier（0=strict, 1=phrase, 2=relaxed）を付ける。
+    window=(since, until)（epoch 秒, どちらも省略可）は ts の range フィルタにし、
+    月ごとのパーティションなら掛かる月のインデックスだけを検索する。
+    長いメッセージはパッセージ単位で当て、親の id / permalink で返す。本文は _source に含めず、
+    ハイライトの断片（OPENSEARCH_FRAGMENT_CHARS × OPENSEARCH_FRAGMENTS）を text_norm にする。
+    """
+    client = _os_client()
+    index = os.getenv("OPENSEARCH_INDEX", "slack_messages")
+    ensure_os_index()
+    # sanitize empty query
+    q = (query or "").strip()
+    if not q:
+        return []
+
+    size = max(1, k)
+    filters: List[Dict[str, Any]] = [
+        {"term": {"channel_id": channel_id}},
+        {"term": {"deleted": False}}
+    ]
+    header: Dict[str, Any] = {"index": index}
+    since, until = window or (None, None)
+    if since is not None or until is not None:
+        ts_range = {}
+        if since is not None:
+            ts_range["gte"] = since
+        if until is not None:
+            ts_range["lt"] = until
+        filters.append({"range": {"ts": ts_range}})
+        if PARTITION == "month" and since is not None:
+            # 窓に掛かる月だけ。まだ無い月（書き込みが無かった月）は無視させる
+            parts = os_partitions_between(since, until if until is not None else time.time(), index)
+            header = {"index": ",".join(parts), "ignore_unavailable": True}
+            metrics.annotate(search_partitions=len(parts))
+    tiers = _relaxation_tiers(q)
+    body: List[Dict[str, Any]] = []
+    for _, tier_query in tiers:
+        body.append(header)
+        body.append({
+            # 同じメッセージのパッセージが並ぶと親単位では k 件に減るので多めに取る
+            "size": size * 2,
+            "_source": _SOURCE_FIELDS,
+            "highlight": _HIGHLIGHT,
+            "query": {"bool": {"must": [tier_query], "filter": filters}},
+            "sort": [
+                {"_score": "desc"},
+                {"ts": "desc"}
+            ]
+        })
+    try:
+        with metrics.stage("opensearch_search"):
+            res = client.msearch(body=body)
+    except Exception:
+        SEARCH_ERRORS.inc(backend="opensearch")
+        raise
+    responses = res.get("responses", [])
+    if responses and all("error" in r for r in responses):
+        SEARCH_ERRORS.inc(backend="opensearch")
+        if all(is_request_error(r.get("status")) for r in responses):
+            raise SearchQueryError(f"OpenSearch rejected the query: {responses[0]['error']}", responses[0]["status"])
+        raise RuntimeError(f"OpenSearch msearch failed: {responses[0]['error']}")
+
+    hits: List[Dict[str, Any]] = []
+    seen = set()
+    used = "none"
+    for tier, ((name, _), r) in enumerate(zip(tiers, responses)):
+        if "error" in r:
+            # query_string の構文エラーなどは段ごとに返るので、他の段で答える
+            log.debug("search tier %s failed: %s", name, r["error"])
+            continue
+        tier_hits = _os_hits(r, tier)
+        if name == "strict" and len(tier_hits) >= size:
+            hits, used = tier_hits, name
+            break
+        for h in tier_hits:
+            if h["id"] not in seen:
+                seen.add(h["id"])
+                hits.append(h)
+                if used == "none":
+                    used = name
+        if len(hits) >= size:
+            break
+    SEARCH_TIER.inc(tier=used)
+    metrics.annotate(search_tier=used)
+    SEARCH_HITS.observe(len(hits), backend="opensearch")
     return hits[:k]
 
-def set_last_channel(user_id: str, channel_id: str):
+def get_messages(message_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    """id → ヒット形式の dict（削除済みは除く）。"""
+    if not message_ids:
+        return {}
+    placeholders = ",".join("?" * len(message_ids))
+    conn = get_conn()
+    rows = conn.execute(f"""
+      SELECT id, text_norm, permalink, user_id, ts, thread_ts, updated_at FROM messages
+      WHERE id IN ({placeholders}) AND deleted = 0
+    """, list(message_ids)).fetchall()
+    return {r["id"]: {
+        "id": r["id"],
+        "text_norm": r["text_norm"],
+        "permalink": r["permalink"],
+        "user_id": r["user_id"],
+        "ts": r["ts"],
+        "thread_ts": r["thread_ts"],
+        "updated_at": r["updated_at"],
+    } for r in rows}
+
+def get_cached_answer(key: str, max_age_sec: int) -> str | None:
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("""
-      INSERT INTO user_prefs (user_id, last_channel_id, updated_at)
-      VALUES (?, ?, strftime('%s','now'))
-      ON CONFLICT(user_id) DO UPDATE SET
-        last_channel_id=excluded.last_channel_id,
-        updated_at=strftime('%s','now');
-    """, (user_id, channel_id))
-    conn.commit()
-    conn.close()
+    cur.execute("SELECT answer FROM answer_cache WHERE key=? AND created_at >= strftime('%s','now') - ?",
+                (key, max_age_sec))
+    row = cur.fetchone()
+    return row["answer"] if row else None
+
+def put_cached_answer(key: str, answer: str, message_ids: List[str], max_age_sec: int):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+          INSERT INTO answer_cache (key, answer, created_at) VALUES (?, ?, strftime('%s','now'))
+          ON CONFLICT(key) DO UPDATE SET answer=excluded.answer, created_at=excluded.created_at;
+        """, (key, answer))
+        conn.executemany("INSERT OR IGNORE INTO answer_cache_refs (message_id, key) VALUES (?, ?)",
+                         [(mid, key) for mid in message_ids])
+        # 期限切れの回答はついでに掃除する（書き込みは LLM 呼び出し 1 回につき 1 回なので十分軽い）
+        conn.execute("DELETE FROM answer_cache WHERE created_at < strftime('%s','now') - ?", (max_age_sec,))
+
+# user_prefs の書き込みスルーのキャッシュ（DM のたびに SQLite を引かない）。
+# user_prefs を書くのはこのプロセス（Bolt アプリ）だけという前提。未登録のユーザーも None として覚える
+_PREFS: Dict[str, str | None] = {}
+_PREFS_LOCK = threading.Lock()
+
+def set_last_channel(user_id: str, channel_id: str):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+          INSERT INTO user_prefs (user_id, last_channel_id, updated_at)
+          VALUES (?, ?, strftime('%s','now'))
+          ON CONFLICT(user_id) DO UPDATE SET
+            last_channel_id=excluded.last_channel_id,
+            updated_at=strftime('%s','now');
+        """, (user_id, channel_id))
+        # 書き込みロックの中で更新する（並んだ set_last_channel の順番どおりに残る）
+        with _PREFS_LOCK:
+            _PREFS[user_id] = channel_id
 
 def get_last_channel(user_id: str) -> str | None:
+    with _PREFS_LOCK:
+        if user_id in _PREFS:
+            return _PREFS[user_id]
+    conn = get_conn()
+    row = conn.execute("SELECT last_channel_id FROM user_prefs WHERE user_id=?", (user_id,)).fetchone()
+    channel_id = row["last_channel_id"] if row else None
+    with _PREFS_LOCK:
+        # 引いている間に set_last_channel された値は上書きしない
+        return _PREFS.setdefault(user_id, channel_id)
+
+def get_sync_state(channel_id: str) -> str | None:
     conn = get_conn()
     cur = conn.cursor()
-    cur.execute("SELECT last_channel_id FROM user_prefs WHERE user_id=?", (user_id,))
+    cur.execute("SELECT last_ts FROM sync_state WHERE channel_id=?", (channel_id,))
     row = cur.fetchone()
-    conn.close()
-    return row["last_channel_id"] if row else None
\ No newline at end of file
+    return row["last_ts"] if row else None
+
+def set_sync_state(channel_id: str, last_ts: str):
+    conn = get_conn()
+    with conn:
+        conn.execute("""
+          INSERT INTO sync_state (channel_id, last_ts, updated_at)
+          VALUES (?, ?, strftime('%s','now'))
+          ON CONFLICT(channel_id) DO UPDATE SET
+            last_ts=excluded.last_ts,
+            updated_at=strftime('%s','now');
+        """, (channel_id, last_ts))
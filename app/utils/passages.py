@@ -0,0 +1,86 @@
+"""
+長いメッセージ（貼り付けたログ・仕様など）をオーバーラップ付きのパッセージに分ける。
+
+OpenSearch には親メッセージとは別に "<親id>#<番号>" の子ドキュメントとして入れ、
+検索はパッセージ単位で当てて親の id / permalink で返す（store.search_top_k）。
+分け方は本文だけで決まるので、何度分けても同じパッセージ・同じ id になる。
+"""
+import os, re
+from typing import List, Tuple
+
+# 1 パッセージの文字数・前のパッセージと重ねる文字数
+PASSAGE_CHARS = int(os.getenv("RAG_PASSAGE_CHARS", "600"))
+PASSAGE_OVERLAP = int(os.getenv("RAG_PASSAGE_OVERLAP", "120"))
+# これより短いメッセージは分けない
+MIN_CHARS = int(os.getenv("RAG_PASSAGE_MIN_CHARS", "1000"))
+
+SEP = "#"
+
+# 切れ目の候補（改行 > 句点 > ピリオド > 空白 の順に優先）
+_BREAKS = ("\n", "。", ". ", " ")
+
+
+def _cut(text: str, start: int, end: int) -> int:
+    """[start, end) の後ろ 1/4 にある切れ目の直後を返す。無ければ end。"""
+    floor = end - PASSAGE_CHARS // 4
+    for sep in _BREAKS:
+        i = text.rfind(sep, floor, end)
+        if i > start:
+            return i + len(sep)
+    return end
+
+
+def split_passages(text: str | None) -> List[Tuple[int, str]]:
+    """[(本文中の開始位置, パッセージ)]。MIN_CHARS 未満なら空（分けない）。"""
+    text = text or ""
+    if len(text) < max(MIN_CHARS, PASSAGE_CHARS + 1):
+        return []
+    out = []
+    start = 0
+    while start < len(text):
+        end = len(text) if len(text) - start <= PASSAGE_CHARS else _cut(text, start, start + PASSAGE_CHARS)
+        out.append((start, text[start:end].strip()))
+        if end >= len(text):
+            break
+        start = max(start + 1, end - PASSAGE_OVERLAP)
+    return out
+
+
+def max_passages(length: int | None) -> int:
+    """長さ length の本文から作られうるパッセージ数の上限（旧本文が手元に無いときの古い子の掃除用）。"""
+    if not length or length < max(MIN_CHARS, PASSAGE_CHARS + 1):
+        return 0
+    step = max(1, PASSAGE_CHARS - PASSAGE_CHARS // 4 - PASSAGE_OVERLAP)
+    return length // step + 1
+
+
+def passage_ids(message_id: str, text: str | None, start: int = 0, stop: int | None = None) -> List[str]:
+    """message_id のパッセージの id。stop を渡すと [start, stop) の番号で作る（本文は見ない）。"""
+    if stop is None:
+        stop = len(split_passages(text))
+    return [f"{message_id}{SEP}{i}" for i in range(start, stop)]
+
+
+def parent_id(doc_id: str) -> str:
+    return doc_id.split(SEP, 1)[0]
+
+
+_WORD = re.compile(r"\w+")
+
+
+def best_passage(text: str | None, query: str) -> str:
+    """
+    query の語を最も多く（異なり数、同数なら出現数）含むパッセージ。分けない長さなら本文のまま。
+    BM25 を通らない経路（SQLite FTS5 / 密ベクトル検索）で長いメッセージをプロンプトに入れるときに使う。
+    """
+    passages = split_passages(text)
+    if not passages:
+        return text or ""
+    terms = {t.lower() for t in _WORD.findall(query or "")}
+
+    def score(p):
+        low = p[1].lower()
+        counts = [low.count(t) for t in terms]
+        return sum(1 for c in counts if c), sum(counts)
+
+    return max(passages, key=score)[1]
@@ -0,0 +1,107 @@
+import time, threading
+
+
+class TokenBucket:
+    """
+    スレッド間で共有するトークンバケット。rate_per_sec で補充し、最大 burst まで貯まる。
+    acquire() はトークンが取れるまでブロックする（timeout を渡すとその秒数で諦めて False）。
+    相手から 429 / Retry-After が返ったら pause() で全利用者をまとめて止める。
+    """
+
+    def __init__(self, rate_per_sec: float, burst: float | None = None):
+        self.rate = rate_per_sec
+        self.capacity = burst if burst is not None else max(1.0, rate_per_sec)
+        self._tokens = self.capacity
+        self._last = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        if now <= self._last:  # pause 中は _last が未来にある
+            return
+        self._tokens = min(self.capacity, self._tokens + (now - self._last) * self.rate)
+        self._last = now
+
+    def _wait_time(self, now: float, tokens: float) -> float:
+        if now < self._paused_until:
+            return self._paused_until - now
+        self._refill(now)
+        if self._tokens >= tokens:
+            return 0.0
+        return (tokens - self._tokens) / self.rate
+
+    def acquire(self, tokens: float = 1.0, timeout: float | None = None) -> bool:
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._wait_time(now, tokens)
+                if wait <= 0:
+                    self._tokens -= tokens
+                    return True
+            # 間に合わないと分かっている場合は待たずに返す（呼び出し側が別経路を選べるように）
+            if deadline is not None and now + wait > deadline:
+                return False
+            time.sleep(wait)
+
+    def ready_in(self, tokens: float = 1.0) -> float:
+        """トークンが取れるまでの秒数の見込み（0 なら今すぐ取れる）。"""
+        with self._lock:
+            return self._wait_time(time.monotonic(), tokens)
+
+    def available(self) -> float:
+        """今すぐ払い出せるトークン数。"""
+        with self._lock:
+            now = time.monotonic()
+            if now < self._paused_until:
+                return 0.0
+            self._refill(now)
+            return self._tokens
+
+    def pause(self, seconds: float):
+        """seconds 秒間は誰にも払い出さない（Retry-After / reset ヘッダ用）。"""
+        with self._lock:
+            now = time.monotonic()
+            self._paused_until = max(self._paused_until, now + seconds)
+            self._refill(now)
+            self._tokens = 0.0
+            self._last = self._paused_until
+
+    def clamp(self, remaining: float):
+        """相手が報告する残り枠より多く貯まっていたら合わせる。"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens = min(self._tokens, max(0.0, remaining))
+
+
+class ConcurrencyGate:
+    """
+    同時実行数の上限。acquire(timeout) が取れなければ False を返すので、
+    呼び出し側はその場で諦める・別の経路へ回すなどを選べる。
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._sem = threading.BoundedSemaphore(limit)
+        self._lock = threading.Lock()
+        self.in_use = 0
+        self.waiting = 0
+
+    def acquire(self, timeout: float | None = None) -> bool:
+        ok = False
+        with self._lock:
+            self.waiting += 1
+        try:
+            ok = self._sem.acquire(timeout=timeout) if timeout is None or timeout > 0 \
+                else self._sem.acquire(blocking=False)
+        finally:
+            with self._lock:
+                self.waiting -= 1
+                if ok:
+                    self.in_use += 1
+        return ok
+
+    def release(self):
+        with self._lock:
+            self.in_use -= 1
+        self._sem.release()
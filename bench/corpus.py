@@ -0,0 +1,132 @@
+"""
+ベンチマーク用の合成 Slack コーパス（シード固定で毎回同じものができる）。
+
+- トピックごとの JA/EN 語彙から本文を作る（片方の言語が主で、ときどき混ざる）
+- 一部の親メッセージにスレッド返信を付ける
+- 同期後に流す編集・削除イベントと、トピックを正解に持つ検索クエリも作る
+"""
+import random
+from typing import List, Dict, Any, Tuple
+
+TOPICS = [
+    (["デプロイ", "リリース", "本番反映", "ロールバック"], ["deploy", "release", "rollback", "production"]),
+    (["障害", "アラート", "停止", "復旧"], ["incident", "outage", "alert", "recovery"]),
+    (["会議", "打ち合わせ", "議事録", "日程"], ["meeting", "agenda", "minutes", "schedule"]),
+    (["請求書", "経費", "精算", "予算"], ["invoice", "expense", "reimbursement", "budget"]),
+    (["採用", "面接", "候補者", "内定"], ["hiring", "interview", "candidate", "offer"]),
+    (["データベース", "インデックス", "クエリ", "遅延"], ["database", "index", "query", "latency"]),
+    (["休暇", "有給", "申請", "承認"], ["vacation", "leave", "request", "approval"]),
+    (["セキュリティ", "脆弱性", "パッチ", "権限"], ["security", "vulnerability", "patch", "permission"]),
+]
+FILLER = ["について", "確認", "お願いします", "今日", "please", "check", "update", "thanks", "よろしく", "FYI"]
+
+BASE_TS = 1_700_000_000
+
+
+def make_doc(rng: random.Random, topic: int) -> str:
+    ja, en = TOPICS[topic]
+    # 基本は片方の言語で書き、ときどきもう片方の語が混ざる
+    main, other = (ja, en) if rng.random() < 0.5 else (en, ja)
+    words = rng.sample(main, 2) + rng.sample(FILLER, 2)
+    if rng.random() < 0.3:
+        words.append(rng.choice(other))
+    rng.shuffle(words)
+    return " ".join(words)
+
+
+def make_query(rng: random.Random, topic: int) -> str:
+    ja, en = TOPICS[topic]
+    # 半分は文書と同じ語、半分は活用・複合語にした言い換え（JA/EN 混在）
+    if rng.random() < 0.5:
+        return f"{rng.choice(ja)} {rng.choice(en)}"
+    return f"{rng.choice(ja)}{rng.choice(['の手順', 'の件', 'について'])} {rng.choice(en)}{rng.choice(['s', 'ing'])}"
+
+
+class Corpus:
+    """
+    history  : channel_id → 親メッセージ（古い順、Slack の message dict 形式）
+    replies  : (channel_id, thread_ts) → 返信（古い順）
+    topic_of : message id（"<channel>-<ts>"）→ トピック番号
+    edits    : 同期後に流す (channel_id, ts, thread_ts, 新しい本文)
+    deletes  : 同期後に流す (channel_id, ts)
+    queries  : (クエリ, channel_id, 正解トピック)
+    """
+
+    def __init__(self, seed: int = 7, channels: int = 4, messages: int = 5000, thread_every: int = 10,
+                 replies_per_thread: int = 3, edit_ratio: float = 0.02, delete_ratio: float = 0.01,
+                 queries: int = 200, spacing_sec: int = 10):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.channel_ids = [f"CB{c:03d}" for c in range(channels)]
+        self.history: Dict[str, List[Dict[str, Any]]] = {c: [] for c in self.channel_ids}
+        self.replies: Dict[Tuple[str, str], List[Dict[str, Any]]] = {}
+        self.topic_of: Dict[str, int] = {}
+        # 親は spacing_sec 秒間隔、返信は親の後ろに 1 秒刻みで付ける（ts はチャンネル内で一意）
+        # スレッドになる親は平均 thread_every 件に 1 件
+        for i in range(messages):
+            ch = self.channel_ids[i % channels]
+            topic = rng.randrange(len(TOPICS))
+            ts = f"{BASE_TS + i * spacing_sec}.000100"
+            msg = {"type": "message", "ts": ts, "user": f"U{rng.randrange(50):04d}", "text": make_doc(rng, topic)}
+            self.history[ch].append(msg)
+            self.topic_of[f"{ch}-{ts}"] = topic
+            if thread_every and rng.random() < 1.0 / thread_every:
+                rs = []
+                for j in range(replies_per_thread):
+                    rts = f"{BASE_TS + i * spacing_sec + j + 1}.000100"
+                    rs.append({"type": "message", "ts": rts, "thread_ts": ts, "user": f"U{rng.randrange(50):04d}",
+                               "text": make_doc(rng, topic)})
+                    self.topic_of[f"{ch}-{rts}"] = topic
+                msg.update(thread_ts=ts, reply_count=len(rs), latest_reply=rs[-1]["ts"])
+                self.replies[(ch, ts)] = rs
+
+        everything = [(ch, m) for ch in self.channel_ids for m in self.history[ch]]
+        everything += [(ch, r) for (ch, _), rs in self.replies.items() for r in rs]
+        picked = rng.sample(everything, int(len(everything) * (edit_ratio + delete_ratio)))
+        n_edit = int(len(everything) * edit_ratio)
+        self.edits = []
+        for ch, m in picked[:n_edit]:
+            topic = self.topic_of[f"{ch}-{m['ts']}"]
+            self.edits.append((ch, m["ts"], m.get("thread_ts"), make_doc(rng, topic) + " (edited)"))
+        self.deletes = [(ch, m["ts"]) for ch, m in picked[n_edit:]]
+        self.queries = []
+        for _ in range(queries):
+            topic = rng.randrange(len(TOPICS))
+            self.queries.append((make_query(rng, topic), rng.choice(self.channel_ids), topic))
+
+    @property
+    def size(self) -> int:
+        return sum(len(v) for v in self.history.values()) + sum(len(v) for v in self.replies.values())
+
+    def records(self, workspace_url: str = "https://example.slack.com/") -> List[Dict[str, Any]]:
+        """ingest.to_record と同じ形のレコード（Slack を通さずに直接投入する場合用）。"""
+        out = []
+        for ch in self.channel_ids:
+            for m in self.history[ch]:
+                out.append(_record(workspace_url, ch, m))
+                out.extend(_record(workspace_url, ch, r) for r in self.replies.get((ch, m["ts"]), []))
+        return out
+
+    def edit_events(self) -> List[Dict[str, Any]]:
+        """edits / deletes を Slack の message_changed / message_deleted イベントにしたもの。"""
+        events = []
+        for ch, ts, thread_ts, text in self.edits:
+            msg = {"type": "message", "ts": ts, "text": text, "user": "U0000"}
+            if thread_ts:
+                msg["thread_ts"] = thread_ts
+            events.append({"type": "message", "subtype": "message_changed", "channel": ch, "channel_type": "channel",
+                           "message": msg})
+        for ch, ts in self.deletes:
+            events.append({"type": "message", "subtype": "message_deleted", "channel": ch,
+                           "channel_type": "channel", "deleted_ts": ts})
+        return events
+
+
+def _record(workspace_url: str, channel_id: str, msg: Dict[str, Any]) -> Dict[str, Any]:
+    ts = msg["ts"]
+    # ingest.build_permalink と同じ形
+    pl = f"{workspace_url}archives/{channel_id}/p{ts.replace('.', '')}"
+    if msg.get("thread_ts") and msg["thread_ts"] != ts:
+        pl += f"?thread_ts={msg['thread_ts']}&cid={channel_id}"
+    return {"id": f"{channel_id}-{ts}", "channel_id": channel_id, "ts": ts, "thread_ts": msg.get("thread_ts"),
+            "user_id": msg.get("user"), "text_norm": msg["text"].strip(), "permalink": pl}
@@ -0,0 +1,67 @@
+"""
+BM25 のみ（FTS5）とハイブリッド（BM25 + 密ベクトル, RRF）の recall@k とレイテンシを比べる。
+合成コーパスはトピックごとの JA/EN 語彙から作り、クエリは同じトピックの別の語で言い換える。
+
+    python bench/dense_recall.py --docs 20000 --queries 200 -k 6
+"""
+import argparse, os, random, statistics, sys, tempfile, time
+
+os.environ.setdefault("RAG_SEARCH_BACKEND", "fts5")
+os.environ.setdefault("RAG_CACHE_SIZE", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from corpus import TOPICS, make_doc, make_query
+
+
+def pct(samples, p):
+    return statistics.quantiles(samples, n=100)[p - 1] if len(samples) > 1 else samples[0]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--docs", type=int, default=20000)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("-k", type=int, default=6)
+    ap.add_argument("--seed", type=int, default=7)
+    args = ap.parse_args()
+    rng = random.Random(args.seed)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import store
+        from fakes import FakeOpenSearch
+        fake_os = FakeOpenSearch()
+        store._os_client = lambda: fake_os
+        store.init_db()
+        from rag import retriever
+
+        topic_of = {}
+        recs = []
+        for i in range(args.docs):
+            t = rng.randrange(len(TOPICS))
+            mid = f"CB-{i}"
+            topic_of[mid] = t
+            recs.append({"id": mid, "channel_id": "CB", "ts": f"{1_700_000_000 + i}.000100",
+                         "thread_ts": None, "user_id": "U1", "text_norm": make_doc(rng, t),
+                         "permalink": f"https://example.slack.com/archives/CB/p{i}"})
+        t0 = time.perf_counter()
+        for i in range(0, len(recs), 200):
+            store.upsert_messages(recs[i:i + 200])
+        print(f"ingest {args.docs} docs (SQLite + FTS5 + vectors): {time.perf_counter() - t0:.2f}s")
+
+        queries = [(make_query(rng, t), t) for t in (rng.randrange(len(TOPICS)) for _ in range(args.queries))]
+        for label, use_dense in (("bm25", False), ("hybrid", True)):
+            retriever.DENSE = use_dense
+            recalls, lat, zero = [], [], 0
+            for q, t in queries:
+                s = time.perf_counter()
+                hits = retriever.retrieve(q, "CB", k=args.k)
+                lat.append((time.perf_counter() - s) * 1000)
+                zero += not hits
+                recalls.append(sum(topic_of[h["id"]] == t for h in hits) / args.k)
+            print(f"{label:6s} recall@{args.k}={statistics.fmean(recalls):.3f} zero-result={zero / len(queries):.1%} "
+                  f"p50={pct(lat, 50):.2f}ms p95={pct(lat, 95):.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
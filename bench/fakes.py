@@ -0,0 +1,369 @@
+"""
+ベンチマーク用のインプロセス・スタブ（Slack WebClient / OpenSearch）。
+ネットワークを使わずに app/ 配下のコードパスを計測するためのもの。
+"""
+import os, re, sys, time, threading
+
+APP_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app")
+if APP_DIR not in sys.path:
+    sys.path.insert(0, APP_DIR)
+
+
+class FakeSlack:
+    """conversations_history / conversations_replies / chat_getPermalink / auth_test を持つ WebClient のスタブ。"""
+
+    def __init__(self, channel_id: str | None = None, n_messages: int = 0, page_size: int = 200,
+                 thread_every: int = 0, replies_per_thread: int = 3, corpus=None):
+        self.page_size = page_size
+        self.calls = {"conversations_history": 0, "conversations_replies": 0, "chat_getPermalink": 0}
+        if corpus is not None:
+            # bench/corpus.py の Corpus をそのまま使う（複数チャンネル）
+            self.history = {ch: [dict(m) for m in ms] for ch, ms in corpus.history.items()}
+            self.replies = {key: [dict(r) for r in rs] for key, rs in corpus.replies.items()}
+            self.channel_id = corpus.channel_ids[0]
+            self._clock = max(float(m["ts"]) for ms in (*self.history.values(), *self.replies.values()) for m in ms)
+            return
+        self.channel_id = channel_id
+        base = 1_700_000_000
+        self.history = {channel_id: [
+            {"ts": f"{base + i * 10}.000100", "user": f"U{i % 50:04d}",
+             "text": f"メッセージ {i} deploy の手順について message body {i}"}
+            for i in range(n_messages)
+        ]}
+        self.replies = {}
+        # 返信の ts は既存のどのメッセージよりも新しくなるよう単調増加させる
+        self._clock = base + n_messages * 10
+        if thread_every:
+            for i, m in enumerate(self.messages):
+                if i % thread_every == 0:
+                    self.add_replies(m, replies_per_thread)
+
+    @property
+    def messages(self):
+        """先頭チャンネルの親メッセージ（古い順）。"""
+        return self.history[self.channel_id]
+
+    def add_replies(self, parent, n, channel_id: str | None = None):
+        channel_id = channel_id or self.channel_id
+        rs = self.replies.setdefault((channel_id, parent["ts"]), [])
+        for j in range(n):
+            self._clock += 1
+            rs.append({"ts": f"{self._clock:.6f}", "thread_ts": parent["ts"], "user": "U9999",
+                       "text": f"返信 {j} re: {parent['text']}"})
+        parent["thread_ts"] = parent["ts"]
+        parent["reply_count"] = len(rs)
+        parent["latest_reply"] = rs[-1]["ts"]
+
+    def post(self, channel_id: str, text: str, user: str = "U9999"):
+        """新着の親メッセージを足す（増分同期用）。"""
+        self._clock += 1
+        msg = {"ts": f"{self._clock:.6f}", "user": user, "text": text}
+        self.history[channel_id].append(msg)
+        return msg
+
+    def auth_test(self):
+        return {"ok": True, "url": "https://example.slack.com/"}
+
+    def _page(self, items, cursor, limit):
+        start = int(cursor or 0)
+        end = start + min(limit, self.page_size)
+        nxt = str(end) if end < len(items) else ""
+        return {"ok": True, "messages": items[start:end], "response_metadata": {"next_cursor": nxt}}
+
+    def conversations_history(self, channel, cursor=None, limit=200, oldest=None, **kwargs):
+        self.calls["conversations_history"] += 1
+        # Slack と同じく新しい順に返す
+        items = [m for m in reversed(self.history.get(channel, []))
+                 if oldest is None or float(m["ts"]) > float(oldest)]
+        return self._page(items, cursor, limit)
+
+    def conversations_replies(self, channel, ts, cursor=None, limit=200, oldest=None, **kwargs):
+        self.calls["conversations_replies"] += 1
+        parent = next(m for m in self.history[channel] if m["ts"] == ts)
+        items = [parent] + [r for r in self.replies.get((channel, ts), [])
+                            if oldest is None or float(r["ts"]) > float(oldest)]
+        return self._page(items, cursor, limit)
+
+    def chat_getPermalink(self, channel, message_ts):
+        self.calls["chat_getPermalink"] += 1
+        return {"ok": True, "permalink": f"https://example.slack.com/archives/{channel}/p{message_ts.replace('.', '')}"}
+
+
+class _FakeIndices:
+    def __init__(self, owner):
+        self.owner = owner
+
+    def exists(self, index):
+        self.owner.requests += 1
+        return index in self.owner.store or index in self.owner.aliases
+
+    def create(self, index, body=None):
+        self.owner.requests += 1
+        self.owner.store.setdefault(index, {})
+        self.owner.settings[index] = dict((body or {}).get("settings", {}).get("index", {}))
+        for alias in (body or {}).get("aliases", {}):
+            self.owner.aliases.setdefault(alias, set()).add(index)
+
+    def exists_alias(self, name, index=None):
+        self.owner.requests += 1
+        return bool(self.owner.aliases.get(name))
+
+    def get_alias(self, name=None, index=None):
+        self.owner.requests += 1
+        return {i: {"aliases": {name: {}}} for i in sorted(self.owner.aliases.get(name, ()))}
+
+    def update_aliases(self, body):
+        """actions は 1 リクエスト内でまとめて適用する（途中の状態は外から見えない）。"""
+        self.owner.requests += 1
+        aliases = {k: set(v) for k, v in self.owner.aliases.items()}
+        dropped = []
+        for action in body["actions"]:
+            (op, arg), = action.items()
+            if op == "add":
+                aliases.setdefault(arg["alias"], set()).add(arg["index"])
+            elif op == "remove":
+                aliases.get(arg["alias"], set()).discard(arg["index"])
+            elif op == "remove_index":
+                dropped.append(arg["index"])
+        with self.owner.lock:
+            self.owner.aliases = {k: v for k, v in aliases.items() if v}
+            for i in dropped:
+                self.owner.store.pop(i, None)
+
+    def put_settings(self, body, index=None):
+        self.owner.requests += 1
+        self.owner.settings.setdefault(index, {}).update(body.get("index", {}))
+
+    def refresh(self, index=None):
+        self.owner.requests += 1
+
+    def delete(self, index):
+        self.owner.requests += 1
+        for i in index.split(","):
+            self.owner.store.pop(i, None)
+            self.owner.settings.pop(i, None)
+
+
+class FakeOpenSearch:
+    """
+    index / bulk / search / msearch の呼び出し回数とドキュメントだけを保持する OpenSearch のスタブ。
+    query_string（空白区切りの AND / OR）・match（operator / minimum_should_match）・
+    match_phrase（語順だけ見る）・bool・term / range フィルタを解釈する素朴な実装。
+    _source のフィールド指定と text_norm のハイライト（最初に当たった語のまわりを切り出すだけ）も返す。
+    インデックスごとにドキュメントを持ち、エイリアス（_aliases の付け替え）とカンマ区切りの複数指定も解釈する。
+    検索のコストは対象インデックスのドキュメント数に比例する（パーティションの効果が見える）。
+    latency_ms を与えると 1 リクエストごとにその分だけ待つ（ネットワーク往復の代わり）。
+    """
+
+    def __init__(self, latency_ms: float = 0.0):
+        self.store = {}  # index → {id: doc}
+        self.aliases = {}  # alias → {index}
+        self.settings = {}
+        self.requests = 0
+        self.latency = latency_ms / 1000.0
+        self.lock = threading.Lock()
+        self.indices = _FakeIndices(self)
+
+    def _targets(self, name):
+        """名前（カンマ区切り可・エイリアス可）→ インデックス名。無い名前は空として扱う（ignore_unavailable 相当）。"""
+        out = []
+        for part in name.split(","):
+            for i in (sorted(self.aliases[part]) if part in self.aliases else [part]):
+                if i not in out:
+                    out.append(i)
+        return out
+
+    def _write_docs(self, name):
+        """書き込み先。エイリアスなら指しているインデックスが 1 つのときだけ書ける（本物と同じ）。"""
+        targets = self._targets(name)
+        if len(targets) != 1:
+            raise ValueError(f"alias [{name}] has more than one index")
+        return self.store.setdefault(targets[0], {})
+
+    def docs_in(self, name):
+        out = {}
+        for i in self._targets(name):
+            out.update(self.store.get(i, {}))
+        return out
+
+    @property
+    def docs(self):
+        """OPENSEARCH_INDEX（エイリアス）が指しているドキュメント。"""
+        return self.docs_in(os.getenv("OPENSEARCH_INDEX", "slack_messages"))
+
+    def _wait(self):
+        if self.latency:
+            time.sleep(self.latency)
+
+    @staticmethod
+    def _terms(text):
+        return [t.lower() for t in re.split(r"\s+", text) if t]
+
+    def _score(self, query, doc):
+        """query に合えばスコア（素朴な tf の合計）、合わなければ None。"""
+        if "bool" in query:
+            q = query["bool"]
+            for f in q.get("filter", []):
+                if "range" in f:
+                    (field, bounds), = f["range"].items()
+                    v = doc.get(field) or 0
+                    if ("gte" in bounds and v < bounds["gte"]) or ("lt" in bounds and v >= bounds["lt"]):
+                        return None
+                    continue
+                (field, value), = f["term"].items()
+                if doc.get(field) != value:
+                    return None
+            score = 0.0
+            for sub in q.get("must", []):
+                s = self._score(sub, doc)
+                if s is None:
+                    return None
+                score += s
+            for sub in q.get("should", []):
+                score += self._score(sub, doc) or 0.0
+            return score
+        text = (doc.get("text_norm") or "").lower()
+        if "query_string" in query:
+            qs = query["query_string"]
+            tf = [text.count(t) for t in self._terms(qs["query"])]
+            ok = all(tf) if qs.get("default_operator", "OR").upper() == "AND" else any(tf)
+            return float(sum(tf)) if ok else None
+        if "match" in query:
+            m = query["match"]["text_norm"]
+            terms = self._terms(m["query"])
+            tf = [text.count(t) for t in terms]
+            msm = str(m.get("minimum_should_match", len(terms) if m.get("operator") == "and" else 1))
+            need = int(len(terms) * float(msm[:-1]) / 100) if msm.endswith("%") else int(msm)
+            return float(sum(tf)) if sum(1 for c in tf if c) >= max(1, need) else None
+        if "match_phrase" in query:
+            m = query["match_phrase"]["text_norm"]
+            terms = self._terms(m["query"])
+            pos = [text.find(t) for t in terms]
+            in_order = all(p >= 0 for p in pos) and pos == sorted(pos)
+            return m.get("boost", 1.0) * len(terms) if in_order else None
+        raise ValueError(f"unsupported query: {query}")
+
+    def _search(self, index, body):
+        scored = []
+        for _id, doc in self.docs_in(index).items():
+            score = self._score(body["query"], doc)
+            if score is not None:
+                scored.append((score, float(doc.get("ts") or 0), _id, doc))
+        scored.sort(key=lambda x: (-x[0], -x[1]))
+        size = body.get("size", 10)
+        hits = []
+        for score, _, _id, doc in scored[:size]:
+            hit = {"_id": _id, "_score": float(score), "_source": self._source(doc, body.get("_source", True))}
+            if "highlight" in body:
+                hit["highlight"] = {"text_norm": self._fragments(body, doc)}
+            hits.append(hit)
+        return {"hits": {"hits": hits}}
+
+    @staticmethod
+    def _source(doc, spec):
+        if spec is True:
+            return doc
+        if isinstance(spec, list):
+            spec = {"includes": spec}
+        out = {f: v for f, v in doc.items() if not spec.get("includes") or f in spec["includes"]}
+        return {f: v for f, v in out.items() if f not in spec.get("excludes", ())}
+
+    def _query_terms(self, query):
+        """query_string / match / match_phrase の語（bool の中も）。"""
+        if "bool" in query:
+            return [t for key in ("must", "should") for sub in query["bool"].get(key, []) for t in self._query_terms(sub)]
+        if "query_string" in query:
+            return self._terms(query["query_string"]["query"])
+        (kind, spec), = query.items()
+        return self._terms(spec["text_norm"]["query"])
+
+    def _fragments(self, body, doc):
+        opts = body["highlight"]["fields"]["text_norm"]
+        size = opts.get("fragment_size", 100)
+        text = doc.get("text_norm") or ""
+        if not text:
+            return []
+        low = text.lower()
+        at = min((p for p in (low.find(t) for t in self._query_terms(body["query"])) if p >= 0), default=-1)
+        if at < 0:
+            return [text[:opts.get("no_match_size", 0)]] if opts.get("no_match_size") else []
+        start = max(0, at - size // 4)
+        n = opts.get("number_of_fragments", 5)
+        return [text[i:i + size] for i in range(start, min(len(text), start + size * n), size)]
+
+    def search(self, index, body, **kwargs):
+        self.requests += 1
+        self._wait()
+        return self._search(index, body)
+
+    def msearch(self, body, **kwargs):
+        """ヘッダ行と検索本文が交互に並ぶ _msearch。往復は 1 回分だけ待つ。"""
+        self.requests += 1
+        self._wait()
+        responses = []
+        for header, search in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self._search(header["index"], search))
+            except ValueError as e:
+                responses.append({"error": {"type": "parse_exception", "reason": str(e)}, "status": 400})
+        return {"responses": responses}
+
+    def index(self, index, id, body, **kwargs):
+        self.requests += 1
+        self._wait()
+        self._write_docs(index)[id] = body
+
+    def bulk(self, body, **kwargs):
+        self.requests += 1
+        self._wait()
+        items, errors = [], False
+        lines = iter(body)
+        for action in lines:
+            (op, meta), = action.items()
+            doc = None if op == "delete" else next(lines)
+            _id = meta["_id"]
+            docs = self._write_docs(meta.get("_index") or kwargs["index"])
+            if op == "delete":
+                items.append({op: {"_id": _id, "status": 200 if docs.pop(_id, None) is not None else 404}})
+                continue
+            if op == "update":
+                if _id not in docs:
+                    errors = True
+                    items.append({op: {"_id": _id, "status": 404}})
+                    continue
+                docs[_id].update(doc["doc"])
+            else:
+                docs[_id] = doc
+            items.append({op: {"_id": _id, "status": 200}})
+        return {"errors": errors, "items": items}
+
+    def exists(self, index, id):
+        self.requests += 1
+        return id in self.docs_in(index)
+
+    def update(self, index, id, body):
+        self.requests += 1
+        self._write_docs(index)[id].update(body["doc"])
+
+
+class FakeLLM:
+    """
+    LLM プロバイダのスタブ。実体は app の llm.providers.FakeProvider で、install() で
+    llm.client の主プロバイダに差し替える（リミッタ・同時実行ゲートも通る）。
+    """
+
+    def __init__(self, ttft_ms: float = 300.0, tokens_per_sec: float = 80.0, answer_tokens: int = 60,
+                 rpm: float = 0.0):
+        from llm.providers import FakeProvider
+        self.provider = FakeProvider(ttft_ms=ttft_ms, tokens_per_sec=tokens_per_sec,
+                                     answer_tokens=answer_tokens, rpm=rpm, fail_rate=0.0)
+        self.ttft = self.provider.ttft
+
+    @property
+    def calls(self) -> int:
+        return self.provider.calls
+
+    def install(self, fallback=None):
+        from llm import client
+        client.set_provider(self.provider, fallback)
+        return self
@@ -0,0 +1,51 @@
+"""
+run_full_sync のスループット (msg/s) をスタブ Slack / OpenSearch に対して計測する。
+
+    python bench/ingest_throughput.py --messages 5000
+"""
+import argparse, os, sys, tempfile
+
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-bench")
+os.environ.setdefault("ALLOWED_CHANNEL_ID", "CBENCH")
+# スタブ相手なので Slack のレート制限待ちは外す
+os.environ.setdefault("SLACK_TIER3_PER_MIN", "1000000")
+os.environ.setdefault("SLACK_TIER4_PER_MIN", "1000000")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from fakes import FakeSlack, FakeOpenSearch
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--messages", type=int, default=5000)
+    ap.add_argument("--thread-every", type=int, default=10, help="N 件に 1 件をスレッド親にする")
+    args = ap.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import store
+        import ingest
+        fake_os = FakeOpenSearch()
+        store._os_client = lambda: fake_os
+        slack = FakeSlack("CBENCH", args.messages, thread_every=args.thread_every)
+        result = ingest.run_full_sync("CBENCH", slack)
+        print(f"slack calls: {slack.calls}, opensearch requests: {fake_os.requests}, "
+              f"indexed docs: {len(fake_os.docs)}")
+
+        # 新着 1% と、古いスレッドへの新着返信を足して増分同期
+        for m in slack.messages[-max(1, args.messages // 100):]:
+            slack.add_replies(m, 1)
+        slack.calls = dict.fromkeys(slack.calls, 0)
+        fake_os.requests = 0
+        ingest.run_sync(["CBENCH"], slack)
+        print(f"incremental slack calls: {slack.calls}, opensearch requests: {fake_os.requests}")
+
+        # 何も変わっていない状態で全件再同期 → 書き込みはほぼ発生しないはず
+        fake_os.requests = 0
+        again = ingest.run_full_sync("CBENCH", slack)
+        print(f"unchanged full resync: written={again['written']}, opensearch requests: {fake_os.requests}")
+        return result
+
+
+if __name__ == "__main__":
+    main()
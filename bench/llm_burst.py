@@ -0,0 +1,69 @@
+"""
+バースト時の LLM 呼び出し（llm.client）を、レート制限付きのローカル FakeProvider に対して計測する。
+
+- unlimited : クライアント側のリミッタをほぼ無効にする（429 を受けてから待つ）
+- limited   : クライアント側のリミッタをプロバイダの rpm に合わせる
+- fallback  : limited + 混雑時は 2 つ目の FakeProvider へ回す
+
+    python bench/llm_burst.py --requests 60 --concurrency 20 --rpm 120
+"""
+import argparse, os, statistics, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from llm import client
+from llm.providers import FakeProvider
+
+
+def run(label, args, client_rpm, fallback):
+    client.RPM = client_rpm
+    client.BURST = max(1.0, min(args.rpm, client_rpm) / 6)
+    primary = FakeProvider(name="fake", ttft_ms=args.ttft_ms, tokens_per_sec=0, answer_tokens=5, rpm=args.rpm,
+                           fail_rate=0.0)
+    secondary = FakeProvider(name="fake2", ttft_ms=args.ttft_ms * 2, tokens_per_sec=0, answer_tokens=5, rpm=0,
+                             fail_rate=0.0) if fallback else None
+    client.set_provider(primary, secondary)
+    lat, errors = [], 0
+    providers = {}
+
+    def one(i):
+        t0 = time.perf_counter()
+        client.generate_llm_answer("system", f"question {i}")
+        return (time.perf_counter() - t0) * 1000
+
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        futures = [pool.submit(one, i) for i in range(args.requests)]
+        for f in futures:
+            try:
+                lat.append(f.result())
+            except Exception as e:
+                errors += 1
+                providers[type(e).__name__] = providers.get(type(e).__name__, 0) + 1
+    wall = time.perf_counter() - t0
+    q = statistics.quantiles(lat, n=100) if len(lat) > 1 else [lat[0] if lat else 0] * 99
+    served = f"primary={primary.calls - primary.rejected}" + (f" fallback={secondary.calls}" if secondary else "")
+    print(f"{label:10s} ok={len(lat)} errors={errors} {providers or ''} 429s={primary.rejected} {served} "
+          f"p50={q[49]:.0f}ms p95={q[94]:.0f}ms wall={wall:.1f}s")
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--requests", type=int, default=60)
+    ap.add_argument("--concurrency", type=int, default=20, help="同時に投げるリクエスト数")
+    ap.add_argument("--max-concurrency", type=int, default=8, help="RAG_LLM_MAX_CONCURRENCY 相当")
+    ap.add_argument("--rpm", type=float, default=120, help="FakeProvider が受け付ける requests/min")
+    ap.add_argument("--ttft-ms", type=float, default=200)
+    ap.add_argument("--deadline-sec", type=float, default=120)
+    args = ap.parse_args()
+    client.DEADLINE_SEC = args.deadline_sec
+    client.MAX_ATTEMPTS = 5
+    client.QUEUE_TIMEOUT_SEC = 2.0
+    client.MAX_CONCURRENCY = args.max_concurrency
+    run("unlimited", args, client_rpm=100000, fallback=False)
+    run("limited", args, client_rpm=args.rpm, fallback=False)
+    run("fallback", args, client_rpm=args.rpm, fallback=True)
+
+
+if __name__ == "__main__":
+    main()
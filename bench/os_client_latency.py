@@ -0,0 +1,51 @@
+"""
+search_top_k の 1 クエリあたりのレイテンシを比較する。
+
+- fresh : 毎回クライアント生成 + indices.exists + search（共有化以前の挙動）
+- shared: 共有クライアント + 起動時に 1 回だけインデックス確認
+
+OPENSEARCH_HOST の実クラスタに対して実行する。
+
+    python bench/os_client_latency.py --channel C123 --query デプロイ -n 200
+"""
+import argparse, os, statistics, sys, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+import store
+
+
+def _run(n: int, query: str, channel: str, fresh: bool) -> list[float]:
+    samples = []
+    for _ in range(n):
+        if fresh:
+            store.reset_os_client()
+        t0 = time.perf_counter()
+        store.search_top_k(query, channel, k=5)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def _summary(samples: list[float]) -> str:
+    q = statistics.quantiles(samples, n=100)
+    return f"p50={q[49]:.2f}ms p95={q[94]:.2f}ms mean={statistics.fmean(samples):.2f}ms"
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--channel", required=True)
+    ap.add_argument("--query", default="deploy")
+    ap.add_argument("-n", type=int, default=200)
+    args = ap.parse_args()
+
+    store.ensure_os_index()
+    fresh = _run(args.n, args.query, args.channel, fresh=True)
+    store.reset_os_client()
+    store.ensure_os_index()
+    shared = _run(args.n, args.query, args.channel, fresh=False)
+    print(f"fresh : {_summary(fresh)}")
+    print(f"shared: {_summary(shared)}")
+    print(f"saving per query (p50): {statistics.median(fresh) - statistics.median(shared):.2f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""
+retrieve の 2 段目の並べ替え（rag.rerank）の効果と所要時間。
+
+合成コーパス（スレッド返信あり）に対して、並べ替えなし（BM25 / RRF の順のまま k 件）と
+並べ替えあり（RAG_RERANK_POOL 件から k 件）を比べる。
+- precision@k : 上位 k 件のうちクエリと同じトピックの割合
+- threads@k   : 上位 k 件に含まれる異なるスレッドの数（同じスレッドの返信で埋まっていないか）
+- age         : 上位 k 件の経過日数の中央値
+- rerank      : rerank.rerank 1 回（候補 POOL 件）の所要時間
+
+    python bench/rerank.py --messages 20000 --queries 200 -k 6
+"""
+import argparse, os, statistics, sys, tempfile, time
+
+os.environ.setdefault("RAG_SEARCH_BACKEND", "fts5")
+os.environ.setdefault("RAG_CACHE_SIZE", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from corpus import Corpus
+from fakes import FakeOpenSearch
+
+
+def pct(samples, p):
+    return statistics.quantiles(samples, n=100)[p - 1] if len(samples) > 1 else samples[0]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--messages", type=int, default=20000)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--thread-every", type=int, default=4)
+    ap.add_argument("-k", type=int, default=6)
+    args = ap.parse_args()
+
+    # 1 年ぶんに広げる（新しさの特徴量が効くように）
+    corpus = Corpus(seed=args.seed, channels=2, messages=args.messages, queries=args.queries,
+                    thread_every=args.thread_every, spacing_sec=max(10, 365 * 86400 // args.messages))
+    records = corpus.records()
+    now = max(float(r["ts"]) for r in records)
+    thread_of = {r["id"]: float(r["thread_ts"] or r["ts"]) for r in records}
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import store
+        fake_os = FakeOpenSearch()
+        store._os_client = lambda: fake_os
+        store.init_db()
+        from rag import retriever, rerank
+        for i in range(0, len(records), 1000):
+            store.upsert_messages(records[i:i + 1000])
+        print(f"corpus: {len(records)} messages", file=sys.stderr)
+
+        real_rerank = rerank.rerank
+        timings = []
+
+        def timed(hits, query, k, _now=None):
+            # コーパスの「現在」で新しさを測る
+            t0 = time.perf_counter()
+            out = real_rerank(hits, query, k, now)
+            timings.append((time.perf_counter() - t0) * 1000)
+            return out
+
+        rerank.rerank = timed
+        for dense in (False, True):
+            retriever.DENSE = dense
+            for on in (False, True):
+                retriever.RERANK = on
+                precision, threads, ages = [], [], []
+                for q, ch, topic in corpus.queries:
+                    hits = retriever.retrieve(q, ch, k=args.k)
+                    if not hits:
+                        continue
+                    precision.append(sum(corpus.topic_of[h["id"]] == topic for h in hits) / args.k)
+                    threads.append(len({thread_of[h["id"]] for h in hits}))
+                    ages.append(statistics.median((now - float(h["ts"])) / 86400 for h in hits))
+                label = f"{'hybrid' if dense else 'bm25'}{' + rerank' if on else ''}"
+                print(f"{label:16s} precision@{args.k}={statistics.fmean(precision):.3f} "
+                      f"threads@{args.k}={statistics.fmean(threads):.2f} age={statistics.median(ages):.0f}d")
+        print(f"rerank over {rerank.POOL} candidates: p50={pct(timings, 50) * 1000:.0f}us "
+              f"p99={pct(timings, 99) * 1000:.0f}us")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,261 @@
+"""
+再現可能なベンチマーク一式。シード固定の合成コーパス（bench/corpus.py）と
+インプロセスのスタブ（Slack / OpenSearch / LLM, bench/fakes.py）に対して
+以下のシナリオを回し、結果を JSON で出力する。
+
+- full_sync        : run_sync(full=True) のスループット
+- incremental_sync : 新着 1% + 既存スレッドへの返信を足した増分同期
+- realtime_upsert  : 編集・削除イベントを WriteBehindWriter に流したときのスループット
+- search           : search_top_k / search_fts / retrieve の p50 / p95 / p99
+- dm_answer        : DM 1 件あたりの get_last_channel → retrieve → stream_answer
+                     （最初のトークンまでと完了までの p50 / p95 / p99）
+- rerank           : retrieve が集めた候補の並べ替え（rag.rerank）1 回の p50 / p95 / p99
+
+    python bench/run.py --out bench_output.json
+    python bench/run.py --baseline bench/baseline.json --fail-on-regression
+    python bench/run.py --save-baseline bench/baseline.json
+
+--baseline を渡すと指標ごとの増減を表示し、tolerance を超えて悪化したものを REGRESSION とする。
+"""
+import argparse, contextlib, json, os, platform, statistics, sys, tempfile, time
+
+os.environ.setdefault("SLACK_BOT_TOKEN", "xoxb-bench")
+os.environ.setdefault("ALLOWED_CHANNEL_ID", "CB000")
+# スタブ相手なので Slack のレート制限待ちは外す
+os.environ.setdefault("SLACK_TIER3_PER_MIN", "1000000")
+os.environ.setdefault("SLACK_TIER4_PER_MIN", "1000000")
+# キャッシュが効くと計測にならないので既定では切る（環境変数で上書き可）
+os.environ.setdefault("RAG_CACHE_SIZE", "0")
+os.environ.setdefault("RAG_ANSWER_CACHE_TTL_SEC", "0")
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from corpus import Corpus
+from fakes import FakeSlack, FakeOpenSearch, FakeLLM
+
+
+def summarize(samples_ms):
+    if not samples_ms:
+        return {"n": 0}
+    q = statistics.quantiles(samples_ms, n=100) if len(samples_ms) > 1 else [samples_ms[0]] * 99
+    return {"n": len(samples_ms), "p50_ms": q[49], "p95_ms": q[94], "p99_ms": q[98],
+            "mean_ms": statistics.fmean(samples_ms)}
+
+
+def timed(fn, *args, **kwargs):
+    t0 = time.perf_counter()
+    out = fn(*args, **kwargs)
+    return out, (time.perf_counter() - t0) * 1000
+
+
+def scenario_full_sync(ctx):
+    slack, fake_os = ctx["slack"], ctx["os"]
+    fake_os.requests = 0
+    r = ctx["ingest"].run_sync(ctx["corpus"].channel_ids, slack, full=True)
+    return {"messages": r["messages"], "seconds": r["seconds"], "msgs_per_sec": r["msgs_per_sec"],
+            "slack_calls": sum(slack.calls.values()), "os_requests": fake_os.requests}
+
+
+def scenario_incremental_sync(ctx):
+    corpus, slack, fake_os = ctx["corpus"], ctx["slack"], ctx["os"]
+    n = max(1, corpus.size // 100)
+    for i in range(n):
+        ch = corpus.channel_ids[i % len(corpus.channel_ids)]
+        if i % 2:
+            slack.post(ch, f"新着 {i} deploy の確認 please check")
+        else:
+            parent = slack.history[ch][-1 - (i // 2) % len(slack.history[ch])]
+            slack.add_replies(parent, 1, channel_id=ch)
+    slack.calls = dict.fromkeys(slack.calls, 0)
+    fake_os.requests = 0
+    r = ctx["ingest"].run_sync(corpus.channel_ids, slack)
+    return {"messages": r["messages"], "written": r["written"], "seconds": r["seconds"],
+            "slack_calls": sum(slack.calls.values()), "os_requests": fake_os.requests}
+
+
+def scenario_realtime_upsert(ctx):
+    from realtime import WriteBehindWriter
+    corpus = ctx["corpus"]
+    events = corpus.edit_events()
+    writer = WriteBehindWriter("https://example.slack.com/", channels=corpus.channel_ids,
+                               maxsize=len(events) + 1, batch_size=100, flush_sec=0.05)
+    t0 = time.perf_counter()
+    writer.start()
+    for ev in events:
+        writer.handle_event(ev)
+    writer.stop(timeout=60)
+    seconds = time.perf_counter() - t0
+    return {"events": len(events), "flushed": writer.flushed, "seconds": seconds,
+            "events_per_sec": len(events) / seconds if seconds > 0 else 0.0}
+
+
+def scenario_search(ctx, k=6):
+    import store
+    from rag import retriever
+    queries = ctx["corpus"].queries
+    out = {}
+    for name, fn in (("search_top_k", store.search_top_k), ("search_fts", store.search_fts),
+                     ("retrieve", retriever.retrieve)):
+        fn(*queries[0][:2], k=k)  # ウォームアップ（インデックス確認・mmap 等）
+        out[name] = summarize([timed(fn, q, ch, k=k)[1] for q, ch, _ in queries])
+    return out
+
+
+def scenario_dm_answer(ctx, n=30, k=6):
+    import store
+    from rag.retriever import retrieve
+    from rag.generator import stream_answer
+    ttft, total = [], []
+    for i, (q, ch, _) in enumerate(ctx["corpus"].queries[:n]):
+        user = f"UBENCH{i % 5}"
+        store.set_last_channel(user, ch)
+        t0 = time.perf_counter()
+        channel = store.get_last_channel(user)
+        hits = retrieve(q, channel, k=k)
+        first = None
+        for _ in stream_answer(q, hits):
+            if first is None:
+                first = (time.perf_counter() - t0) * 1000
+        total.append((time.perf_counter() - t0) * 1000)
+        ttft.append(first if first is not None else total[-1])
+    return {"time_to_first_token": summarize(ttft), "total": summarize(total), "llm_calls": ctx["llm"].calls}
+
+
+def scenario_rerank(ctx, k=6, repeat=5):
+    """retrieve が rerank に渡す候補（RAG_RERANK_POOL 件まで）を集め、rerank.rerank だけを計る。"""
+    from rag import retriever, rerank
+    real, enabled = rerank.rerank, retriever.RERANK
+    pools = []
+
+    def capture(hits, query, k, now=None):
+        pools.append((list(hits), query))
+        return real(hits, query, k, now)
+
+    rerank.rerank, retriever.RERANK = capture, True
+    try:
+        for q, ch, _ in ctx["corpus"].queries:
+            retriever.retrieve(q, ch, k=k)
+    finally:
+        rerank.rerank, retriever.RERANK = real, enabled
+    samples = [timed(real, hits, query, k)[1] for _ in range(repeat) for hits, query in pools]
+    return {"pools": len(pools), "candidates": statistics.fmean(len(h) for h, _ in pools) if pools else 0.0,
+            "rerank": summarize(samples)}
+
+
+SCENARIOS = {
+    "full_sync": scenario_full_sync,
+    "incremental_sync": scenario_incremental_sync,
+    "realtime_upsert": scenario_realtime_upsert,
+    "search": scenario_search,
+    "dm_answer": scenario_dm_answer,
+    "rerank": scenario_rerank,
+}
+
+
+def _flatten(d, prefix=""):
+    for key, v in d.items():
+        name = f"{prefix}.{key}" if prefix else key
+        if isinstance(v, dict):
+            yield from _flatten(v, name)
+        elif isinstance(v, (int, float)):
+            yield name, float(v)
+
+
+def _direction(metric):
+    """1: 大きいほど良い / -1: 小さいほど良い / 0: 比較しない（件数など）。"""
+    leaf = metric.rsplit(".", 1)[-1]
+    if leaf.endswith("_per_sec"):
+        return 1
+    if leaf.endswith("_ms") or leaf == "seconds":
+        return -1
+    return 0
+
+
+def compare(result, baseline, tolerance):
+    """baseline との差分を表示し、tolerance（比率）を超えて悪化した指標名を返す。"""
+    if baseline.get("params") != result.get("params"):
+        print(f"warning: baseline params differ: {baseline.get('params')} vs {result.get('params')}", file=sys.stderr)
+    base = dict(_flatten(baseline.get("results", {})))
+    regressions = []
+    for metric, value in _flatten(result["results"]):
+        d = _direction(metric)
+        if not d or metric not in base or base[metric] == 0:
+            continue
+        change = (value - base[metric]) / base[metric]
+        worse = -change * d
+        flag = "REGRESSION" if worse > tolerance else ("improved" if worse < -tolerance else "")
+        if flag == "REGRESSION":
+            regressions.append(metric)
+        print(f"  {metric:45s} {base[metric]:12.2f} -> {value:12.2f} ({change:+7.1%}) {flag}", file=sys.stderr)
+    return regressions
+
+
+def run(args):
+    corpus = Corpus(seed=args.seed, channels=args.channels, messages=args.messages, queries=args.queries)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import store
+        import ingest
+        fake_os = FakeOpenSearch(latency_ms=args.os_latency_ms)
+        store._os_client = lambda: fake_os
+        store.init_db()
+        llm = FakeLLM(ttft_ms=args.llm_ttft_ms, tokens_per_sec=args.llm_tokens_per_sec).install()
+        ctx = {"corpus": corpus, "slack": FakeSlack(corpus=corpus), "os": fake_os, "llm": llm, "ingest": ingest}
+        results = {}
+        for name in args.scenarios:
+            print(f"== {name}", file=sys.stderr)
+            results[name] = SCENARIOS[name](ctx)
+    return {
+        "params": {"seed": args.seed, "messages": args.messages, "channels": args.channels,
+                   "queries": args.queries, "os_latency_ms": args.os_latency_ms,
+                   "llm_ttft_ms": args.llm_ttft_ms, "llm_tokens_per_sec": args.llm_tokens_per_sec},
+        "env": {"python": platform.python_version(), "machine": platform.machine(),
+                "created_at": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--messages", type=int, default=5000, help="親メッセージ数（返信は別に約 30%%）")
+    ap.add_argument("--channels", type=int, default=4)
+    ap.add_argument("--queries", type=int, default=200)
+    ap.add_argument("--os-latency-ms", type=float, default=0.0, help="OpenSearch スタブの 1 リクエストあたりの遅延")
+    ap.add_argument("--llm-ttft-ms", type=float, default=50.0)
+    ap.add_argument("--llm-tokens-per-sec", type=float, default=500.0)
+    ap.add_argument("--scenarios", default=",".join(SCENARIOS), help="カンマ区切り（既定: 全部）")
+    ap.add_argument("--out", help="結果 JSON の出力先（既定: 標準出力）")
+    ap.add_argument("--baseline", help="比較対象の結果 JSON")
+    ap.add_argument("--save-baseline", help="結果をこのパスに baseline として保存する")
+    ap.add_argument("--tolerance", type=float, default=0.2, help="悪化とみなす変化率（既定 20%%）")
+    ap.add_argument("--fail-on-regression", action="store_true")
+    args = ap.parse_args()
+    args.scenarios = [s.strip() for s in args.scenarios.split(",") if s.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        ap.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    # ingest の進捗表示などは stderr へ回し、標準出力は JSON だけにする
+    with contextlib.redirect_stdout(sys.stderr):
+        result = run(args)
+    text = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+        print(f"compared with {args.baseline} (tolerance {args.tolerance:.0%}):", file=sys.stderr)
+        regressions = compare(result, baseline, args.tolerance)
+        if regressions and args.fail_on_regression:
+            print(f"{len(regressions)} regression(s): {', '.join(regressions)}", file=sys.stderr)
+            raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+スナップショット（app/snapshot.py）からの立ち上げを計測する。
+
+1. 元の DB をコーパスで作る（upsert_messages。Slack から同期したのと同じ書き込み経路）
+2. export → 新しい空の DB へ import（SQLite / FTS5 → reindex で FakeOpenSearch）
+3. 件数・FTS5 の検索結果・OpenSearch のドキュメント数が元と一致するかを確かめ、
+   upsert_messages で入れ直した場合の時間と比べる
+
+    python bench/snapshot_bootstrap.py --messages 200000
+"""
+import argparse, contextlib, os, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from corpus import Corpus
+from fakes import FakeOpenSearch
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--messages", type=int, default=200000)
+    ap.add_argument("--channels", type=int, default=8)
+    ap.add_argument("--batch", type=int, default=50000)
+    args = ap.parse_args()
+
+    corpus = Corpus(seed=args.seed, channels=args.channels, messages=args.messages, queries=50)
+    records = corpus.records()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "source.sqlite")
+        import store, snapshot
+        store._os_client = lambda: FakeOpenSearch()
+        store.init_db()
+        t0 = time.perf_counter()
+        for i in range(0, len(records), 1000):
+            store.upsert_messages(records[i:i + 1000])
+        upsert_sec = time.perf_counter() - t0
+        store.set_sync_state(corpus.channel_ids[0], records[-1]["ts"])
+        print(f"source: {len(records)} messages via upsert_messages in {upsert_sec:.1f}s "
+              f"({len(records) / upsert_sec:.0f} msg/s)")
+        expected = {q: [h["id"] for h in store.search_fts(q, ch, k=10)] for q, ch, _ in corpus.queries}
+
+        path = os.path.join(tmp, "snapshot.parquet")
+        with contextlib.redirect_stdout(sys.stderr):
+            exported = snapshot.export_snapshot(path, args.batch)
+        db_bytes = os.path.getsize(store.DB_PATH)
+
+        # 空の DB / OpenSearch へ取り込む
+        store.DB_PATH = os.path.join(tmp, "restored.sqlite")
+        fake_os = FakeOpenSearch()
+        store.reset_os_client()
+        store._os_client = lambda: fake_os
+        with contextlib.redirect_stdout(sys.stderr):
+            imported = snapshot.import_snapshot(path, args.batch)
+
+        conn = store.get_conn()
+        rows = conn.execute("SELECT COUNT(*) FROM messages").fetchone()[0]
+        fts_rows = conn.execute("SELECT COUNT(*) FROM messages_fts").fetchone()[0]
+        got = {q: [h["id"] for h in store.search_fts(q, ch, k=10)] for q, ch, _ in corpus.queries}
+        t0 = time.perf_counter()
+        table = snapshot.stats(path)
+        stats_sec = time.perf_counter() - t0
+
+        print(f"export : {exported['rows']} rows in {exported['seconds']:.2f}s, "
+              f"{exported['bytes'] / 1e6:.1f} MB (SQLite file {db_bytes / 1e6:.1f} MB)")
+        print(f"import : SQLite + FTS5 {imported['sqlite_seconds']:.2f}s "
+              f"({imported['rows'] / imported['sqlite_seconds']:.0f} msg/s), "
+              f"OpenSearch reindex {imported['reindex']['seconds']:.2f}s, total {imported['seconds']:.2f}s")
+        print(f"check  : rows {rows}/{len(records)}, fts rows {fts_rows}, opensearch docs {len(fake_os.docs)}, "
+              f"fts results identical for {sum(expected[q] == got[q] for q in expected)}/{len(expected)} queries, "
+              f"sync_state {store.get_sync_state(corpus.channel_ids[0]) == records[-1]['ts']}")
+        print(f"stats  : {len(table.splitlines()) - 2} channel-months in {stats_sec:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
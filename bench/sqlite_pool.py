@@ -0,0 +1,123 @@
+"""
+SQLite の接続層の前後比較。同じ store の関数を 2 通りの get_conn で呼ぶ。
+
+- before: 呼び出しごとに sqlite3.connect して捨てる（プール以前の挙動）。user_prefs のキャッシュも使わない
+- after : スレッドごとの接続を使い回す + PRAGMA 調整 + user_prefs の書き込みスルーのキャッシュ
+
+DM の処理で毎回通る get_last_channel、その他の単発の読み書きと、
+複数スレッドで DM の参照と upsert を同時に流したときの処理量を測る。
+
+    python bench/sqlite_pool.py --messages 20000 -n 2000 --threads 8
+"""
+import argparse, os, sqlite3, statistics, sys, tempfile, threading, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from corpus import Corpus
+from fakes import FakeOpenSearch
+
+
+def _summary(samples):
+    q = statistics.quantiles(samples, n=100)
+    return f"p50={q[49] * 1000:7.1f}us p95={q[94] * 1000:7.1f}us"
+
+
+def _time(fn, n):
+    samples = []
+    for i in range(n):
+        t0 = time.perf_counter()
+        fn(i)
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--messages", type=int, default=20000)
+    ap.add_argument("-n", type=int, default=2000, help="1 操作あたりの呼び出し回数")
+    ap.add_argument("--threads", type=int, default=8)
+    ap.add_argument("--seconds", type=float, default=2.0, help="並行負荷を流す時間")
+    args = ap.parse_args()
+
+    corpus = Corpus(seed=args.seed, channels=4, messages=args.messages, queries=10)
+    records = corpus.records()
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import store
+        fake_os = FakeOpenSearch()
+        store._os_client = lambda: fake_os
+        store.init_db()
+        for i in range(0, len(records), 1000):
+            store.upsert_messages(records[i:i + 1000])
+        users = [f"U{i:04d}" for i in range(200)]
+        for i, u in enumerate(users):
+            store.set_last_channel(u, corpus.channel_ids[i % len(corpus.channel_ids)])
+        ids = [r["id"] for r in records]
+        print(f"corpus: {len(records)} messages, {len(users)} users", file=sys.stderr)
+
+        pooled = store.get_conn
+
+        def fresh():
+            # プール以前の get_conn（閉じるのは呼び出し側の参照が切れたとき）
+            conn = sqlite3.connect(store.DB_PATH)
+            conn.row_factory = sqlite3.Row
+            return conn
+
+        ops = {
+            "get_last_channel (DM)": lambda i: store.get_last_channel(users[i % len(users)]),
+            "set_last_channel": lambda i: store.set_last_channel(users[i % len(users)], corpus.channel_ids[i % 4]),
+            "get_messages x10": lambda i: store.get_messages(ids[i % 1000:i % 1000 + 10]),
+            "upsert_message (unchanged)": lambda i: store.upsert_message(dict(records[i % len(records)])),
+            "get_sync_state": lambda i: store.get_sync_state(corpus.channel_ids[i % 4]),
+        }
+        results = {}
+        for mode in ("before", "after"):
+            store.get_conn = fresh if mode == "before" else pooled
+            for name, fn in ops.items():
+                if mode == "before":
+                    # 毎回 SQLite を引かせる
+                    fn = (lambda f: lambda i: (store._PREFS.clear(), f(i)))(fn)
+                results[(mode, name)] = _time(fn, args.n)
+
+            # 並行: threads-1 本で DM の参照、1 本で upsert（変更あり）を流す
+            stop = time.perf_counter() + args.seconds
+            counts = [0] * args.threads
+
+            def reader(slot):
+                i = slot
+                while time.perf_counter() < stop:
+                    if mode == "before":
+                        store._PREFS.clear()
+                    store.get_last_channel(users[i % len(users)])
+                    i += args.threads
+                    counts[slot] += 1
+
+            def writer(slot):
+                i = 0
+                while time.perf_counter() < stop:
+                    r = dict(records[i % len(records)])
+                    r["text_norm"] += f" edit {mode} {i}"
+                    store.upsert_message(r)
+                    i += 1
+                    counts[slot] += 1
+
+            threads = [threading.Thread(target=writer if t == 0 else reader, args=(t,)) for t in range(args.threads)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+            results[(mode, "concurrent")] = (counts[0] / args.seconds, sum(counts[1:]) / args.seconds)
+        store.get_conn = pooled
+
+        for name in ops:
+            before, after = results[("before", name)], results[("after", name)]
+            print(f"{name:28s} before {_summary(before)}  after {_summary(after)}  "
+                  f"x{statistics.median(before) / statistics.median(after):.1f}")
+        for mode in ("before", "after"):
+            writes, reads = results[(mode, "concurrent")]
+            print(f"concurrent {mode:6s}: {reads:8.0f} DM lookups/s, {writes:6.0f} upserts/s "
+                  f"({args.threads - 1} readers + 1 writer)")
+
+
+if __name__ == "__main__":
+    main()
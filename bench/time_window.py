@@ -0,0 +1,74 @@
+"""
+時間窓つき検索のベンチ。何年分もあるチャンネルで「直近30日」などを聞いたときの search_top_k を、
+1 つのインデックス（OPENSEARCH_PARTITION=none）と月ごとのパーティション（month）で比べる。
+
+SQLite に一度だけ投入し、モードごとに新しい FakeOpenSearch へ reindex.py で入れ直す
+（本番で none → month に切り替えるときと同じ手順）。FakeOpenSearch の検索コストは
+対象インデックスのドキュメント数に比例するので、パーティションで絞った効果がそのまま出る。
+
+    python bench/time_window.py --messages 20000 --years 3 --window 直近30日
+"""
+import argparse, contextlib, os, statistics, sys, tempfile, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "app"))
+from corpus import Corpus
+from fakes import FakeOpenSearch
+
+
+def p50(samples):
+    return statistics.median(samples) if samples else 0.0
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--seed", type=int, default=7)
+    ap.add_argument("--messages", type=int, default=20000)
+    ap.add_argument("--channels", type=int, default=4)
+    ap.add_argument("--years", type=float, default=3.0, help="コーパスが覆う期間")
+    ap.add_argument("--queries", type=int, default=100)
+    ap.add_argument("--window", default="直近30日", help="質問文に付ける期間指定")
+    ap.add_argument("--os-latency-ms", type=float, default=0.0)
+    args = ap.parse_args()
+
+    spacing = max(5, int(args.years * 365 * 86400 / args.messages))
+    corpus = Corpus(seed=args.seed, channels=args.channels, messages=args.messages, queries=args.queries,
+                    spacing_sec=spacing)
+    records = corpus.records()
+    now = max(float(r["ts"]) for r in records)
+    with tempfile.TemporaryDirectory() as tmp:
+        os.environ["SQLITE_PATH"] = os.path.join(tmp, "bench.sqlite")
+        import store, reindex
+        from rag.timewindow import extract_time_window
+        store._os_client = lambda: FakeOpenSearch()
+        store.init_db()
+        for i in range(0, len(records), 1000):
+            store.upsert_messages(records[i:i + 1000])
+        print(f"corpus: {len(records)} messages over {args.years:g} years", file=sys.stderr)
+
+        for mode in ("none", "month"):
+            fake_os = FakeOpenSearch(latency_ms=args.os_latency_ms)
+            store.reset_os_client()
+            store._os_client = lambda: fake_os
+            store.PARTITION = mode
+            with contextlib.redirect_stdout(sys.stderr):
+                reindex.reindex()
+            full, windowed, hits_full, hits_windowed = [], [], 0, 0
+            for q, ch, _ in corpus.queries:
+                query, window = extract_time_window(f"{args.window} {q}", now=now)
+                if window[1] is None:
+                    # コーパスの「現在」は実時間より先なので、開いた窓は最後のメッセージまでで閉じる
+                    window = (window[0], now + 1)
+                t0 = time.perf_counter()
+                hits_full += len(store.search_top_k(query, ch, k=6))
+                t1 = time.perf_counter()
+                hits_windowed += len(store.search_top_k(query, ch, k=6, window=window))
+                t2 = time.perf_counter()
+                full.append((t1 - t0) * 1000)
+                windowed.append((t2 - t1) * 1000)
+            print(f"partition={mode:5s} indices={len(fake_os.store):3d} "
+                  f"all-time p50={p50(full):6.2f}ms hits={hits_full}  "
+                  f"{args.window} p50={p50(windowed):6.2f}ms hits={hits_windowed}")
+
+
+if __name__ == "__main__":
+    main()